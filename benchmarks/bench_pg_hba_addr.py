@@ -0,0 +1,401 @@
+#!/usr/bin/python3
+
+'''
+# Copyright (C) 2017 Collaboration of KPN and Splendid Data
+#
+# This file is part of puppet_pure_postgres.
+#
+# puppet_pure_barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# puppet_pure_postgres is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with puppet_pure_postgres.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+'''
+This script benchmarks the integer based address engine of pg_hba.py (parse_network)
+against the original regex and string based functions (ipv4_re, ipv6_re, ipv4_to_int, ipv6_to_int,
+prefix_to_ipv4netmask, prefix_to_ipv6netmask and the original gateway calculation), which are kept in this script.
+
+It generates random ipv4, ipv6 and ipv4-mapped ipv6 networks in different notations, runs them through both,
+checks that family, address, netmask and gateway are the same, and prints the throughput of both.
+It exits with 1 if any result differs.
+
+Example usage:
+  bench_pg_hba_addr.py -n 1000000
+'''
+
+import os
+import re
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'files'))
+import pg_hba
+from pg_hba import IPError
+
+'''
+Below are the original regular expressions and functions of pg_hba.py (up to 1.1.x), the reference implementation
+that parse_network is verified against. pg_hba.py itself doesn't use them anymore.
+'''
+
+'''
+The following generates a regular expression which can be used to find ipv4 addresses.
+There are easier approaches, but this is the most thorough one.
+See http://stackoverflow.com/questions/53497/regular-expression-that-matches-valid-ipv6-addresses for more info...
+'''
+#segment of ipv4, can be 0 to 255
+IPV4SEG   = '(25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])'
+#IPv4 address consists of 3x(segment+.)+segement
+IPV4ADDR  = '('+IPV4SEG+r'\.){3,3}'+IPV4SEG
+
+'''
+The following generates a regular expression which can be used to find ipv6 addresses.
+There are easier approaches, but this is the most thorough one.
+See http://stackoverflow.com/questions/53497/regular-expression-that-matches-valid-ipv6-addresses for more info...
+'''
+
+#segment of ipv6, can be 0 to 4 times (0-9, a-z or A-Z)
+IPV6SEG   = '[0-9a-fA-F]{1,4}'
+
+#This a concattenation of all possible combinations that would describe a valid ipv6 address.
+#Comment after the line gives an example.
+IPV6ADDR  = '(('+IPV6SEG+':){7,7}'+IPV6SEG+'|'           # 1:2:3:4:5:6:7:8
+IPV6ADDR += '('+IPV6SEG+':){1,7}:|'                      # 1::
+IPV6ADDR += '('+IPV6SEG+':){1,6}:'+IPV6SEG+'|'           # 1::8               1:2:3:4:5:6::8   1:2:3:4:5:6::8
+IPV6ADDR += '('+IPV6SEG+':){1,5}(:'+IPV6SEG+'){1,2}|'    # 1::7:8             1:2:3:4:5::7:8   1:2:3:4:5::8
+IPV6ADDR += '('+IPV6SEG+':){1,4}(:'+IPV6SEG+'){1,3}|'    # 1::6:7:8           1:2:3:4::6:7:8   1:2:3:4::8
+IPV6ADDR += '('+IPV6SEG+':){1,3}(:'+IPV6SEG+'){1,4}|'    # 1::5:6:7:8         1:2:3::5:6:7:8   1:2:3::8
+IPV6ADDR += '('+IPV6SEG+':){1,2}(:'+IPV6SEG+'){1,5}|'    # 1::4:5:6:7:8       1:2::4:5:6:7:8   1:2::8
+IPV6ADDR += IPV6SEG+':((:'+IPV6SEG+'){1,6})|'            # 1::3:4:5:6:7:8     1::3:4:5:6:7:8   1::8
+IPV6ADDR += ':((:'+IPV6SEG+'){1,7}|:)|'                  # ::2:3:4:5:6:7:8    ::2:3:4:5:6:7:8  ::8       ::       
+IPV6ADDR += 'fe80:(:'+IPV6SEG+'){0,4}%[0-9a-zA-Z]{1,}|'  # fe80::7:8%eth0     fe80::7:8%1  (link-local IPv6 addresses with zone index)
+IPV6ADDR += '::(ffff(:0{1,4}){0,1}:){0,1}'+IPV4ADDR+'|'  # ::255.255.255.255  ::ffff:255.255.255.255  ::ffff:0:255.255.255.255 (IPv4-mapped IPv6 addresses and IPv4-translated addresses)
+IPV6ADDR += '('+IPV6SEG+':){1,4}:'+IPV4ADDR+')'          # 2001:db8:3:4::192.0.2.33  64:ff9b::192.0.2.33 (IPv4-Embedded IPv6 Address)
+
+#regular expression to detect if a string is an ipv4 address
+ipv4_re     = re.compile(r'^\s*'+IPV4ADDR+r'(/\d{1,2})?\s*$')
+#regular expression to find an ipv4 address in a string
+ipv4part_re = re.compile(IPV4ADDR)
+#regular expression to detect if a string is an ipv6 address
+ipv6_re     = re.compile(r'^\s*'+IPV6ADDR+r'(/\d{1,3})?\s*$')
+#regular expression to find an ipv6 address in a string
+ipv6_obs_re = re.compile(r'(\s|:)(0{1,4}:)+')
+
+'''
+This function converts a string containing an ip address like '192.168.0.101' to an integer like 3232235621.
+It is the inverse of int_to_ipv4().
+'''
+def ipv4_to_int(ip):
+    if type(ip) is int:
+        # If IP was already an integer, then just return it unchanged
+        return ip
+    elif type(ip) is str:
+        #Split by '.'
+        ip_ar = ip.split(".")
+        #check that there are 4 parts
+        if len(ip_ar) != 4:
+            raise IPError("Invalid IP: {0}. We need 4 numbers in an IP".format(ip))
+        #Start empty
+        ip=0
+        #Loop through parts and
+        for i in ip_ar:
+            try:
+                #convert to int
+                i=int(i)
+            except:
+                raise IPError("IP part {0} must be numeric".format(i))
+            #Check that it is within range
+            if i<0 or i>255:
+                raise IPError("IP part {0} must be from 0-255".format(i))
+            #Scale original part up 256 times and add the new part
+            ip=ip*256+i
+        #IP p1.p2.p3.p4 should now be 256**3 * p1 + 256**2 * p2 + 256 * p3 + p4.
+        #Return as result
+        return ip
+    else:
+        raise IPError("{0} has an invalid type for an IP.".format(ip.__repr__()))
+
+'''
+This function converts an integer converted ip address like 3232235621 back into a string like '192.168.0.101'.
+It is the inverse of ipv4_to_int().
+'''
+def int_to_ipv4(i):
+    try:
+        # Check that it is (or can be convert to) a basic integer
+        i = int(i)
+    except:
+        raise IPError("{0} is not an integer.".format(i.__repr__()))
+    if i >= 2**32 or i < 0:
+        raise IPError('IP address number out of range.')
+    ip = []
+    for x in range(4):
+        #First see what the scale factor (what we should divide i by to get the part) of this part is.
+        #For part 0 (everything that should end up before the first dot) it would be 256**3
+        #For part 3 (everything that should end up after the last dot) it would be 1
+        scale = 256**(3-x)
+
+        #Then divide i by scale and trim everything larger than 256 and everything smaller than 1
+        part=int(i/scale) % 256
+
+        #Convert part to string and add to list
+        ip.append(str(part))
+
+    #By now, we have a list of parts like ['192', '168', '0', '101' ].
+    #Join the list elements to one string, seperated by dot and you get the reult, like '192.168.0.101'.
+    return '.'.join(ip)
+
+'''
+This function converts a string containing a network base like '/24' to a netmask like '256.256.256.0'.
+'''
+def prefix_to_ipv4netmask(base):
+    if type(base) is str:
+        #It could contain a /. If it does, remove it.
+        base=base.replace('/','')
+    try:
+        #convert to int
+        base=int(base)
+    except:
+        raise IPError("invalid numeric expression for ipv4 network base {}".format(base))
+
+    #Generate the amount of ones as required (/24 would generate 16 times a 1, like 111111111111111111111111)
+    #Basically, 2**24 would be a 1 and 24 zeros. If you substract 1, you end up with 24 1's.
+    ones = 2**base-1
+
+    #After the ones, there should be a number of zeroes making a total of 32 bits.
+    #So for 24 1's there should be 8 zero's and for 16 there should be 16. This is always (32-base) zero's.
+    #For every zero, one could multiply by two, so for 8 zero's one should multiply by 2**8.
+    #And for (32-base) zero's, one can multiply with 2**(32-base)
+    multiplier = 2 ** (32-base)
+    netmask = ones * multiplier
+
+    #convert t to a ipv4 string with int_to_ipv4 and return it
+    return int_to_ipv4(netmask)
+
+'''
+This function converts a string containing an ipv6 address like 'fe80::79ee:7b70:320f:8877' 
+into an integer like 338288524927261089662804992486200543351.
+It understands (and converts) an ipv4 part in a ipv6 address, aswell as '::'
+It is the inverse of int_to_ipv6() and the ipv6 alternate to ipv4_to_int().
+'''
+def ipv6_to_int(ip):
+    # We will create a normalized version too.
+    # Better copy to new varaiable and leave the passed in unchanged,
+    # so that it is easy to compare during debug
+    normalized = ip
+    if '.' in normalized:
+        # If it holds a '.', it probably holds an ipv4 part.
+        # Check using re.search
+        m = ipv4part_re.search(normalized)
+        #Convert ipv4 parts (dec) to ipv6 parts (hex)
+        ipv6part = ''.join('%02x'%int(i) for i in m.group(0).split('.'))
+        #It is now one hex of 8 digits, while it should be two of 4. Lets insert a ':' in the middle.
+        ipv6part = ipv6part[:4] + ':' + ipv6part[4:]
+        #And replace the ipv4 part in the ip by the just generated ipv6 counterpart
+        normalized = normalized.replace(m.group(0), ipv6part)
+    if '::' in ip:
+        if ':::' in ip:
+            raise IPError('::: is not valid in ipv6')
+        # It is possible that multiple parts of ':0000:' are together replaced by a single '::'.
+        # If so, we should rstore that to the ':0000:' parts
+        # First see how much are missing
+        missing = 8 - normalized.count(':')
+        # This creates a string with '0000' elements surrounded and seperated by ':', just as much as there where missing.
+        replacer = ':'+'0000:'*missing
+        # Replace the '::' by the replacer string
+        normalized = normalized.replace('::', replacer)
+        #If :: was at the beginning (or the end), the initial (or last) ':' should not be there...
+        normalized.strip(':')
+        #normalized = normalized.replace('::',':')
+    #Now split in multiple parts
+    parts = normalized.split(':')
+    if len(parts) < 8:
+        raise IPError('IPv6 seems to consist of too less parts')
+    elif len(parts) > 8:
+        raise IPError('IPv6 seems to consist of too much parts')
+    #Normalize: Every part should have 4 digits. If not, the join would produce the correct number.
+    for i in range(len(parts)):
+        if len(parts[i]) != 4:
+            part = '0000' + parts[i]
+            part = part[-4:]
+            parts[i] = part
+    #Since it is now normalized, we can glue all together and handle this as one huge hexadecimal number
+    hex_result = ''.join(parts)
+    #convert to int with base 16 and return the result
+    return int(hex_result,16)
+
+'''
+This function converts an integer converted ip address like 338288524927261089662804992486200543351 
+back into a string containing an ipv6 address like 'fe80::79ee:7b70:320f:8877'.
+It cleans up by leading zeros and replacing multiple instances of ':0:' by '::'.
+It is the inverse of ipv6_to_int() and the ipv6 counterpart of ipv6_to_int.
+'''
+def int_to_ipv6(i):
+    try:
+        i = int(i)
+    except:
+        raise IPError("{0} is not an integer.".format(i.__repr__()))
+    #convert to hex, but remove the 0x front
+    hex_i = hex(i).split('x')[-1]
+    #Add '0' to the front up until 32 characters total
+    hex_i = '0'*(32 - len(hex_i)) + hex_i
+    #split in parts of 4 characters
+    parts = [ hex_i[i:i+4] for i in range(0, 32, 4) ]
+    #Lets loop through the parts and clean those leading zero's
+    for n in range(len(parts)):
+        #Not looping though parts directly, but using n, so we now the index and can later replace more easilly.
+        #But get the part in seperate variable for easier access
+        part = parts[n]
+        #look for leading zero
+        while part[0] == '0' and part != '0':
+            #remove leading zero
+            part = part[1:]
+        #write back to parts list
+        parts[n] = part
+    #join seperated with ':'. It now looks like a valid ipv6, but some cleanup can be done.
+    ipv6 = ':'.join(parts)
+    #Find repetions of zero fields to replace by '::'
+    obsoletes = [ m.group(0) for m in ipv6_obs_re.finditer(ipv6) ]
+    if len(obsoletes) > 0:
+        # Find largest number of repetitions
+        obsoletes = sorted(obsoletes, key=len)
+        largest_obsolete = obsoletes[-1]
+        # Replace only the first occurrence of this repetition by '::'
+        ipv6 = ipv6.replace(largest_obsolete, '::', 1)
+    if ipv6.startswith('0::'):
+        # If it starts with '0::', the '0' should be left out too.
+        ipv6 = ipv6[1:]
+    if ipv6.endswith('::0'):
+        # If it ends with '::0', the '0' should be left out too.
+        ipv6 = ipv6[:-1]
+    #This is clean ipv6, Lets return.
+    return ipv6
+
+def prefix_to_ipv6netmask(base):
+    if type(base) is str:
+        #if it is a string, could be that a '/' is still in it. remove it if so.
+        base=base.replace('/','')
+    try:
+        #convert to integer
+        base=int(base)
+    except:
+        raise IPError("invalid numeric expression for ipv6 network base {}".format(base))
+
+    #Generate the amount of ones as required (/24 would generate 16 times a 1, like 111111111111111111111111)
+    #Basically, 2**24 would be a 1 and 24 zeros. If you substract 1, you end up with 24 1's.
+    ones = 2**base-1
+
+    #After the ones, there should be a number of zeroes making a total of 128 bits.
+    #So for 96 1's there should be 32 zero's and for 64 there should be 64. This is always (128-base) zero's.
+    #For every zero, one could multiply by two, so for 32 zero's one should multiply by 2**32.
+    #And for (128-base) zero's, one can multiply with 2**(128-base)
+    multiplier = 2 ** (128-base)
+    netmask = ones * multiplier
+
+    #convert t to a ipv6 string with int_to_ipv6 and return it
+    return int_to_ipv6(netmask)
+
+
+'''
+This function generates a random network in one of the notations that can be found in pg_hba files.
+'''
+def random_network(rnd):
+    kind = rnd.randint(0, 3)
+    if kind == 0:
+        #ipv4, sometimes with a leading zero in a part
+        parts = [ str(rnd.randint(0, 255)) for i in range(4) ]
+        if rnd.random() < 0.1:
+            i = rnd.randint(0, 3)
+            if len(parts[i]) == 1:
+                parts[i] = '0' + parts[i]
+        return '.'.join(parts) + '/' + str(rnd.randint(0, 32))
+    elif kind == 1:
+        #ipv6 compressed by the original formatter, with some zero groups to make '::' likely
+        groups = [ rnd.randint(0, 65535) if rnd.random() < 0.6 else 0 for i in range(8) ]
+        i = 0
+        for g in groups:
+            i = (i << 16) | g
+        address = int_to_ipv6(i)
+        if rnd.random() < 0.2:
+            address = address.upper()
+        return address + '/' + str(rnd.randint(0, 128))
+    elif kind == 2:
+        #ipv6 fully written out
+        address = ':'.join('{0:04x}'.format(rnd.randint(0, 65535)) for i in range(8))
+        return address + '/' + str(rnd.randint(0, 128))
+    else:
+        #ipv4 mapped ipv6
+        address = '::ffff:' + '.'.join(str(rnd.randint(0, 255)) for i in range(4))
+        return address + '/' + str(rnd.randint(96, 128))
+
+'''
+This function converts a network the way the original pg_hba.py did,
+and returns a tuple of (family, address, netmask, gateway).
+'''
+def legacy_parse(network):
+    address, prefix = network.split('/')
+    if ipv4_re.search(network):
+        addr = ipv4_to_int(address)
+        netmask = ipv4_to_int(prefix_to_ipv4netmask(prefix))
+        return (4, addr, netmask, (addr & netmask) + 1)
+    elif ipv6_re.search(network):
+        addr = ipv6_to_int(address)
+        netmask = ipv6_to_int(prefix_to_ipv6netmask(prefix))
+        return (6, addr, netmask, (addr & netmask) + 1)
+    return None
+
+'''
+This function converts a network with parse_network and returns the same tuple as legacy_parse.
+'''
+def engine_parse(network):
+    net = pg_hba.parse_network(network)
+    if not net:
+        return None
+    return (net.family, net.addr, net.netmask, net.gateway)
+
+'''
+This function runs func over all networks and returns the results and the number of seconds it took.
+'''
+def timed(func, networks):
+    start = time.time()
+    results = [ func(n) for n in networks ]
+    return results, time.time() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark and verify the pg_hba address engine')
+    parser.add_argument('-n', '--count', help='Number of random networks', type=int, default=1000000)
+    parser.add_argument('--seed',        help='Seed for random generator', type=int, default=1)
+    options = parser.parse_args()
+
+    rnd = random.Random(options.seed)
+    networks = [ random_network(rnd) for i in range(options.count) ]
+
+    legacy, legacy_time = timed(legacy_parse, networks)
+    pg_hba._network_cache.clear()
+    engine, engine_time = timed(engine_parse, networks)
+    #Second run is answered from the memo cache (up to pg_hba._network_cache_size networks)
+    cached, cached_time = timed(engine_parse, networks)
+
+    mismatches = [ (n, l, e) for n, l, e in zip(networks, legacy, engine) if l != e ]
+    mismatches += [ (n, e, c) for n, e, c in zip(networks, engine, cached) if e != c ]
+
+    print('{0:<10} {1:>10} {2:>14}'.format('engine', 'seconds', 'networks/s'))
+    for name, seconds in (('legacy', legacy_time), ('parse', engine_time), ('cached', cached_time)):
+        print('{0:<10} {1:>10.3f} {2:>14.0f}'.format(name, seconds, options.count / max(seconds, 1e-9)))
+    print('speedup parse vs legacy: {0:.1f}x'.format(legacy_time / max(engine_time, 1e-9)))
+
+    if mismatches:
+        print('{0} of {1} networks differ, like:'.format(len(mismatches), options.count))
+        for network, expected, result in mismatches[:10]:
+            print('  {0}: {1} != {2}'.format(network, expected, result))
+        sys.exit(1)
+    print('all {0} networks have the same results'.format(options.count))
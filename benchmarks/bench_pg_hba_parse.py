@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+
+'''
+# Copyright (C) 2017 Collaboration of KPN and Splendid Data
+#
+# This file is part of puppet_pure_postgres.
+#
+# puppet_pure_barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# puppet_pure_postgres is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with puppet_pure_postgres.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+'''
+This script benchmarks the streaming pg_hba parser of pg_hba.py (tokenize_hba, fields_to_rule and PgHba.read).
+
+It generates a pg_hba file (by default with 1000000 lines) with a mix of comments, empty lines, local rules,
+ipv4 and ipv6 networks, networks with a netmask column, hostnames, lists, quoted names, options and continued lines.
+Then it prints the throughput (lines/s and MB/s) of tokenizing only, and of reading into a PgHba object
+(with and without mmap).
+
+Example usage:
+  bench_pg_hba_parse.py -n 1000000
+'''
+
+import os
+import sys
+import time
+import random
+import tempfile
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'files'))
+import pg_hba
+
+'''
+This function generates the lines for one random rule (or comment) in one of the notations that can be found in pg_hba files.
+Rules are unique by their line number, so that no rule replaces an earlier one.
+'''
+def random_lines(rnd, n):
+    kind = rnd.randint(0, 9)
+    db   = 'db{0}'.format(n)
+    if kind == 0:
+        return [ '# comment for rule {0}'.format(n) ]
+    elif kind == 1:
+        return [ '' ]
+    elif kind == 2:
+        return [ 'local\t{0}\tall\tpeer'.format(db) ]
+    elif kind == 3:
+        address = '.'.join(str(rnd.randint(0, 255)) for i in range(4))
+        return [ 'host\t{0}\tall\t{1}\t255.255.0.0\tmd5'.format(db, address) ]
+    elif kind == 4:
+        address = ':'.join('{0:x}'.format(rnd.randint(0, 65535)) for i in range(4))
+        return [ 'hostssl {0} all {1}::/64 cert clientcert=1'.format(db, address) ]
+    elif kind == 5:
+        return [ 'host {0}, other all app{1}.example.com md5 # app server'.format(db, n) ]
+    elif kind == 6:
+        return [ 'host "{0} x" "user ""{1}""" 10.{2}.0.0/16 md5'.format(db, n, rnd.randint(0, 255)) ]
+    elif kind == 7:
+        return [ 'host {0} all 10.0.0.0/8 ldap ldapserver=ldap.example.com \\'.format(db),
+                 '    ldapport=389' ]
+    address = '.'.join(str(rnd.randint(0, 255)) for i in range(4))
+    return [ 'host {0} all {1}/{2} md5'.format(db, address, rnd.randint(8, 32)) ]
+
+'''
+This function runs func and returns the result and the number of seconds it took.
+'''
+def timed(func):
+    start = time.time()
+    result = func()
+    return result, time.time() - start
+
+'''
+This function tokenizes a file without converting lines into rules, and returns the number of lines with fields.
+'''
+def tokenize_only(path):
+    with open(path, 'rb') as f:
+        return sum(1 for lineno, fields, comment in pg_hba.tokenize_hba(f, path) if fields)
+
+'''
+This function reads a file into a PgHba object and returns the number of rules.
+'''
+def read_hba(path, use_mmap):
+    hba = pg_hba.PgHba(path, use_mmap=use_mmap)
+    hba.read()
+    return len(hba.rules)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the pg_hba parser')
+    parser.add_argument('-n', '--count', help='Number of lines in generated file', type=int, default=1000000)
+    parser.add_argument('--seed',        help='Seed for random generator', type=int, default=1)
+    options = parser.parse_args()
+
+    rnd = random.Random(options.seed)
+    fd, path = tempfile.mkstemp(prefix='pg_hba_bench_')
+    try:
+        lines = 0
+        with os.fdopen(fd, 'w') as f:
+            while lines < options.count:
+                for line in random_lines(rnd, lines):
+                    f.write(line + '\n')
+                    lines += 1
+        size = os.path.getsize(path)
+
+        print('{0:<10} {1:>10} {2:>10} {3:>14} {4:>10}'.format('parser', 'rules', 'seconds', 'lines/s', 'MB/s'))
+        for name, func in (('tokenize', lambda: tokenize_only(path)),
+                           ('read', lambda: read_hba(path, False)),
+                           ('read_mmap', lambda: read_hba(path, True))):
+            rules, seconds = timed(func)
+            seconds = max(seconds, 1e-9)
+            print('{0:<10} {1:>10} {2:>10.3f} {3:>14.0f} {4:>10.1f}'.format(name, rules, seconds, lines / seconds,
+                                                                           size / seconds / 1e6))
+    finally:
+        os.remove(path)
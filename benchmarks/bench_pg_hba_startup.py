@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+
+'''
+# Copyright (C) 2017 Collaboration of KPN and Splendid Data
+#
+# This file is part of puppet_pure_postgres.
+#
+# puppet_pure_barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# puppet_pure_postgres is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with puppet_pure_postgres.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+'''
+This script benchmarks the startup of pg_hba.py, which is what most puppet runs pay for: every exec runs
+pg_hba.py --check (as unless) and most of the time nothing needs to change. For every interpreter (--python) it times:
+- interpreter: starting the interpreter without doing anything (python -c pass), the floor for all other timings
+- import: starting the interpreter and importing pg_hba.py (from its compiled bytecode)
+- script: a cold run of pg_hba.py --check for a rule that exists, in a file with --rules rules.
+  pg_hba.py is run as a script here, so it is compiled on every run (like modify_pg_hba.py was up to 1.1.x)
+- check: the same check with modify_pg_hba.py, which imports pg_hba.py and uses its compiled bytecode
+- check_cache: the same, with a cache file (--cache) that was written by an earlier run, like the puppet module does
+Every timing is the median of --repeat runs, in milliseconds. Compiled bytecode is written (and used), also when
+PYTHONDONTWRITEBYTECODE is set.
+
+For interpreters that support it (python 3.7 and newer), the modules that take most time to import are listed,
+as measured by python -X importtime.
+
+The script exits with 1 if the check_cache timing of any interpreter is more than --budget milliseconds.
+
+Example usage:
+  bench_pg_hba_startup.py --python python2,python3 --rules 1000 --budget 100
+'''
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from bench_pg_hba_suite import PG_HBA_PY, generate
+
+MODIFY_PG_HBA_PY = os.path.join(os.path.dirname(PG_HBA_PY), 'modify_pg_hba.py')
+
+#Environment for all runs, in which python writes compiled bytecode
+ENV = dict( (key, value) for key, value in os.environ.items() if key != 'PYTHONDONTWRITEBYTECODE' )
+
+'''
+This function runs a command, and returns the number of milliseconds it took.
+'''
+def run_ms(cmd):
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        rc = subprocess.call(cmd, stdout=devnull, stderr=devnull, env=ENV)
+    if rc != 0:
+        raise Exception('{0} exited with {1}'.format(' '.join(cmd), rc))
+    return (time.time() - start) * 1000
+
+'''
+This function returns the median of running a command repeat times, in milliseconds.
+'''
+def median_ms(cmd, repeat):
+    timings = sorted( run_ms(cmd) for i in range(repeat) )
+    return timings[len(timings) // 2]
+
+'''
+This function returns the modules that took most time to import (self time in milliseconds), as measured
+by python -X importtime. It returns None if the interpreter does not support -X importtime.
+'''
+def import_times(python, top):
+    cmd  = [ python, '-X', 'importtime', '-c', 'import pg_hba' ]
+    proc = subprocess.Popen(cmd, cwd=os.path.dirname(PG_HBA_PY), stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=ENV)
+    out, err = proc.communicate()
+    modules = []
+    for line in err.decode('utf-8', 'replace').splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules.append((int(self_us) / 1000.0, int(cumulative_us) / 1000.0, name.strip()))
+    if proc.returncode != 0 or not modules:
+        return None
+    return sorted(modules, reverse=True)[:top]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the startup of pg_hba.py')
+    parser.add_argument('--python', help='Comma separated list of interpreters', default=sys.executable)
+    parser.add_argument('--rules',  help='Number of rules in the pg_hba file',   type=int, default=1000)
+    parser.add_argument('--repeat', help='Number of runs per timing',            type=int, default=11)
+    parser.add_argument('--budget', help='Maximum milliseconds for check_cache', type=float, default=100.0)
+    parser.add_argument('--top',    help='Number of slowest imports to list',    type=int, default=10)
+    parser.add_argument('--seed',   help='Seed for random generator',            type=int, default=1)
+    options = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix='bench_pg_hba_startup')
+    over_budget = []
+    try:
+        pg_hba_file = generate(options.rules, options.seed, folder)
+        cache_file  = pg_hba_file + '.cache'
+        #A rule that is in the file, so that the check finds nothing to change
+        with open(pg_hba_file) as f:
+            rule = [ line.split() for line in f if line.startswith('host\t') ][0]
+        check = [ '-f', pg_hba_file, '-t', rule[0], '-d', rule[1], '-u', rule[2], '-s', rule[3] ]
+        if len(rule) > 5:
+            check += [ '-n', rule[4] ]
+        check += [ '-m', rule[-1], '--check' ]
+
+        print('{0:<24} {1:>12} {2:>10} {3:>10} {4:>10} {5:>12}'.format('python', 'interpreter', 'import', 'script',
+                                                                        'check', 'check_cache'))
+        for python in options.python.split(','):
+            python = python.strip()
+            #Write the cache and the compiled bytecode, so that the timings measure runs that can use them
+            run_ms([ python, MODIFY_PG_HBA_PY ] + check + [ '--cache', cache_file ])
+            timings = [ median_ms([ python, '-c', 'pass' ], options.repeat),
+                        median_ms([ python, '-c', 'import sys; sys.path.insert(0, sys.argv[1]); import pg_hba',
+                                    os.path.dirname(PG_HBA_PY) ], options.repeat),
+                        median_ms([ python, PG_HBA_PY ] + check, options.repeat),
+                        median_ms([ python, MODIFY_PG_HBA_PY ] + check, options.repeat),
+                        median_ms([ python, MODIFY_PG_HBA_PY ] + check + [ '--cache', cache_file ], options.repeat) ]
+            print('{0:<24} {1:>12.1f} {2:>10.1f} {3:>10.1f} {4:>10.1f} {5:>12.1f}'.format(python, *timings))
+            if timings[-1] > options.budget:
+                over_budget.append((python, timings[-1]))
+            os.remove(cache_file)
+
+        for python in options.python.split(','):
+            modules = import_times(python.strip(), options.top)
+            if not modules:
+                continue
+            print('')
+            print('slowest imports of pg_hba with {0} (ms):'.format(python.strip()))
+            print('{0:>10} {1:>12}  {2}'.format('self', 'cumulative', 'module'))
+            for self_ms, cumulative_ms, name in modules:
+                print('{0:>10.1f} {1:>12.1f}  {2}'.format(self_ms, cumulative_ms, name))
+    finally:
+        shutil.rmtree(folder)
+
+    print('')
+    if over_budget:
+        for python, ms in over_budget:
+            print('check_cache with {0} takes {1:.1f} ms, more than the budget of {2:.1f} ms'.format(python, ms,
+                                                                                                    options.budget))
+        sys.exit(1)
+    print('check_cache is within the budget of {0:.1f} ms'.format(options.budget))
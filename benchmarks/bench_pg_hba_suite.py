@@ -0,0 +1,223 @@
+#!/usr/bin/python3
+
+'''
+# Copyright (C) 2017 Collaboration of KPN and Splendid Data
+#
+# This file is part of puppet_pure_postgres.
+#
+# puppet_pure_barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# puppet_pure_postgres is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with puppet_pure_postgres.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+'''
+This script is a benchmark suite for pg_hba.py. For every size (number of rules, by default 100 to 100000, up to 1000000
+with --sizes) it generates a pg_hba file with a mix of ipv4 and ipv6 networks (with prefix and with a netmask column),
+hostnames, samehost / samenet, local rules and lists of databases and users. Then it times:
+- read: reading and parsing the file into a PgHba object
+- rule2key, rule2weight: calculating key and weight of all rules
+- render: rendering all rules in order (the first render creates the sorted index)
+- add_remove: adding and removing 1000 rules on the read object
+- new_rules: expanding 1000 rule specifications with lists of databases and users into rules
+- cli_check, cli_apply: full runs of pg_hba.py (including interpreter startup) checking and applying a rule
+
+Results are written as json (to stdout or --output). With --baseline (json written by an earlier run) every result
+is compared to the baseline, and the script exits with 1 if any timing is more than --threshold times slower
+(or as set for one timing with --op-threshold, like --op-threshold read=1.1) and at least --min-seconds slower.
+Every timing is the best of --repeat runs.
+
+Example usage:
+  bench_pg_hba_suite.py --sizes 100,1000,10000,100000,1000000 --output new.json --baseline old.json --threshold 1.25
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+PG_HBA_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'files', 'pg_hba.py')
+sys.path.insert(0, os.path.dirname(PG_HBA_PY))
+import pg_hba
+
+#Number of rules for the add_remove and new_rules timings
+OPS = 1000
+
+'''
+This function generates the line of a random rule in one of the notations that can be found in pg_hba files.
+Rules are unique by their number, so that no rule replaces an earlier one.
+'''
+def random_rule(rnd, n):
+    kind = rnd.randint(0, 9)
+    db   = 'db{0}'.format(n)
+    if kind == 0:
+        return 'local\t{0}\tall\tpeer'.format(db)
+    elif kind <= 3:
+        address = '.'.join(str(rnd.randint(0, 255)) for i in range(3)) + '.0'
+        return 'host\t{0}\tall\t{1}/{2}\tmd5'.format(db, address, rnd.randint(8, 32))
+    elif kind == 4:
+        address = '.'.join(str(rnd.randint(0, 255)) for i in range(2)) + '.0.0'
+        return 'host\t{0}\tall\t{1}\t255.255.0.0\tmd5'.format(db, address)
+    elif kind == 5:
+        address = ':'.join('{0:x}'.format(rnd.randint(0, 65535)) for i in range(4))
+        return 'hostssl\t{0}\tall\t{1}::/64\tcert'.format(db, address)
+    elif kind == 6:
+        return 'host\t{0}\tall\tapp{1}.example.com\tmd5'.format(db, n)
+    elif kind == 7:
+        return 'host\t{0}\tall\t{1}\ttrust'.format(db, rnd.choice(['samehost', 'samenet']))
+    #Comma heavy lists of databases and users
+    dbs  = ','.join('{0}_{1}'.format(db, i) for i in range(rnd.randint(2, 8)))
+    usrs = ','.join('usr{0}_{1}'.format(n, i) for i in range(rnd.randint(2, 8)))
+    return 'host\t{0}\t{1}\t10.{2}.0.0/16\tmd5'.format(dbs, usrs, rnd.randint(0, 255))
+
+'''
+This function returns a random rule specification (as for new_rules) with lists of databases and users.
+'''
+def random_spec(rnd, n):
+    return { 'contype': 'host', 'databases': ','.join('new{0}_{1}'.format(n, i) for i in range(3)),
+             'users': ','.join('usr{0}_{1}'.format(n, i) for i in range(3)),
+             'source': '172.{0}.{1}.0/24'.format(rnd.randint(16, 31), rnd.randint(0, 255)),
+             'netmask': '', 'method': 'md5', 'options': '' }
+
+'''
+This function runs func and returns the number of seconds it took.
+'''
+def timed(func):
+    start = time.time()
+    func()
+    return time.time() - start
+
+'''
+This function runs pg_hba.py with arguments (like the puppet module does) and returns the number of seconds it took.
+'''
+def cli(*args):
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call([ sys.executable, PG_HBA_PY ] + list(args), stdout=devnull)
+    return time.time() - start
+
+'''
+This function generates a pg_hba file with size rules, and returns its path.
+'''
+def generate(size, seed, folder):
+    rnd  = random.Random(seed)
+    path = os.path.join(folder, 'pg_hba_{0}.conf'.format(size))
+    with open(path, 'w') as f:
+        f.write('# generated by bench_pg_hba_suite.py\n')
+        for n in range(size):
+            f.write(random_rule(rnd, n) + '\n')
+    return path
+
+'''
+This function runs all timings once for a pg_hba file, and returns a dict with the seconds per timing.
+The cli_apply run changes the file, so it is copied first.
+'''
+def bench_file(source, seed, folder):
+    rnd  = random.Random(seed)
+    path = os.path.join(folder, 'pg_hba.conf')
+    shutil.copy(source, path)
+    results = {}
+    hba = [ None ]
+    def read():
+        hba[0] = pg_hba.PgHba(path)
+    results['read'] = timed(read)
+    hba = hba[0]
+    rules = list(hba.rules.values())
+    results['rule2key'] = timed(lambda: [ hba.rule2key(rule) for rule in rules ])
+    results['rule2weight'] = timed(lambda: [ hba.rule2weight(rule) for rule in rules ])
+    results['render'] = timed(lambda: list(hba.render()))
+
+    specs = [ random_spec(rnd, n) for n in range(OPS) ]
+    new_rules = []
+    results['new_rules'] = timed(lambda: new_rules.extend( r for spec in specs for r in hba.new_rules(**spec) ))
+    def add_remove():
+        for rule in new_rules[:OPS]:
+            hba.add_rule(rule)
+        for rule in new_rules[:OPS]:
+            hba.remove_rule(rule)
+    results['add_remove'] = timed(add_remove)
+
+    spec = random_spec(rnd, OPS)
+    args = [ '-f', path, '-d', spec['databases'], '-u', spec['users'], '-s', spec['source'] ]
+    results['cli_check'] = cli(*(args + [ '--check' ]))
+    results['cli_apply'] = cli(*args)
+    return results
+
+'''
+This function compares results with a baseline, and returns a list of regressions as text.
+'''
+def regressions(results, baseline, threshold, op_thresholds, min_seconds):
+    ret = []
+    for size, timings in sorted(results.items()):
+        for op, seconds in sorted(timings.items()):
+            base = baseline.get(size, {}).get(op)
+            if not base:
+                continue
+            limit = op_thresholds.get(op, threshold)
+            if seconds > base * limit and seconds - base > min_seconds:
+                ret.append('{0} rules, {1}: {2:.3f}s is {3:.2f}x baseline {4:.3f}s (threshold {5}x)'.format(
+                           size, op, seconds, seconds / base, base, limit))
+    return ret
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark suite for pg_hba.py')
+    parser.add_argument('--sizes',        help='Comma separated numbers of rules', default='100,1000,10000,100000')
+    parser.add_argument('--seed',         help='Seed for random generator', type=int, default=1)
+    parser.add_argument('--output',       help='Write json results to this file (default: stdout)', default='')
+    parser.add_argument('--baseline',     help='Json results of an earlier run to compare with', default='')
+    parser.add_argument('--threshold',    help='Maximum ratio against baseline for every timing', type=float, default=1.25)
+    parser.add_argument('--min-seconds',  help='Differences below this many seconds are no regression', type=float, default=0.01)
+    parser.add_argument('--repeat',       help='Run all timings this many times and keep the best', type=int, default=3)
+    parser.add_argument('--op-threshold', help='Maximum ratio for one timing, like read=1.1', action='append', default=[])
+    options = parser.parse_args()
+
+    op_thresholds = {}
+    for op_threshold in options.op_threshold:
+        op, ratio = op_threshold.split('=', 1)
+        op_thresholds[op] = float(ratio)
+
+    folder = tempfile.mkdtemp(prefix='pg_hba_bench_')
+    try:
+        results = {}
+        for size in [ int(size) for size in options.sizes.split(',') ]:
+            #Keep the best of all repeats, which is the least disturbed by other activity on the host
+            path = generate(size, options.seed, folder)
+            for i in range(options.repeat):
+                timings = bench_file(path, options.seed, folder)
+                best = results.setdefault(str(size), timings)
+                for op, seconds in timings.items():
+                    best[op] = min(best[op], seconds)
+            sys.stderr.write('{0} rules: {1}\n'.format(size, ', '.join( '{0} {1:.3f}s'.format(op, seconds)
+                                                            for op, seconds in sorted(results[str(size)].items()) )))
+    finally:
+        shutil.rmtree(folder)
+
+    output = { 'python': platform.python_version(), 'seed': options.seed, 'ops': OPS, 'results': results }
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(output, indent=2, sort_keys=True))
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)['results']
+        found = regressions(results, baseline, options.threshold, op_thresholds, options.min_seconds)
+        for regression in found:
+            sys.stderr.write('regression: {0}\n'.format(regression))
+        if found:
+            sys.exit(1)
@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+
+'''
+# Copyright (C) 2017 Collaboration of KPN and Splendid Data
+#
+# This file is part of puppet_pure_postgres.
+#
+# puppet_pure_barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# puppet_pure_postgres is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with puppet_pure_postgres.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+'''
+This script benchmarks pg_sql_batch.py for --grants grants (select on a table each, with the has_table_privilege
+guard of pure_postgres::sql::grant), against a running postgres (--pid-file). It times:
+- exec: every grant as its own exec, like pure_postgres::sql::grant (and every other run_sql based define) does:
+  pg_sql_batch.py --check as unless, and pg_sql_batch.py for the grant when it is needed. That is two processes
+  and two connections per grant when the grant is needed, and one when it isn't.
+- batch: all grants as one exec, like pure_postgres::sql::batch does: one pg_sql_batch.py --check and one
+  pg_sql_batch.py for the whole batch.
+Both are timed for a first run (all grants needed) and for a next run (nothing needed), in seconds.
+Every timing is the median of --repeat runs.
+
+The tables and the role are created in a database (--db) that is created for the benchmark, and dropped afterwards.
+The user (--user, default the current user) should be allowed to create databases and roles.
+
+Example usage:
+  bench_sql_batch.py --pid-file /var/pgpure/postgres/9.6/data/postmaster.pid --grants 300
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+PG_SQL_BATCH_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'files', 'pg_sql_batch.py')
+sys.path.insert(0, os.path.dirname(PG_SQL_BATCH_PY))
+from pg_protocol import PgConnection
+
+ROLE = 'bench_sql_batch_reader'
+
+'''
+This function runs a command, and returns the number of seconds it took. Exit code 1 is expected from --check.
+'''
+def run_s(cmd):
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        rc = subprocess.call(cmd, stdout=devnull, stderr=devnull)
+    if rc not in (0, 1):
+        raise Exception('{0} exited with {1}'.format(' '.join(cmd), rc))
+    return time.time() - start, rc
+
+'''
+This function returns the items of the grants, as pure_postgres::sql::grant would run them.
+'''
+def grant_items(grants, db):
+    return [ { 'name': 'grant {0}'.format(pos), 'db': db,
+               'sql': 'grant select on table bench_{0} to {1};'.format(pos, ROLE),
+               'unless': "select 'yes' where has_table_privilege('{0}', 'bench_{1}', 'select')".format(ROLE, pos) }
+             for pos in range(grants) ]
+
+'''
+This function runs every item as its own exec (unless, then the command when needed), and returns the seconds it took.
+'''
+def run_execs(python, connect_args, items):
+    total = 0
+    for item in items:
+        cmd = [ python, PG_SQL_BATCH_PY ] + connect_args + [ '--db', item['db'], '--sql', item['sql'] ]
+        seconds, rc = run_s(cmd + [ '--unless', item['unless'], '--check' ])
+        total += seconds
+        if rc != 0:
+            total += run_s(cmd + [ '--unless', item['unless'] ])[0]
+    return total
+
+'''
+This function runs all items as one exec (unless, then the command when needed), and returns the seconds it took.
+'''
+def run_batch(python, connect_args, batch_file):
+    cmd = [ python, PG_SQL_BATCH_PY ] + connect_args + [ '--batch', batch_file ]
+    seconds, rc = run_s(cmd + [ '--check' ])
+    if rc != 0:
+        seconds += run_s(cmd)[0]
+    return seconds
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark pg_sql_batch.py for many grants')
+    parser.add_argument('--db',       help='Database that is created for the benchmark',  default='bench_sql_batch')
+    parser.add_argument('--grants',   help='Number of grants',                            type=int, default=300)
+    parser.add_argument('--pid-file', help='postmaster.pid of postgres',                  required=True)
+    parser.add_argument('--python',   help='Interpreter for pg_sql_batch.py',             default=sys.executable)
+    parser.add_argument('--repeat',   help='Number of runs per timing',                   type=int, default=3)
+    parser.add_argument('--user',     help='User to connect as',                          default=None)
+    options = parser.parse_args()
+
+    connect_args = [ '--pid-file', options.pid_file ]
+    if options.user:
+        connect_args += [ '--user', options.user ]
+
+    def query(sql, db='postgres'):
+        conn = PgConnection.connect_pid_file(options.pid_file, user=options.user, database=db)
+        try:
+            return conn.query(sql)
+        finally:
+            conn.close()
+
+    query('DROP DATABASE IF EXISTS {0}'.format(options.db))
+    query('DROP ROLE IF EXISTS {0}'.format(ROLE))
+    query('CREATE DATABASE {0}'.format(options.db))
+    query('CREATE ROLE {0}'.format(ROLE))
+    query(';'.join( 'CREATE TABLE bench_{0} (id int)'.format(pos) for pos in range(options.grants) ), options.db)
+    revoke = ';'.join( 'REVOKE select ON bench_{0} FROM {1}'.format(pos, ROLE) for pos in range(options.grants) )
+
+    folder = tempfile.mkdtemp(prefix='bench_sql_batch')
+    try:
+        items = grant_items(options.grants, options.db)
+        batch_file = os.path.join(folder, 'grants.json')
+        with open(batch_file, 'w') as f:
+            json.dump(items, f)
+
+        timings = {}
+        for name, run in [ ('exec', lambda: run_execs(options.python, connect_args, items)),
+                           ('batch', lambda: run_batch(options.python, connect_args, batch_file)) ]:
+            first, rerun = [], []
+            for i in range(options.repeat):
+                query(revoke, options.db)
+                first.append(run())
+                rerun.append(run())
+            timings[name] = [ sorted(first)[len(first) // 2], sorted(rerun)[len(rerun) // 2] ]
+    finally:
+        shutil.rmtree(folder)
+        query('DROP DATABASE IF EXISTS {0}'.format(options.db))
+        query('DROP ROLE IF EXISTS {0}'.format(ROLE))
+
+    print('{0} grants with {1} (seconds)'.format(options.grants, options.python))
+    print('{0:<8} {1:>12} {2:>12}'.format('', 'first run', 'next run'))
+    for name in [ 'exec', 'batch' ]:
+        print('{0:<8} {1:>12.2f} {2:>12.2f}'.format(name, *timings[name]))
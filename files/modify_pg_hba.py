@@ -0,0 +1,36 @@
+#!/usr/bin/python3
+
+'''
+# Copyright (C) 2017 Collaboration of KPN and Splendid Data
+#
+# This file is part of puppet_pure_postgres.
+#
+# puppet_pure_barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# puppet_pure_postgres is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with puppet_pure_postgres.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+'''
+This script runs pg_hba.py (in the same folder) with the arguments it is given. See pg_hba.py for the options.
+pg_hba.py is imported as a module instead of being run as a script, because python only keeps the compiled bytecode
+of modules: a script is compiled again on every run, which for pg_hba.py takes longer than the check itself.
+
+Example usage:
+  modify_pg_hba.py -f /etc/pgpure/postgres/9.6/data/pg_hba.conf -d app -u app_user -s 10.0.0.0/8 --check
+'''
+
+import sys
+
+from pg_hba import main
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,497 @@
+#!/usr/bin/python3
+
+'''
+# Copyright (C) 2017 Collaboration of KPN and Splendid Data
+#
+# This file is part of puppet_pure_postgres.
+#
+# puppet_pure_barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# puppet_pure_postgres is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with puppet_pure_postgres.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+'''
+This script writes conf.d/autotune.conf: postgres settings that are derived from the hardware of this machine
+and the workload it is declared for.
+
+The hardware is read from /proc and /sys (PgHardware):
+- cpus (cpuinfo, limited by a cgroup cpu quota)
+- memory (meminfo, limited by a cgroup memory limit)
+- numa nodes and zone reclaim
+- huge pages (reserved huge pages and transparent huge pages)
+- storage: whether the disk of the data directory (or, when that can't be found, any disk) is rotational
+With --root, /proc and /sys are read below another folder (a fixture with the same layout), for tests.
+
+The workload is a profile (--profile) and the maximum number of connections (--max-connections):
+- oltp: many short transactions; small sorts, little parallelism, frequent checkpoints spread out
+- olap: few large queries; large sorts and maintenance, parallel queries, more statistics
+- mixed: in between
+From these, settings for memory, parallelism, wal, checkpoints and planner costs are calculated for the version
+of postgres (--pg-version), see PgAutotune. Every setting is written with an explanation of how it was calculated.
+
+Like modify_pg_hba.py, --check only checks if the file would change (exit code 1 if it would), and the file is only
+written when its contents change, so that postgres is only restarted when a setting changes.
+
+Example usage:
+  pg_autotune.py --profile oltp --max-connections 200 --pg-version 9.6 --data-dir /var/pgpure/postgres/9.6/data \
+                 --output /etc/pgpure/postgres/9.6/data/conf.d/autotune.conf
+'''
+
+import os
+import re
+import sys
+import glob
+
+KB = 1
+MB = 1024 * KB
+GB = 1024 * MB
+
+#Workload profiles, and the values that differ between them
+PgAutotuneProfiles = {
+    'oltp':  { 'maintenance_divisor': 16, 'work_mem_divisor': 1, 'gather_max': 2, 'min_wal_size': 2 * GB,
+               'max_wal_size': 8 * GB,  'checkpoint_timeout': '15min', 'statistics': 100 },
+    'olap':  { 'maintenance_divisor': 8,  'work_mem_divisor': 2, 'gather_max': None, 'min_wal_size': 4 * GB,
+               'max_wal_size': 16 * GB, 'checkpoint_timeout': '30min', 'statistics': 500 },
+    'mixed': { 'maintenance_divisor': 16, 'work_mem_divisor': 2, 'gather_max': 4, 'min_wal_size': 1 * GB,
+               'max_wal_size': 4 * GB,  'checkpoint_timeout': '15min', 'statistics': 100 },
+}
+
+#Disks that are not real storage
+PgAutotuneVirtualDisks = re.compile(r'^(loop|ram|zram|sr|fd|nbd)\d*')
+
+'''
+This exception is raised when the hardware can't be read, or for invalid arguments.
+'''
+class PgAutotuneError(Exception):
+    pass
+
+'''
+This function returns a size in kB as postgres would accept it, in the largest unit that fits exactly (like 4GB).
+'''
+def format_size(kb):
+    for unit, size in [ ('GB', GB), ('MB', MB) ]:
+        if kb >= size and kb % size == 0:
+            return '{0}{1}'.format(kb // size, unit)
+    return '{0}kB'.format(kb)
+
+'''
+This function returns a size in kB for people to read (like 15.6GB).
+'''
+def describe_size(kb):
+    if kb >= GB:
+        return '{0:.1f}GB'.format(kb / float(GB))
+    return '{0}MB'.format(kb // MB)
+
+'''
+This function rounds a size in kB down to whole megabytes (when it is more than 64MB), so that settings
+don't change with every few kB of memory that the kernel reserves.
+'''
+def round_size(kb):
+    if kb >= 64 * MB:
+        return kb - kb % MB
+    return max(kb, 64)
+
+'''
+This function converts a version of postgres (like '9.6' or '10') into a tuple that can be compared (like (9, 6)).
+'''
+def parse_version(version):
+    try:
+        return tuple( int(part) for part in str(version).split('.')[:2] )
+    except ValueError:
+        raise PgAutotuneError("'{0}' is not a valid postgres version".format(version))
+
+'''
+This class reads the hardware of the machine from /proc and /sys (or from a fixture folder with the same layout).
+'''
+class PgHardware(object):
+    def __init__(self, root='/', data_dir=None):
+        self.root          = root
+        self.data_dir      = data_dir
+        self.cpus          = self.read_cpus()
+        self.memory        = self.read_memory()
+        self.numa_nodes    = self.read_numa_nodes()
+        self.zone_reclaim  = self.read_int('proc/sys/vm/zone_reclaim_mode', 0)
+        meminfo            = self.read_meminfo()
+        self.huge_page     = meminfo.get('Hugepagesize', 0)
+        self.huge_pages    = meminfo.get('HugePages_Total', 0)
+        self.thp           = self.read_selected('sys/kernel/mm/transparent_hugepage/enabled')
+        self.rotational    = self.read_rotational()
+
+    def path(self, path):
+        '''
+        This function returns the path of a file of /proc or /sys below root.
+        '''
+        return os.path.join(self.root, path)
+
+    def read(self, path, default=None):
+        '''
+        This function returns the stripped contents of a file below root, or default when it can't be read.
+        '''
+        try:
+            with open(self.path(path)) as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return default
+
+    def read_int(self, path, default=None):
+        '''
+        This function returns the contents of a file below root as an int, or default.
+        '''
+        try:
+            return int(self.read(path, ''))
+        except ValueError:
+            return default
+
+    def read_selected(self, path):
+        '''
+        This function returns the selected option of a sysfs file like 'always [madvise] never', or None.
+        '''
+        match = re.search(r'\[(\w+)\]', self.read(path, ''))
+        return match.group(1) if match else None
+
+    def read_meminfo(self):
+        '''
+        This function returns /proc/meminfo as a dict of name => value (in kB, or a number for counts).
+        '''
+        meminfo = {}
+        for line in self.read('proc/meminfo', '').splitlines():
+            fields = line.replace(':', ' ').split()
+            if len(fields) >= 2 and fields[1].isdigit():
+                meminfo[fields[0]] = int(fields[1])
+        return meminfo
+
+    def read_cpus(self):
+        '''
+        This function returns the number of cpus, limited by the cpu quota of the cgroup (v2 or v1) if there is one.
+        '''
+        cpuinfo = self.read('proc/cpuinfo', '')
+        cpus = len(re.findall(r'^processor\s*:', cpuinfo, re.M)) or 1
+        quota = self.read('sys/fs/cgroup/cpu.max', '').split()
+        if len(quota) == 2 and quota[0] != 'max':
+            cpus = min(cpus, max(1, int(quota[0]) // int(quota[1])))
+        else:
+            quota  = self.read_int('sys/fs/cgroup/cpu/cpu.cfs_quota_us', -1)
+            period = self.read_int('sys/fs/cgroup/cpu/cpu.cfs_period_us', 0)
+            if quota > 0 and period > 0:
+                cpus = min(cpus, max(1, quota // period))
+        return cpus
+
+    def read_memory(self):
+        '''
+        This function returns the memory in kB, limited by the memory limit of the cgroup (v2 or v1) if there is one.
+        '''
+        memory = self.read_meminfo().get('MemTotal')
+        if not memory:
+            raise PgAutotuneError("Cannot read the memory of this machine from '{0}'".format(self.path('proc/meminfo')))
+        for path in [ 'sys/fs/cgroup/memory.max', 'sys/fs/cgroup/memory/memory.limit_in_bytes' ]:
+            limit = self.read_int(path)
+            if limit:
+                memory = min(memory, limit // 1024)
+        return memory
+
+    def read_numa_nodes(self):
+        '''
+        This function returns the number of numa nodes.
+        '''
+        nodes = [ path for path in glob.glob(self.path('sys/devices/system/node/node*'))
+                  if os.path.basename(path)[4:].isdigit() ]
+        return len(nodes) or 1
+
+    def disk_rotational(self, sys_path):
+        '''
+        This function returns if a block device (as a folder in /sys) is rotational. A partition is a disk if its
+        parent is, and a device mapper device (like lvm) is rotational if any of the devices below it is.
+        It returns None when it can't tell.
+        '''
+        sys_path = os.path.realpath(sys_path)
+        if os.path.exists(os.path.join(sys_path, 'partition')):
+            sys_path = os.path.dirname(sys_path)
+        slaves = glob.glob(os.path.join(sys_path, 'slaves', '*'))
+        if slaves:
+            flags = [ self.disk_rotational(slave) for slave in slaves ]
+            return any(flags) if None not in flags else None
+        try:
+            with open(os.path.join(sys_path, 'queue', 'rotational')) as f:
+                return f.read().strip() == '1'
+        except (IOError, OSError):
+            return None
+
+    def read_rotational(self):
+        '''
+        This function returns if the storage of the data directory is rotational.
+        When the disk of the data directory can't be found (it doesn't exist yet, or root is a fixture),
+        storage is rotational when any disk is.
+        '''
+        if self.root == '/' and self.data_dir:
+            folder = self.data_dir
+            while not os.path.exists(folder) and folder != os.path.dirname(folder):
+                folder = os.path.dirname(folder)
+            dev = os.stat(folder).st_dev
+            rotational = self.disk_rotational(self.path('sys/dev/block/{0}:{1}'.format(os.major(dev), os.minor(dev))))
+            if rotational is not None:
+                return rotational
+        flags = [ self.disk_rotational(path) for path in sorted(glob.glob(self.path('sys/block/*')))
+                  if not PgAutotuneVirtualDisks.match(os.path.basename(path)) ]
+        return any( flag for flag in flags )
+
+    def describe(self):
+        '''
+        This function returns a description of the hardware, as lines for the header of the config file.
+        '''
+        huge_pages = 'none reserved'
+        if self.huge_pages:
+            huge_pages = '{0} of {1}'.format(self.huge_pages, format_size(self.huge_page))
+        return [ 'cpus: {0}, memory: {1}, numa nodes: {2}'.format(self.cpus, describe_size(self.memory), self.numa_nodes),
+                 'storage: {0}, huge pages: {1}, transparent huge pages: {2}'.format(
+                     'rotational' if self.rotational else 'ssd', huge_pages, self.thp or 'unknown') ]
+
+'''
+This class calculates settings for hardware (a PgHardware object), a workload profile, max_connections and a
+version of postgres. settings() returns them as a list of (name, value, explanation), where explanation is
+a list of lines. Settings that the version of postgres doesn't have are left out.
+'''
+class PgAutotune(object):
+    def __init__(self, hardware, profile='mixed', max_connections=100, pg_version='9.6'):
+        if profile not in PgAutotuneProfiles:
+            raise PgAutotuneError("'{0}' is not a valid profile (use one of {1})".format(profile,
+                                                                                          ', '.join(sorted(PgAutotuneProfiles))))
+        if max_connections < 1:
+            raise PgAutotuneError("max_connections should be at least 1, not {0}".format(max_connections))
+        self.hw              = hardware
+        self.profile         = profile
+        self.params          = PgAutotuneProfiles[profile]
+        self.max_connections = max_connections
+        self.version         = parse_version(pg_version)
+        self.settings_list   = []
+
+    def add(self, name, value, *explanation):
+        '''
+        This procedure adds a setting with its explanation.
+        '''
+        self.settings_list.append((name, value, list(explanation)))
+
+    def settings(self):
+        '''
+        This function calculates all settings, and returns them.
+        '''
+        self.settings_list = []
+        self.connections()
+        self.memory()
+        self.parallelism()
+        self.wal()
+        self.planner()
+        return self.settings_list
+
+    def connections(self):
+        '''
+        This procedure adds max_connections.
+        '''
+        self.add('max_connections', self.max_connections,
+                 'As declared for this server. All per connection memory below is calculated for this many connections.')
+
+    def memory(self):
+        '''
+        This procedure adds shared_buffers, huge_pages, effective_cache_size, maintenance_work_mem,
+        autovacuum_work_mem and work_mem.
+        '''
+        mem = self.hw.memory
+        self.shared_buffers = round_size(mem // 4)
+        explanation = [ '25% of memory ({0}). More mostly doubles what the os page cache holds.'.format(describe_size(mem)) ]
+        if self.hw.numa_nodes > 1:
+            explanation.append('This machine has {0} numa nodes: shared buffers are spread over all of them, '
+                               'so most backends also read memory of another node.'.format(self.hw.numa_nodes))
+            if self.hw.zone_reclaim:
+                explanation.append('vm.zone_reclaim_mode is {0}: set it to 0, or the os will drop page cache to keep '
+                                   'memory on one node.'.format(self.hw.zone_reclaim))
+        self.add('shared_buffers', format_size(self.shared_buffers), *explanation)
+
+        if self.version >= (9, 4):
+            needed = (self.shared_buffers // self.hw.huge_page) + 1 if self.hw.huge_page else 0
+            if self.hw.huge_pages >= needed > 0:
+                explanation = [ '{0} huge pages of {1} are reserved, enough for shared buffers ({2} needed).'.format(
+                    self.hw.huge_pages, format_size(self.hw.huge_page), needed) ]
+            elif self.hw.huge_pages:
+                explanation = [ 'Only {0} huge pages of {1} are reserved, shared buffers need {2}: postgres will run '
+                                'without huge pages.'.format(self.hw.huge_pages, format_size(self.hw.huge_page), needed) ]
+            else:
+                explanation = [ 'No huge pages are reserved (vm.nr_hugepages): postgres runs without them. '
+                                'Reserving {0} pages saves page table memory per connection.'.format(needed or 'enough') ]
+            if self.hw.thp == 'always':
+                explanation.append('Transparent huge pages are always on, which can stall backends: prefer madvise or never.')
+            self.add('huge_pages', 'try', *explanation)
+
+        self.add('effective_cache_size', format_size(round_size(mem * 3 // 4)),
+                 '75% of memory: shared buffers plus what the os is expected to cache. Only used by the planner.')
+
+        maintenance = round_size(min(mem // self.params['maintenance_divisor'], 2 * GB))
+        self.add('maintenance_work_mem', format_size(maintenance),
+                 '1/{0} of memory for the {1} profile, at most 2GB (vacuum, create index and foreign keys).'.format(
+                     self.params['maintenance_divisor'], self.profile))
+
+        if self.version >= (9, 4):
+            autovacuum = round_size(min(maintenance // 3, 1 * GB))
+            self.add('autovacuum_work_mem', format_size(autovacuum),
+                     'maintenance_work_mem divided over 3 autovacuum workers, at most 1GB (autovacuum uses no more).')
+
+        workers = max(1, self.gather_workers())
+        work_mem = (mem - self.shared_buffers) // (self.max_connections * 3) // workers // self.params['work_mem_divisor']
+        self.add('work_mem', format_size(round_size(work_mem)),
+                 '(memory - shared_buffers) / (max_connections * 3 sorts or hashes) / {0} parallel workers{1}, '
+                 'at least 64kB.'.format(workers, ' / {0} for the {1} profile'.format(self.params['work_mem_divisor'],
+                                                                                     self.profile)
+                                          if self.params['work_mem_divisor'] > 1 else ''))
+
+    def gather_workers(self):
+        '''
+        This function returns max_parallel_workers_per_gather: half of the cpus, limited per profile
+        (0 for postgres before 9.6, which has no parallel query).
+        '''
+        if self.version < (9, 6):
+            return 0
+        workers = max(1, self.hw.cpus // 2)
+        if self.params['gather_max']:
+            workers = min(workers, self.params['gather_max'])
+        return workers if self.hw.cpus > 1 else 0
+
+    def parallelism(self):
+        '''
+        This procedure adds max_worker_processes and the settings for parallel query.
+        '''
+        cpus = self.hw.cpus
+        if self.version >= (9, 4):
+            self.add('max_worker_processes', max(8, cpus),
+                     'One per cpu ({0}), and at least the default of 8 (for parallel query and extensions).'.format(cpus))
+        if self.version >= (9, 6):
+            limit = 'at most {0} for the {1} profile'.format(self.params['gather_max'], self.profile) \
+                    if self.params['gather_max'] else 'no limit for the olap profile'
+            if cpus > 1:
+                explanation = 'Half of the cpus ({0}), {1}.'.format(cpus, limit)
+            else:
+                explanation = 'No parallel workers with one cpu: they would only compete with the leader for it.'
+            self.add('max_parallel_workers_per_gather', self.gather_workers(), explanation)
+        if self.version >= (10, ):
+            self.add('max_parallel_workers', cpus, 'All cpus ({0}) can run parallel workers.'.format(cpus))
+        if self.version >= (11, ):
+            self.add('max_parallel_maintenance_workers', min(4, max(1, cpus // 2)),
+                     'Half of the cpus ({0}), at most 4 (create index).'.format(cpus))
+
+    def wal(self):
+        '''
+        This procedure adds the settings for wal and checkpoints.
+        '''
+        wal_buffers = min(16 * MB, max(64, self.shared_buffers // 32))
+        self.add('wal_buffers', format_size(wal_buffers),
+                 '3% of shared_buffers, at most 16MB (one wal segment).')
+        if self.version >= (9, 5):
+            self.add('min_wal_size', format_size(self.params['min_wal_size']),
+                     'Wal kept for reuse, for the {0} profile.'.format(self.profile))
+            self.add('max_wal_size', format_size(self.params['max_wal_size']),
+                     'Wal written before a checkpoint is forced, for the {0} profile. Larger means fewer checkpoints '
+                     'and full page writes, but a longer recovery after a crash.'.format(self.profile))
+        else:
+            segments = self.params['max_wal_size'] // (3 * 16 * MB)
+            self.add('checkpoint_segments', segments,
+                     'Segments of 16MB written before a checkpoint is forced, for the {0} profile.'.format(self.profile))
+        self.add('checkpoint_timeout', self.params['checkpoint_timeout'],
+                 'Time between checkpoints for the {0} profile.'.format(self.profile))
+        self.add('checkpoint_completion_target', 0.9,
+                 'Spread checkpoint writes over 90% of the time between checkpoints.')
+
+    def planner(self):
+        '''
+        This procedure adds planner costs and statistics, which depend on the storage and the profile.
+        '''
+        if self.hw.rotational:
+            self.add('random_page_cost', 4.0, 'Rotational storage: a random read costs 4 times a sequential read.')
+            self.add('effective_io_concurrency', 2, 'Rotational storage handles few concurrent reads.')
+        else:
+            self.add('random_page_cost', 1.1, 'Solid state storage: a random read costs about as much as a sequential read.')
+            self.add('effective_io_concurrency', 200, 'Solid state storage handles many concurrent reads.')
+        self.add('default_statistics_target', self.params['statistics'],
+                 'Statistics per column for the {0} profile (more gives better plans for complex queries, '
+                 'and slower analyze).'.format(self.profile))
+
+'''
+This function renders the config file for the settings of a PgAutotune object (tuner), and returns its contents.
+'''
+def render(tuner):
+    lines = [ '#This file is managed by puppet, and written by pg_autotune.py for this machine:' ]
+    lines += [ '#  ' + line for line in tuner.hw.describe() ]
+    lines += [ '#  profile: {0}, max_connections: {1}, postgres {2}'.format(tuner.profile, tuner.max_connections,
+                                                                          '.'.join( str(v) for v in tuner.version )),
+               '#Settings in files that are read later (like manual_override.conf in the same folder) override these.',
+               '#Changes to shared_buffers, huge_pages, max_connections, max_worker_processes and wal_buffers',
+               '#only take effect after a restart.' ]
+    for name, value, explanation in tuner.settings():
+        lines.append('')
+        lines += [ '#' + line for line in explanation ]
+        if isinstance(value, str) and not re.match(r'^\d+(\.\d+)?(kB|MB|GB)?$', value):
+            value = "'{0}'".format(value) if not re.match(r'^\d+(ms|s|min|h|d)$', value) else value
+        lines.append('{0} = {1}'.format(name, value))
+    return '\n'.join(lines) + '\n'
+
+'''
+This function writes contents to path (atomically, with a temporary file in the same folder), unless the file
+already has these contents. It returns True if the file was written.
+'''
+def write_file(path, contents):
+    try:
+        with open(path) as f:
+            if f.read() == contents:
+                return False
+    except (IOError, OSError):
+        pass
+    import tempfile
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path), dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(contents)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o640)
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+    return True
+
+def cli_parser():
+    import argparse
+    parser = argparse.ArgumentParser(description='Write postgres settings for the hardware of this machine')
+    parser.add_argument('--check',           help='Only check if the file would change',             action='store_true')
+    parser.add_argument('--data-dir',        help='Data directory (to find the disk it is on)',      default=None)
+    parser.add_argument('--max-connections', help='Maximum number of connections',                   type=int, default=100)
+    parser.add_argument('--output',          help='Config file to write (default: stdout)',          default='')
+    parser.add_argument('--pg-version',      help='Version of postgres',                             default='9.6')
+    parser.add_argument('--profile',         help='Workload: ' + ', '.join(sorted(PgAutotuneProfiles)), default='mixed')
+    parser.add_argument('--root',            help='Read /proc and /sys below this folder (fixture)', default='/')
+    return parser
+
+def main(argv):
+    options  = cli_parser().parse_args(argv)
+    hardware = PgHardware(options.root, options.data_dir)
+    contents = render(PgAutotune(hardware, options.profile, options.max_connections, options.pg_version))
+    if not options.output:
+        sys.stdout.write(contents)
+        return 0
+    if options.check:
+        try:
+            with open(options.output) as f:
+                return 0 if f.read() == contents else 1
+        except (IOError, OSError):
+            return 1
+    if write_file(options.output, contents):
+        print('{0} changed'.format(options.output))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 
 '''
 # Copyright (C) 2017 Collaboration of KPN and Splendid Data
@@ -74,14 +74,24 @@ In that case, the -o option will set which part has priority over the other.
 '''
 
 import os
-import pwd
-import grp
+import errno
+import fcntl
+import bisect
+import itertools
 import stat
 import re
-import tempfile
-import shutil
-import subprocess
 import sys
+import json
+import hashlib
+import time
+#Modules that are only needed for some actions (like tempfile, shutil, subprocess, pwd, grp, csv, signal and socket)
+#are imported where they are used, to keep the startup of a check fast.
+
+try:
+    intern = sys.intern
+except AttributeError:
+    #Python 2 has intern as a builtin
+    pass
 
 '''
 This exception is raised when the touch function fails.
@@ -93,6 +103,7 @@ class TouchError(Exception):
 This function creates an empty file with proper ownership and permissions if it doesn't already exist.
 '''
 def touch(path, owner, group, mode):
+    import pwd, grp
     try:
         #If it exists, then exit this function
         fstat = os.stat(path)
@@ -142,272 +153,191 @@ class IPError(Exception):
     pass
 
 '''
-This function converts a string containing an ip address like '192.168.0.101' to an integer like 3232235621.
-It is the inverse of int_to_ipv4().
-'''
-def ipv4_to_int(ip):
-    if type(ip) is int:
-        # If IP was already an integer, then just return it unchanged
-        return ip
-    elif type(ip) is str:
-        #Split by '.'
-        ip_ar = ip.split(".")
-        #check that there are 4 parts
-        if len(ip_ar) != 4:
-            raise IPError("Invalid IP: {0}. We need 4 numbers in an IP".format(ip))
-        #Start empty
-        ip=0
-        #Loop through parts and
-        for i in ip_ar:
-            try:
-                #convert to int
-                i=int(i)
-            except:
-                raise IPError("IP part {0} must be numeric".format(i))
-            #Check that it is within range
-            if i<0 or i>255:
-                raise IPError("IP part {0} must be from 0-255".format(i))
-            #Scale original part up 256 times and add the new part
-            ip=ip*256+i
-        #IP p1.p2.p3.p4 should now be 256**3 * p1 + 256**2 * p2 + 256 * p3 + p4.
-        #Return as result
-        return ip
+This function returns the first address (as integer) of the network of an ip address and a netmask.
+It returns 0 for anything that is not an ip address (like a hostname).
+'''
+def gateway(network, netmask):
+    net = parse_network(network, netmask)
+    if net:
+        return net.gateway
     else:
-        raise IPError("{0} has an invalid type for an IP.".format(ip.__repr__()))
+        return 0
 
 '''
-This function converts an integer converted ip address like 3232235621 back into a string like '192.168.0.101'.
-It is the inverse of ipv4_to_int().
+This class is a regular expression that is compiled when it is used for the first time.
+Compiling all expressions (like those for postgres logs, log_refused_re) takes a noticable part of the startup of this
+script, and most runs (like a check) never use them. It can be used like a compiled expression (log_ip_re.search(...)).
 '''
-def int_to_ipv4(i):
-    try:
-        # Check that it is (or can be convert to) a basic integer
-        i = int(i)
-    except:
-        raise IPError("{0} is not an integer.".format(i.__repr__()))
-    if i >= 2**32 or i < 0:
-        raise IPError('IP address number out of range.')
-    ip = []
-    for x in range(4):
-        #First see what the scale factor (what we should divide i by to get the part) of this part is.
-        #For part 0 (everything that should end up before the first dot) it would be 256**3
-        #For part 3 (everything that should end up after the last dot) it would be 1
-        scale = 256**(3-x)
+class LazyRegex(object):
+    def __init__(self, pattern, flags=0):
+        self.pattern  = pattern
+        self.flags    = flags
+        self.compiled = None
 
-        #Then divide i by scale and trim everything larger than 256 and everything smaller than 1
-        part=int(i/scale) % 256
-
-        #Convert part to string and add to list
-        ip.append(str(part))
-
-    #By now, we have a list of parts like ['192', '168', '0', '101' ].
-    #Join the list elements to one string, seperated by dot and you get the reult, like '192.168.0.101'.
-    return '.'.join(ip)
+    def __getattr__(self, name):
+        '''
+        This function compiles the expression (once) and returns its attribute name (like search or sub).
+        The attribute is kept on this object, so the next lookup doesn't come here.
+        '''
+        if self.compiled is None:
+            self.compiled = re.compile(self.pattern, self.flags)
+        attr = getattr(self.compiled, name)
+        setattr(self, name, attr)
+        return attr
 
 '''
-This function converts a string containing a network base like '/24' to a netmask like '256.256.256.0'.
+This class represents an ip network (or a single ip address) as integers:
+- family is 4 for ipv4 and 6 for ipv6
+- addr is the address as an integer, as it was written (not masked with the netmask)
+- prefix is the number of 1's in the netmask (e.a. 24 for 255.255.255.0)
+Objects are created by parse_network(), which parses every source only once.
+Keys, weights and gateways of rules are all derived from it.
 '''
-def prefix_to_ipv4netmask(base):
-    if type(base) is str:
-        #It could contain a /. If it does, remove it.
-        base=base.replace('/','')
-    try:
-        #convert to int
-        base=int(base)
-    except:
-        raise IPError("invalid numeric expression for ipv4 network base {}".format(base))
-
-    #Generate the amount of ones as required (/24 would generate 16 times a 1, like 111111111111111111111111)
-    #Basically, 2**24 would be a 1 and 24 zeros. If you substract 1, you end up with 24 1's.
-    ones = 2**base-1
-
-    #After the ones, there should be a number of zeroes making a total of 32 bits.
-    #So for 24 1's there should be 8 zero's and for 16 there should be 16. This is always (32-base) zero's.
-    #For every zero, one could multiply by two, so for 8 zero's one should multiply by 2**8.
-    #And for (32-base) zero's, one can multiply with 2**(32-base)
-    multiplier = 2 ** (32-base)
-    netmask = ones * multiplier
-
-    #convert t to a ipv4 string with int_to_ipv4 and return it
-    return int_to_ipv4(netmask)
-
-'''
-This function converts a string containing an ipv6 address like 'fe80::79ee:7b70:320f:8877' 
-into an integer like 338288524927261089662804992486200543351.
-It understands (and converts) an ipv4 part in a ipv6 address, aswell as '::'
-It is the inverse of int_to_ipv6() and the ipv6 alternate to ipv4_to_int().
-'''
-def ipv6_to_int(ip):
-    # We will create a normalized version too.
-    # Better copy to new varaiable and leave the passed in unchanged,
-    # so that it is easy to compare during debug
-    normalized = ip
-    if '.' in normalized:
-        # If it holds a '.', it probably holds an ipv4 part.
-        # Check using re.search
-        m = ipv4part_re.search(normalized)
-        #Convert ipv4 parts (dec) to ipv6 parts (hex)
-        ipv6part = ''.join('%02x'%int(i) for i in m.group(0).split('.'))
-        #It is now one hex of 8 digits, while it should be two of 4. Lets insert a ':' in the middle.
-        ipv6part = ipv6part[:4] + ':' + ipv6part[4:]
-        #And replace the ipv4 part in the ip by the just generated ipv6 counterpart
-        normalized = normalized.replace(m.group(0), ipv6part)
-    if '::' in ip:
-        if ':::' in ip:
-            raise IPError('::: is not valid in ipv6')
-        # It is possible that multiple parts of ':0000:' are together replaced by a single '::'.
-        # If so, we should rstore that to the ':0000:' parts
-        # First see how much are missing
-        missing = 8 - normalized.count(':')
-        # This creates a string with '0000' elements surrounded and seperated by ':', just as much as there where missing.
-        replacer = ':'+'0000:'*missing
-        # Replace the '::' by the replacer string
-        normalized = normalized.replace('::', replacer)
-        #If :: was at the beginning (or the end), the initial (or last) ':' should not be there...
-        normalized.strip(':')
-        #normalized = normalized.replace('::',':')
-    #Now split in multiple parts
-    parts = normalized.split(':')
-    if len(parts) < 8:
-        raise IPError('IPv6 seems to consist of too less parts')
-    elif len(parts) > 8:
-        raise IPError('IPv6 seems to consist of too much parts')
-    #Normalize: Every part should have 4 digits. If not, the join would produce the correct number.
-    for i in range(len(parts)):
-        if len(parts[i]) != 4:
-            part = '0000' + parts[i]
-            part = part[-4:]
-            parts[i] = part
-    #Since it is now normalized, we can glue all together and handle this as one huge hexadecimal number
-    hex_result = ''.join(parts)
-    #convert to int with base 16 and return the result
-    return int(hex_result,16)
-
-'''
-This function converts an integer converted ip address like 338288524927261089662804992486200543351 
-back into a string containing an ipv6 address like 'fe80::79ee:7b70:320f:8877'.
-It cleans up by leading zeros and replacing multiple instances of ':0:' by '::'.
-It is the inverse of ipv6_to_int() and the ipv6 counterpart of ipv6_to_int.
-'''
-def int_to_ipv6(i):
-    try:
-        i = int(i)
-    except:
-        raise IPError("{0} is not an integer.".format(i.__repr__()))
-    #convert to hex, but remove the 0x front
-    hex_i = hex(i).split('x')[-1]
-    #Add '0' to the front up until 32 characters total
-    hex_i = '0'*(32 - len(hex_i)) + hex_i
-    #split in parts of 4 characters
-    parts = [ hex_i[i:i+4] for i in range(0, 32, 4) ]
-    #Lets loop through the parts and clean those leading zero's
-    for n in range(len(parts)):
-        #Not looping though parts directly, but using n, so we now the index and can later replace more easilly.
-        #But get the part in seperate variable for easier access
-        part = parts[n]
-        #look for leading zero
-        while part[0] == '0' and part != '0':
-            #remove leading zero
-            part = part[1:]
-        #write back to parts list
-        parts[n] = part
-    #join seperated with ':'. It now looks like a valid ipv6, but some cleanup can be done.
-    ipv6 = ':'.join(parts)
-    #Find repetions of zero fields to replace by '::'
-    obsoletes = [ m.group(0) for m in ipv6_obs_re.finditer(ipv6) ]
-    if len(obsoletes) > 0:
-        # Find largest number of repetitions
-        obsoletes = sorted(obsoletes, key=len)
-        largest_obsolete = obsoletes[-1]
-        # Replace only the first occurrence of this repetition by '::'
-        ipv6 = ipv6.replace(largest_obsolete, '::', 1)
-    if ipv6.startswith('0::'):
-        # If it starts with '0::', the '0' should be left out too.
-        ipv6 = ipv6[1:]
-    if ipv6.endswith('::0'):
-        # If it ends with '::0', the '0' should be left out too.
-        ipv6 = ipv6[:-1]
-    #This is clean ipv6, Lets return.
-    return ipv6
-
-def prefix_to_ipv6netmask(base):
-    if type(base) is str:
-        #if it is a string, could be that a '/' is still in it. remove it if so.
-        base=base.replace('/','')
-    try:
-        #convert to integer
-        base=int(base)
-    except:
-        raise IPError("invalid numeric expression for ipv6 network base {}".format(base))
+class IPNetwork(object):
+    __slots__ = ('family', 'addr', 'prefix')
+
+    def __init__(self, family, addr, prefix):
+        self.family = family
+        self.addr   = addr
+        self.prefix = prefix
+
+    @property
+    def bits(self):
+        return 32 if self.family == 4 else 128
+
+    @property
+    def netmask(self):
+        #prefix 1's, followed by (bits - prefix) 0's
+        return ((1 << self.prefix) - 1) << (self.bits - self.prefix)
+
+    @property
+    def network(self):
+        return self.addr & self.netmask
+
+    @property
+    def gateway(self):
+        return self.network + 1
+
+    @property
+    def weight(self):
+        #Every 1 in the netmask makes the network more specific.
+        #To keep both families on the same scale, ipv4 /32 is considered equivalent to ipv6 /128.
+        if self.family == 4:
+            return self.prefix * 4
+        return self.prefix
+
+    def contains(self, other):
+        '''
+        This function returns True if the other network is part of this network.
+        '''
+        if self.family != other.family or self.prefix > other.prefix:
+            return False
+        #The first prefix bits should be the same
+        return (self.addr ^ other.addr) >> (self.bits - self.prefix) == 0
 
-    #Generate the amount of ones as required (/24 would generate 16 times a 1, like 111111111111111111111111)
-    #Basically, 2**24 would be a 1 and 24 zeros. If you substract 1, you end up with 24 1's.
-    ones = 2**base-1
+    def __str__(self):
+        '''
+        The normalized notation, like 192.168.0.1/24 or fe80::1/64.
+        '''
+        import socket, binascii
+        if self.family == 4:
+            a = self.addr
+            return '{0}.{1}.{2}.{3}/{4}'.format(a >> 24, (a >> 16) & 255, (a >> 8) & 255, a & 255, self.prefix)
+        packed = binascii.unhexlify('{0:032x}'.format(self.addr))
+        return '{0}/{1}'.format(socket.inet_ntop(socket.AF_INET6, packed), self.prefix)
 
-    #After the ones, there should be a number of zeroes making a total of 128 bits.
-    #So for 96 1's there should be 32 zero's and for 64 there should be 64. This is always (128-base) zero's.
-    #For every zero, one could multiply by two, so for 32 zero's one should multiply by 2**32.
-    #And for (128-base) zero's, one can multiply with 2**(128-base)
-    multiplier = 2 ** (128-base)
-    netmask = ones * multiplier
+    def __repr__(self):
+        return 'IPNetwork({0!r})'.format(str(self))
 
-    #convert t to a ipv6 string with int_to_ipv6 and return it
-    return int_to_ipv6(netmask)
+    def __eq__(self, other):
+        return (isinstance(other, IPNetwork) and
+                (self.family, self.addr, self.prefix) == (other.family, other.addr, other.prefix))
 
-def gateway(network, netmask):
-    if ipv4_re.search(network):
-        nw_int = ipv4_to_int(network)
-        nm_int = ipv4_to_int(netmask)
-        return (nw_int & nm_int) + 1
-    elif ipv6_re.search(network):
-        nw_int = ipv6_to_int(network)
-        nm_int = ipv6_to_int(netmask)
-        return (nw_int & nm_int) + 1
-    else:
-        return 0
+    def __ne__(self, other):
+        return not self == other
 
-'''
-The following generates a regular expression which can be used to find ipv4 addresses.
-There are easier approaches, but this is the most thorough one.
-See http://stackoverflow.com/questions/53497/regular-expression-that-matches-valid-ipv6-addresses for more info...
-'''
-#segment of ipv4, can be 0 to 255
-IPV4SEG   = '(25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])'
-#IPv4 address consists of 3x(segment+.)+segement
-IPV4ADDR  = '('+IPV4SEG+'\.){3,3}'+IPV4SEG
+    def __hash__(self):
+        return hash((self.family, self.addr, self.prefix))
 
 '''
-The following generates a regular expression which can be used to find ipv6 addresses.
-There are easier approaches, but this is the most thorough one.
-See http://stackoverflow.com/questions/53497/regular-expression-that-matches-valid-ipv6-addresses for more info...
+This function converts a string containing an ip address into a tuple (family, integer).
+- '192.168.0.101' would become (4, 3232235621). Leading zeros are allowed, so 192.168.0.01 is 192.168.0.1.
+- 'fe80::79ee:7b70:320f:8877' would become (6, 338288524927261089662804992486200543351).
+  '::', embedded ipv4 parts (like ::ffff:192.168.0.1) and zone indexes (like fe80::1%eth0) are understood.
+It returns None if the string is not an ip address (like a hostname or a keyword).
 '''
+def parse_address(address):
+    import socket, binascii
+    if ':' in address:
+        #A zone index is not part of the address
+        address = address.split('%', 1)[0]
+        try:
+            packed = socket.inet_pton(socket.AF_INET6, address)
+        except (socket.error, ValueError):
+            return None
+        return 6, int(binascii.hexlify(packed), 16)
+    parts = address.split('.')
+    if len(parts) != 4:
+        return None
+    i = 0
+    for part in parts:
+        if not part.isdigit() or len(part) > 3:
+            return None
+        part = int(part)
+        if part > 255:
+            return None
+        #Scale up 256 times and add the new part
+        i = (i << 8) | part
+    return 4, i
 
-#segment of ipv6, can be 0 to 4 times (0-9, a-z or A-Z)
-IPV6SEG   = '[0-9a-fA-F]{1,4}'
-
-#This a concattenation of all possible combinations that would describe a valid ipv6 address.
-#Comment after the line gives an example.
-IPV6ADDR  = '(('+IPV6SEG+':){7,7}'+IPV6SEG+'|'           # 1:2:3:4:5:6:7:8
-IPV6ADDR += '('+IPV6SEG+':){1,7}:|'                      # 1::
-IPV6ADDR += '('+IPV6SEG+':){1,6}:'+IPV6SEG+'|'           # 1::8               1:2:3:4:5:6::8   1:2:3:4:5:6::8
-IPV6ADDR += '('+IPV6SEG+':){1,5}(:'+IPV6SEG+'){1,2}|'    # 1::7:8             1:2:3:4:5::7:8   1:2:3:4:5::8
-IPV6ADDR += '('+IPV6SEG+':){1,4}(:'+IPV6SEG+'){1,3}|'    # 1::6:7:8           1:2:3:4::6:7:8   1:2:3:4::8
-IPV6ADDR += '('+IPV6SEG+':){1,3}(:'+IPV6SEG+'){1,4}|'    # 1::5:6:7:8         1:2:3::5:6:7:8   1:2:3::8
-IPV6ADDR += '('+IPV6SEG+':){1,2}(:'+IPV6SEG+'){1,5}|'    # 1::4:5:6:7:8       1:2::4:5:6:7:8   1:2::8
-IPV6ADDR += IPV6SEG+':((:'+IPV6SEG+'){1,6})|'            # 1::3:4:5:6:7:8     1::3:4:5:6:7:8   1::8
-IPV6ADDR += ':((:'+IPV6SEG+'){1,7}|:)|'                  # ::2:3:4:5:6:7:8    ::2:3:4:5:6:7:8  ::8       ::       
-IPV6ADDR += 'fe80:(:'+IPV6SEG+'){0,4}%[0-9a-zA-Z]{1,}|'  # fe80::7:8%eth0     fe80::7:8%1  (link-local IPv6 addresses with zone index)
-IPV6ADDR += '::(ffff(:0{1,4}){0,1}:){0,1}'+IPV4ADDR+'|'  # ::255.255.255.255  ::ffff:255.255.255.255  ::ffff:0:255.255.255.255 (IPv4-mapped IPv6 addresses and IPv4-translated addresses)
-IPV6ADDR += '('+IPV6SEG+':){1,4}:'+IPV4ADDR+')'          # 2001:db8:3:4::192.0.2.33  64:ff9b::192.0.2.33 (IPv4-Embedded IPv6 Address)
+#Every source is only parsed once. This holds the result by (source, netmask).
+_network_cache = {}
+#The cache is cleared when it holds this many results, so that a long running process (like the daemon) that sees
+#many sources doesn't grow without bounds. Clearing is cheap, and a pg_hba file rarely has this many sources.
+_network_cache_size = 1 << 16
 
-#regular expression to detect if a string is an ipv4 address
-ipv4_re     = re.compile('^\s*'+IPV4ADDR+'(/\d{1,2})?\s*$')
-#regular expression to find an ipv4 address in a string
-ipv4part_re = re.compile(IPV4ADDR)
-#regular expression to detect if a string is an ipv6 address
-ipv6_re     = re.compile('^\s*'+IPV6ADDR+'(/\d{1,3})?\s*$')
-#regular expression to find an ipv6 address in a string
-ipv6_obs_re = re.compile('(\s|:)(0{1,4}:)+')
+'''
+This function converts a source (and optionally a netmask) from a pg_hba rule into an IPNetwork.
+The source can be an ip address with a prefix (192.168.0.0/24), or without (192.168.0.0).
+Without prefix, the netmask is used (255.255.255.0), and without netmask it is a single ip (/32 or /128).
+It returns None if the source is not an ip address (like a hostname, 'all', 'samenet', etc.).
+Results are cached, so calling it again for the same source is cheap.
+'''
+def parse_network(source, netmask=None):
+    try:
+        return _network_cache[(source, netmask)]
+    except KeyError:
+        pass
+    if '/' in source:
+        address, prefix = source.split('/', 1)
+    else:
+        address, prefix = source, None
+    parsed = parse_address(address)
+    if not parsed:
+        net = None
+    else:
+        family, addr = parsed
+        bits = 32 if family == 4 else 128
+        if prefix is not None:
+            if not prefix.isdigit() or int(prefix) > bits:
+                raise IPError("invalid prefix /{0} for ipv{1} address {2}".format(prefix, family, address))
+            prefix = int(prefix)
+        elif netmask:
+            parsed = parse_address(netmask)
+            if not parsed or parsed[0] != family:
+                raise IPError("invalid netmask {0} for ipv{1} address {2}".format(netmask, family, address))
+            mask = parsed[1]
+            #The number of 1's in the netmask is the prefix. But only if all 1's are in front.
+            prefix = bin(mask).count('1')
+            if mask != ((1 << prefix) - 1) << (bits - prefix):
+                raise IPError("netmask {0} has 0's between the 1's".format(netmask))
+        else:
+            prefix = bits
+        net = IPNetwork(family, addr, prefix)
+    if len(_network_cache) >= _network_cache_size:
+        _network_cache.clear()
+    _network_cache[(source, netmask)] = net
+    return net
 
 '''
 These are some lists that act as enum for the valid values for pg_hba settings.
@@ -420,478 +350,3675 @@ PgHbaTypes = [ "local", "host", "hostssl", "hostnossl" ]
 PgHbaOrders = [ "sdu", "sud", "dsu", "dus", "usd", "uds"]
 # This is a list of headers that the elements of pg_hba have
 PgHbaHDR = [ 'type', 'db', 'usr', 'src', 'mask', 'method', 'options']
+# This is a list of states that a rule can be requested to be in
+PgHbaStates = [ "present", "absent" ]
+# These are the elements (and their defaults) of a rule specification, as used by the cli and by batch files
+PgHbaSpecDefaults = { 'contype': 'host', 'databases': 'all', 'users': 'all', 'source': 'samehost',
+                      'netmask': '', 'method': 'md5', 'options': '', 'state': 'present', 'users_file': '',
+                      'shard': '' }
+# These are the directives that include other files (postgres 16 and newer)
+PgHbaIncludes = [ "include", "include_if_exists", "include_dir" ]
+# Maximum depth of nested includes (like postgres)
+PgHbaMaxDepth = 10
+# Included files are parsed in parallel processes when there is more than one, and they are at least this many bytes
+PgHbaParallelBytes = 1 << 20
 
 #Always split by any of spaces, tabs and \n
-split_re = re.compile('\s+')
+split_re = re.compile(r'\s+')
+#Commas with optional whitespace around them. They glue items of a list (like db1, db2) into one field.
+comma_re = re.compile(r'\s*,\s*')
+#A token in a line with quotes: a quoted string ("" is a quote inside), a comma, a comment, anything else up to
+#a seperator, or an unterminated quote (which is an error). Together they match every character but whitespace.
+token_re = re.compile(r'"(?:[^"]|"")*"|,|#.*|[^\s,#"]+|"')
+#Methods as a set, for fast lookups while parsing
+PgHbaMethodSet = frozenset(PgHbaMethods)
 
 '''
-This exception is raised by the PgHba object when an issue arises
+This function generates the key of a rule from its columns. The key consists of source, db and usr.
 '''
-class PgHbaError(Exception):
-    pass
+def rule_key(contype, db, usr, src, mask):
+    #Set source to something udefull
+    if contype == 'local':
+        #For local conenctions, source can be local
+        source = 'local'
+    else:
+        net = parse_network(src, mask)
+        if net:
+            #Normalized, so that notation (prefix or netmask, leading zeros, '::', etc.) makes no difference.
+            source = str(net)
+        else:
+            #Don't understand, lets not be smart.
+            source = src
+    return (source, db, usr)
 
 '''
-This class is used to read and process a pg_hba file.
+This class represents one rule of a pg_hba file.
+It is a compact record (with __slots__) rather than a dict, since generated hba files can hold many rules.
+The strings of type, db, usr and method are interned, since they are mostly the same for many rules.
+Next to the columns, it holds:
+- key: the normalized key of the rule (see rule_key). It is calculated when the rule is created.
+- fingerprint: a hash of all columns, so that checking if two rules are the same mostly is one hash comparison.
+- weights: the weights of the rule, as calculated by PgHba.rule2weights (only calculated when required)
+- lineno: the line number in the file the rule was read from (None if it was not read from a file)
+- section: the number of include directives before the rule in its file. Rules are sorted within their section.
+- source: the included file the rule is in (None for the pg_hba file itself)
 '''
-class PgHba(object):
-    def __init__(self, pg_hba_file=None, order="sdu", backup=False):
+class PgHbaRule(object):
+    __slots__ = ('type', 'db', 'usr', 'src', 'mask', 'method', 'options', 'key', 'fingerprint', 'weights', 'lineno',
+                 'section', 'source')
+
+    def __init__(self, type, db, usr, src=None, mask=None, method=None, options=None, key=None):
+        self.type    = intern(type)
+        self.db      = intern(db)
+        self.usr     = intern(usr)
+        self.src     = src or None
+        self.mask    = mask or None
+        self.method  = intern(method)
+        self.options = options or None
+        self.key     = key or rule_key(type, db, usr, src, mask)
+        self.fingerprint = hash(self.columns())
+        self.weights = None
+        self.lineno  = None
+        self.section = 0
+        self.source  = None
+
+    @classmethod
+    def from_dict(cls, rule):
         '''
-        Initialize a pg_hba object.
-        - pg_hba_file should be the path of a pg_hba file.
-        - order should be a string of three characters 's', 'd', and 'u'. Every character exactly once.
-        - backup should be set to true to keep a backup of the original file, or to false not to keep a backup.
+        This function creates a rule from a dict with the items of PgHbaHDR.
         '''
+        return cls(*[ rule.get(k) for k in PgHbaHDR ])
 
-        #Check that order is one of "sdu", "sud", "dsu", "dus", "usd", "uds"
-        if order not in PgHbaOrders:
-            raise PgHbaError("invalid order setting {0} (should be one of '{1}').".format(order, "', '".join(PgHbaOrders)))
-        #Copy parameters to new object
-        self.pg_hba_file = pg_hba_file
-        self.rules      = None
-        self.comment    = None
-        self.changed    = True
-        self.order      = order
-        self.backup     = backup
+    def columns(self):
+        '''
+        This function returns the columns of this rule, in the order of PgHbaHDR (None for columns without a value).
+        '''
+        return (self.type, self.db, self.usr, self.src, self.mask, self.method, self.options)
 
-        #Read the rules of the hba file
-        self.read()
+    def as_dict(self):
+        '''
+        This function returns the columns of this rule as a dict, without the columns that have no value.
+        '''
+        return dict( (k, v) for k, v in zip(PgHbaHDR, self.columns()) if v )
 
-    def read(self):
+    @property
+    def line(self):
         '''
-        This procedure read the rules from the pg_hba file.
+        The line for this rule in a pg_hba file.
         '''
+        return '\t'.join( c for c in self.columns() if c )
 
-        #Reset self.rules and self.comment
-        self.rules = {}
-        self.comment = []
+    def __eq__(self, other):
+        #Different fingerprints, is different rules. Only when fingerprints are the same, columns are compared.
+        return (isinstance(other, PgHbaRule) and self.fingerprint == other.fingerprint and
+                self.columns() == other.columns())
 
-        if not self.pg_hba_file:
-           return
+    def __ne__(self, other):
+        return not self == other
 
-        try:
-            # open the pg_hbafile
-            f = open(self.pg_hba_file, 'r')
-            #Process al lines
-            for l in f:
-                #Strip spaces
-                l=l.strip()
-                #uncomment
-                if '#' in l:
-                    l, comment = l.split('#', 1)
-                    self.comment.append('#'+comment)
-                #Convert line to rule
-                rule = self.line_to_rule(l)
-                if rule:
-                    #Add rule to this object
-                    self.add_rule(rule)
-            # Finished reading all lines. Done with this file.
-            f.close()
-            # Since we have read contents, this object represents file without changes, so write should do anything.
-            self.changed = False
-        except IOError, e:
-            raise PgHbaError("pg_hba file '{0}' doesn't exist. Use create option to autocreate.".format(self.pg_hba_file))
+    def __hash__(self):
+        return self.fingerprint
 
-    def line_to_rule(self, line):
-        #First we check that the line actually has info (next to only seperator characters like space and tab).
-        #This is checked by replacing all seperator characters with ''. If there is anything left in result, there is data in there.
-        if split_re.sub('', line) == '':
-            #empty line. skip this one...
-            return None
-        #Now split with split_re in cols
-        cols = split_re.split(line)
-        #And check that the number of cols is as it is expected
-        if len(cols) < 4:
-            raise PgHbaError("File {0} has a rule with too few columns: {1}.".format(self.pg_hba_file, line))
-        if cols[0] not in PgHbaTypes:
-            raise PgHbaError("File {0} contains an rule of unknown type: {1}.".format(self.pg_hba_file, line))
-        if cols[0] == 'local':
-            if cols[3] not in PgHbaMethods:
-                raise PgHbaError("File {0} contains an rule of 'local' type where 4th column '{1}'isnt a valid auth-method.".format(self.pg_hba_file, cols[3]))
-            #For local type, the cols address and netmask are not set in hba file. Set them to none
-            cols.insert(3, None)
-            cols.insert(3, None)
-        else:
-            if len(cols) < 6:
-                #For host type, the cols address and netmask are not set in hba file. Set them to none
-                cols.insert(4, None)
-            elif cols[5] not in PgHbaMethods:
-                #Unknown method. Probably this is no method.
-                cols.insert(4, None)
-            if len(cols) < 7:
-                #options are not set (which is almost always). Set to none
-                cols.insert(7, None)
-            if cols[5] not in PgHbaMethods:
-                raise PgHbaError("File {0} contains an rule '{1}' that has no valid method.".format(self.pg_hba_file, line))
-        #Convert list to dict with named items
-        rule = dict(zip(PgHbaHDR, cols[:7]))
-        #Remove all columns that have no value from dictionary
-        self.cleanEmptyRuleKeys(rule)
-        #Set original line in the line value (for future reference)
-        rule['line'] = line
-        return rule
+    def __repr__(self):
+        return 'PgHbaRule({0!r})'.format(self.line)
 
-    def cleanEmptyRuleKeys(self, rule):
+#Position of the weights in the result of PgHba.rule2weights per character of the order setting
+PgHbaWeightPos = { 's': 0, 'd': 1, 'u': 2 }
+
+'''
+This function puts the weights of a rule (as returned by PgHba.rule2weights) in the order of an order setting.
+For 'usd' this would be (uweight, -srcweight, dbweight, db, usr, gateway).
+Rules are sorted by this weight tuple.
+'''
+def order_weight(weights, order):
+    return tuple( weights[PgHbaWeightPos[c]] for c in order ) + weights[3:]
+
+'''
+This class is an ordered structure that keeps its items sorted while items are added and removed.
+It is used to keep the rules of a PgHba object in the order they are rendered, so that they need no sorting.
+
+Items are kept in a list of sorted chunks, together with a list of the last (largest) item of every chunk.
+Adding or removing an item finds the chunk with a binary search (O(log n)) and changes only that chunk,
+which holds at most 2 * load items. Chunks that grow larger are split in two.
+'''
+class SortedIndex(object):
+    #Number of items per chunk
+    load = 256
+
+    def __init__(self, items=()):
+        #Sorting is only done when the index is created. For items that are already (almost) in order,
+        #like rules read from a file that was written by this script, this is a linear operation.
+        items = sorted(items)
+        self.chunks = [ items[i:i+self.load] for i in range(0, len(items), self.load) ]
+        self.maxes  = [ chunk[-1] for chunk in self.chunks ]
+
+    def __len__(self):
+        return sum( len(chunk) for chunk in self.chunks )
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            for item in chunk:
+                yield item
+
+    def add(self, item):
         '''
-        This function is a helper function that cleans out dictionary keys 
-        that have no value (value that evaluates to False, like '', False, -1, etc).
+        This function adds an item in its place.
         '''
-        for k in rule.keys():
-            if not rule[k]:
-                del rule[k]
-
-    def rule2key(self, rule):
+        if not self.chunks:
+            self.chunks.append([ item ])
+            self.maxes.append(item)
+            return
+        #Find the first chunk with a last item larger than this item
+        pos = bisect.bisect_left(self.maxes, item)
+        if pos == len(self.maxes):
+            #Larger than all items. Add to the end of the last chunk.
+            pos -= 1
+            self.chunks[pos].append(item)
+            self.maxes[pos] = item
+        else:
+            bisect.insort(self.chunks[pos], item)
+        chunk = self.chunks[pos]
+        if len(chunk) > 2 * self.load:
+            #Chunk has grown too large. Split in two.
+            self.chunks[pos:pos+1] = [ chunk[:self.load], chunk[self.load:] ]
+            self.maxes[pos:pos+1]  = [ chunk[self.load-1], chunk[-1] ]
+
+    def remove(self, item):
         '''
-        This function generates a key from a rule. The key consists of source, db and usr.
-        '''
-        #Set source to something udefull
-        if rule['type'] == 'local':
-            #For local conenctions, source can be local
-            source = 'local'
-        elif ipv4_re.search(rule['src']):
-            #Handle as ipv4 source
-            if '/' in rule['src']:
-                #Network inidicated as base. Convert to netmask notation.
-                nw, prefix = rule['src'].split('/')
-                netmask = prefix_to_ipv4netmask(prefix)
-                source = nw+'/'+netmask
-            elif 'mask' not in rule.keys():
-                #Network not inidicated. set to 255.255.255.255 (equivalent of /32 which is one ip).
-                source = rule['src']+'/255.255.255.255'
-            else:
-                #Network inidicated as ip with netmask. Glue ip and netmask togethers with slash.
-                source = rule['src']+'/'+rule['mask']
-        elif ipv6_re.search(rule['src']):
-            #Handle as ipv6 source
-            if '/' in rule['src']:
-                #Network inidicated as base. Convert to netmask notation.
-                nw, prefix = rule['src'].split('/')
-                netmask = prefix_to_ipv6netmask(prefix)
-                source = nw+'/'+netmask
-            elif 'mask' not in rule.keys():
-                #Network not inidicated. set to ffff:ffff:ffff:ffff:ffff:ffff (equivalent of /128, which is one ip).
-                source = rule['src']+'/ffff:ffff:ffff:ffff:ffff:ffff'
-            else:
-                #Network inidicated as ip with netmask. Glue ip and netmask togethers with slash.
-                source = rule['src']+'/'+rule['mask']
+        This function removes an item. It raises a ValueError if the item is not in the index.
+        '''
+        pos = bisect.bisect_left(self.maxes, item)
+        if pos == len(self.maxes):
+            raise ValueError('item not in index')
+        chunk = self.chunks[pos]
+        i = bisect.bisect_left(chunk, item)
+        if i == len(chunk) or chunk[i] != item:
+            raise ValueError('item not in index')
+        del chunk[i]
+        if chunk:
+            self.maxes[pos] = chunk[-1]
         else:
-            #Don't understand, lets not be smart.
-            source = rule['src']
-
-        return (source, rule['db'], rule['usr'])
+            del self.chunks[pos]
+            del self.maxes[pos]
 
-    def rule2weight(self, rule):
-        '''
-        This function can calculate the weight from a rule.
-        It is only used during the render function, which sorts and outputs the rules in correct order.
+'''
+This exception is raised by the PgHba object when an issue arises
+'''
+class PgHbaError(Exception):
+    pass
 
-        The weigth actually defines the grainness of the rule (how specific is this rule).
-        For networks, every 1 in 'netmask in binary' makes the subnet more specific.
-        Therefore network prefix has an important imact on the weight.
-        So a single IP (/32) should have twice the weight of a /16 network.
-        To keep everything in the same weight scale for IPv6,
-        - a scale of 0 - 128 from 0 bits to 32 bits is chosen for ipv4 and 
-        - a scale of 0 - 128 from 0 bits to 128 bits is chosen for ipv6.
-        In addition to weight, also the db, username and the gateway is added to sort on that too.
-        '''
-        if rule['type'] == 'local':
-            #local is always 'this server' and therefore considered /32
-            srcweight = 128 #(ipv4 /32 is considered equivalent to ipv6 /128)
-            gw = 0
-        elif ipv4_re.search(rule['src']):
-            if '/' in rule['src']:
-                #prefix tells how much 1's there are in netmask, so lets use that for sourceweight
-                ip, prefix = rule['src'].split('/', 1)
-                srcweight = int(prefix) * 4
-                gw = gateway(ip, prefix_to_ipv4netmask(prefix))
-            elif 'mask' in rule.keys():
-                #Netmask. But /24 = the number of 1's in the binary form of the netmask,
-                #So let's count the 1's in this netmask in binary form and use that for weight.
-                bits = "{0:b}".format(ipv4_to_int(rule['mask']))
-                srcweight = bits.count('1') * 4
-                gw = gateway(rule['src'], rule['mask'])
-            else:
-                #seems, there is no netmask / prefix to be found. Then only one IP applies.
-                #ipv4 /32 is considered equivalent to ipv6 /128.
-                srcweight = 128
-                gw = ip4_to_int(rule['src'])
-        elif ipv6_re.search(rule['src']):
-            if '/' in rule['src']:
-                #prefix tells how much 1's there are in netmask, so lets use that for sourceweight
-                ip, prefix = rule['src'].split('/', 1)
-                srcweight = int(prefix)
-                gw = gateway(ip, prefix_to_ipv6netmask(prefix))
-            elif 'mask' in rule.keys():
-                #Netmask. But /24 = the number of 1's in the binary form of the netmask,
-                #So let's count the 1's in this netmask in binary form and use that for weight.
-                bits = "{0:b}".format(ipv6_to_int(rule['mask']))
-                srcweight = bits.count('1') * 4
-                gw = gateway(rule['src'], rule['mask'])
-            else:
-                #seems, there is no netmask / prefix to be found. Then only one IP applies.
-                srcweight = 128 #(ipv4 /32 is considered equivalent to ipv6 /128)
-                gw = ip6_to_int(rule['src'])
+'''
+This function splits the text of a line with quotes into fields the way postgres does.
+It returns a tuple of (fields, comment). See tokenize_hba().
+'''
+def split_quoted(text, path, lineno):
+    fields  = []
+    comment = None
+    #Set after a comma, when the next token belongs to the same field
+    glue    = False
+    end     = -1
+    for m in token_re.finditer(text):
+        token = m.group(0)
+        if token[0] == '#':
+            comment = token.rstrip()
+            break
+        elif token == '"':
+            raise PgHbaError('{0}:{1}: unterminated quoted string'.format(path, lineno))
+        elif token == ',':
+            if not fields:
+                raise PgHbaError('{0}:{1}: line starts with a comma'.format(path, lineno))
+            fields[-1] += token
+            glue = True
+        elif glue or m.start() == end:
+            #Item after a comma, or a token directly attached to the previous one (like abc"def")
+            fields[-1] += token
+            glue = False
         else:
-            #You can also write all to match any IP address, samehost to match any of the server's own IP addresses, or samenet to match any address in any subnet that the server is directly connected to.
-            if rule['src'] == 'all':
-                #every ip is ok. Lets put this one on the very bottom of the file.
-                srcweight = 0
-                gw = 1
-            elif rule['src'] == 'samehost':
-                #All i's from this host is ok. Lets consider this is only one ip.
-                srcweight = 128 #(ipv4 /32 is considered equivalent to ipv6 /128)
-                gw = 0
-            elif rule['src'] == 'samenet':
-                #Might write some fancy code to determine all prefix's 
-                #from all interfaces and find a sane value for this one.
-                #For now, let's assume /24...
-                srcweight = 96 #(ipv4 /24 is considered equivalent to ipv6 /96)
-                gw = 0
-            elif rule['src'][0] == '.':
-                # suffix matching, let's asume a very large scale and therefore a very low weight.
-                srcweight = 64 #(ipv4 /16 is considered equivalent to ipv6 /64)
-                gw = -1
-            else:
-                #This seems to be a hostname. Let's asume only one host matches
-                srcweight = 128 #(ipv4 /32 is considered equivalent to ipv6 /128)
-                gw = -1
+            fields.append(token)
+        end = m.end()
+    return fields, comment
 
-        #dbweight is equal to the number of databases.
-        if rule['db'] == 'all':
-            #More than one, make it huge and sink to the bottom.
-            dbweight = 1000
+'''
+This function is a tokenizer for pg_hba files. It streams over lines (str or bytes) in a single pass
+and yields a tuple of (line number, fields, comment) for every line with a rule or a comment:
+- fields is a list of the fields of the rule (empty for lines with only a comment).
+  Lists are one field (like 'db1,db2', also when written as 'db1, db2').
+  Quoted tokens (like "my db") keep their quotes, so that they stay literals (a quoted "all" is no keyword).
+- comment is the comment (including the '#') or None.
+Lines ending with a backslash are continued on the next line, just like postgres does.
+The line number is the number of the first line of a continued line.
+'''
+def tokenize_hba(lines, path=''):
+    lineno = 0
+    text   = None
+    start  = 0
+    for line in lines:
+        lineno += 1
+        if not isinstance(line, str):
+            line = line.decode('utf-8')
+        line = line.rstrip('\r\n')
+        if text is None:
+            text, start = line, lineno
         else:
-            #Count comma's to find number of databases
-            dbweight = rule['db'].count(',') + 1
+            text += line
+        if text.endswith('\\'):
+            #Line continues on next line
+            text = text[:-1]
+            continue
+        if '"' in text:
+            fields, comment = split_quoted(text, path, start)
+        else:
+            #Fast path for lines without quotes (which are almost all lines)
+            text, sep, comment = text.partition('#')
+            comment = sep + comment.rstrip() if sep else None
+            if ',' in text:
+                text = comma_re.sub(',', text)
+            fields = text.split()
+        text = None
+        if fields or comment:
+            yield start, fields, comment
+    if text is not None:
+        raise PgHbaError('{0}:{1}: file ends with a backslash continuation'.format(path, start))
 
-        #uweight is equal to the number of users
+'''
+This function converts the fields of a line (as yielded by tokenize_hba) into a PgHbaRule.
+path and lineno are used in error messages, which point at the line in the file.
+'''
+def fields_to_rule(fields, path='', lineno=None):
+    #check that the number of fields is as it is expected
+    if len(fields) < 4:
+        raise PgHbaError("{0}:{1}: rule has too few columns: {2}".format(path, lineno, ' '.join(fields)))
+    contype = fields[0]
+    if contype not in PgHbaTypes:
+        raise PgHbaError("{0}:{1}: rule of unknown type: {2}".format(path, lineno, ' '.join(fields)))
+    if contype == 'local':
+        #For local type, the address and netmask are not set in hba file.
+        if fields[3] not in PgHbaMethodSet:
+            raise PgHbaError("{0}:{1}: rule of 'local' type where 4th column '{2}' isn't a valid auth-method".format(path, lineno, fields[3]))
+        src, mask, pos = None, None, 3
+    elif len(fields) < 5:
+        raise PgHbaError("{0}:{1}: rule has too few columns: {2}".format(path, lineno, ' '.join(fields)))
+    elif '/' in fields[3] or fields[4] in PgHbaMethodSet:
+        #Source with prefix, hostname or keyword. No netmask column.
+        src, mask, pos = fields[3], None, 4
+    else:
+        #ip address with a netmask column
+        src, mask, pos = fields[3], fields[4], 5
+    if len(fields) <= pos or fields[pos] not in PgHbaMethodSet:
+        raise PgHbaError("{0}:{1}: rule has no valid method: {2}".format(path, lineno, ' '.join(fields)))
+    #Everything after the method are options (like ldapserver=... ldapport=...)
+    options = ' '.join(fields[pos+1:])
+    try:
+        rule = PgHbaRule(contype, fields[1], fields[2], src, mask, fields[pos], options)
+    except IPError as e:
+        #Like a prefix that is too long, or a netmask that isn't contiguous
+        raise PgHbaError("{0}:{1}: rule has an invalid address: {2}: {3}".format(path, lineno, ' '.join(fields), e))
+    rule.lineno = lineno
+    return rule
 
-        if rule['usr'] == 'all':
-            #All users, so (probably) more than one. Sink to bottom.
-            uweight = 1000
-        else:
-            #More than one, sink to the bottom
-            uweight = rule['usr'].count(',') + 1
+'''
+This function converts a value (like text as returned by json) to the native str type.
+'''
+def native_str(value):
+    if isinstance(value, str):
+        return value
+    elif not isinstance(value, bytes) and hasattr(value, 'encode'):
+        #Python 2 unicode
+        return value.encode('utf-8')
+    return str(value)
 
-        #Now, put the weights in the correct order, according to self.order parameter
-        ret = []
-        for c in self.order:
-            if c == 'u':
-                ret.append(uweight)
-            elif c == 's':
-                ret.append(-srcweight)
-            elif c == 'd':
-                ret.append(dbweight)
-        #Add dbname, username and gateway for sort when all else is the same
-        ret += [ rule['db'], rule['usr'], gw ]
-
-        #Return the end weight tuple
-        return tuple( ret )
+'''
+This function returns the identity of a file as a dict with inode, size, mtime and a sha1 hash of the contents.
+fstat should be the result of os.stat() of the file, from right before it was read.
+If the file was changed while reading, None is returned, since then the identity is not reliable.
+'''
+def file_identity(path, fstat, sha1=None):
+    if not sha1:
+        #Hash was not calculated while reading the file. Read and hash now.
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                sha1.update(chunk)
+    #Check that file was not changed in the mean time
+    newstat = os.stat(path)
+    if (newstat.st_ino, newstat.st_size, newstat.st_mtime) != (fstat.st_ino, fstat.st_size, fstat.st_mtime):
+        return None
+    return { 'ino': fstat.st_ino, 'size': fstat.st_size, 'mtime': fstat.st_mtime, 'sha1': sha1.hexdigest() }
 
-    def write(self, reload=False):
+'''
+This function returns a cheap identity of a file (inode, size, mtime and ctime), or None if it doesn't exist.
+It is used to find out if a file was changed since it was read (see PgHbaModels).
+'''
+def stat_identity(path):
+    try:
+        fstat = os.stat(path)
+    except OSError:
+        return None
+    return (fstat.st_ino, fstat.st_size, fstat.st_mtime, fstat.st_ctime)
+
+'''
+This function returns the identity of a file as it is kept in a graph: [path, identity as a list]
+(or [path, None] for a file that doesn't exist).
+'''
+def graph_entry(path):
+    ident = stat_identity(path)
+    return [ path, list(ident) if ident else None ]
+
+'''
+This function returns True if all files in graph (a list of [path, identity], see PgHba.graph_identity)
+still have that identity.
+'''
+def graph_current(graph):
+    return all( graph_entry(path) == [ path, ident ] for path, ident in graph )
+
+'''
+This function returns a fingerprint of a list of rule specifications (as returned by read_batch).
+It is used to recognize a check that was done before.
+'''
+def specs_fingerprint(specs):
+    return hashlib.sha1(json.dumps(specs, sort_keys=True).encode('utf-8')).hexdigest()
+
+'''
+This function converts a rule (kept under key) into a row for json: a list of the key, the columns, the section
+and the line number of the rule. Rows are kept in the cache file, and pass rules of included files between processes.
+'''
+def rule_to_row(key, rule):
+    return list(key) + list(rule.columns()) + [ rule.section, rule.lineno ]
+
+'''
+This function converts a row (see rule_to_row) back into a tuple of (key, rule).
+'''
+def row_to_rule(row):
+    columns = [ native_str(v) if v is not None else None for v in row[:10] ]
+    key  = tuple(columns[:3])
+    rule = PgHbaRule(*columns[3:10], key=key)
+    rule.section, rule.lineno = row[10:12]
+    return key, rule
+
+'''
+This class is used to keep the parsed state of a pg_hba file in a cache file, so that it doesn't have to be parsed again.
+The cache is only valid for the exact pg_hba file it was created from (same inode, size, mtime and contents).
+Next to the parsed rules, it keeps the results of checks done against that file, by fingerprint of the rule specifications.
+
+The cache file consists of two lines:
+- a json header with version, identity of the pg_hba file, the comments, the include directives and the check results,
+  and whether the rules are expanded (see PgHba.expand_rule), which they are for a compacted file
+- a json list with all rules (see rule_to_row)
+The second line is only parsed when the rules are actually needed.
+Check results also depend on included files and @file lists. The header keeps their identity as it was when the
+checks where done (graph, see PgHba.graph_identity), and the checks are only used while that is still current.
+A cache that cannot be read or written is just ignored, since it is only there for speed.
+'''
+class PgHbaCache(object):
+    #Version of the cache format. Caches with another version are ignored.
+    version = 5
+    #Maximum number of check results to keep
+    max_checks = 4096
+
+    def __init__(self, path, expanded=False):
+        self.path     = path
+        self.expanded = expanded
+        self.ident    = None
+        self.comment  = []
+        self.includes = []
+        self.graph    = []
+        self.checks   = {}
+        self.count    = None
+        self.rules_json = None
+
+    def load(self, pg_hba_file, fstat):
         '''
-        This function writes a hba file if it has added or deleted rules.
+        This function loads the header of the cache and returns True if it is valid for the pg_hba_file.
+        fstat should be the result of os.stat() on pg_hba_file.
         '''
-        if not self.changed:
-            #No changes, then don't write either.
-            return
+        try:
+            with open(self.path) as f:
+                header = json.loads(f.readline())
+        except (IOError, OSError, ValueError):
+            return False
+        if not isinstance(header, dict) or header.get('version') != self.version:
+            return False
+        if header.get('expanded', False) != self.expanded:
+            return False
+        ident = header.get('file') or {}
+        #Check cheap parts of identity first, and only hash if they are the same
+        if [ ident.get(k) for k in ('ino', 'size', 'mtime') ] != [ fstat.st_ino, fstat.st_size, fstat.st_mtime ]:
+            return False
+        if file_identity(pg_hba_file, fstat) != ident:
+            return False
+        self.ident   = ident
+        self.comment = header.get('comment', [])
+        self.includes = header.get('includes', [])
+        self.graph   = header.get('graph', [])
+        self.checks  = header.get('checks', {})
+        self.count   = header.get('count')
+        return True
+
+    def rules(self):
+        '''
+        This function reads the rules from the cache as a list of (key, rule) tuples.
+        '''
+        if self.rules_json is None:
+            with open(self.path) as f:
+                f.readline()
+                self.rules_json = f.readline()
+        return [ row_to_rule(row) for row in json.loads(self.rules_json) ]
 
-        if self.pg_hba_file:
-            if self.backup:
-                #Filepath is set and backup is selected.
-                #Make temp file for backup
-                backup_file_h, backup_file = tempfile.mkstemp(prefix='pg_hba')
-                #Copy contents
-                shutil.copy(self.pg_hba_file, backup_file)
-                #Print location of temp file
-                print('Backup written to {0}'.format(backup_file))
-            #Open the file, so we can write new conent to it
-            fileh = open(self.pg_hba_file, 'w')
-        else:
-            #no file path was set. create temp file
-            filed, path = tempfile.mkstemp(prefix='pg_hba')
-            #open temp file
-            fileh = os.fdopen(filed, 'w')
-            #Print location of temp file
-            print('Writing changed data to {0}'.format(path))
+    def set_rules(self, ident, comment, includes, rules):
+        '''
+        This function sets a new state (of a freshly read or written pg_hba file) in the cache.
+        rules should be the dict of rules by key of a PgHba object.
+        Checks are reset, since they are for another state.
+        '''
+        self.ident   = ident
+        self.comment = comment
+        self.includes = includes
+        self.graph   = []
+        self.checks  = {}
+        rows = [ rule_to_row(key, rule) for key, rule in rules.items() ]
+        self.count   = len(rows)
+        self.rules_json = json.dumps(rows)
+
+    def set_check(self, fingerprint, result, graph):
+        '''
+        This function registers the result of a check, done with included files and lists as in graph.
+        '''
+        if len(self.checks) >= self.max_checks or graph != self.graph:
+            self.checks = {}
+            self.graph  = graph
+        self.checks[fingerprint] = result
 
-        #render altered contents and write to file
-        for line in self.render():
-            fileh.write(line+'\n')
-        if reload:
+    def save(self):
+        '''
+        This function writes the cache to file.
+        It writes to a temp file and renames, so that a concurrent reader never sees a half written cache.
+        '''
+        import tempfile
+        if not self.ident or self.rules_json is None:
+            return
+        header = { 'version': self.version, 'file': self.ident, 'comment': self.comment, 'checks': self.checks,
+                   'count': self.count, 'expanded': self.expanded, 'includes': self.includes, 'graph': self.graph }
+        try:
+            filed, path = tempfile.mkstemp(prefix='.pg_hba_cache', dir=os.path.dirname(os.path.abspath(self.path)))
+            with os.fdopen(filed, 'w') as f:
+                f.write(json.dumps(header)+'\n')
+                f.write(self.rules_json+'\n')
+            os.rename(path, self.path)
+        except (IOError, OSError):
+            #No permissions, full disk, etc. The cache is only for speed, so just skip.
             try:
-                #File has changed. reload and don't mind errors if they occur.
-                subprocess.call(['/etc/init.d/postgres', 'reload'])
+                os.remove(path)
             except:
                 pass
-        #file was written, so file and object are in sync
-        self.changed = False
-        #Close file (don't need it anymore)
-        fileh.close()
 
-    def new_rules(self, contype, databases, users, source, netmask, method, options):
+'''
+This class keeps statistics of a run: the wall time per phase (like read, sort, write and reload) and counters
+(like rules, cache hits and bytes written). Phases can be part of other phases (like sort is part of render
+when the rules are sorted for the first time on render, and backup is part of write). They can be returned as a dict (for json) and written to a textfile
+for the textfile collector of the prometheus node exporter (see write_textfile).
+'''
+class PgHbaStats(object):
+    #Help texts and types of the metrics in the textfile. Counters are added to the value of the previous run.
+    metrics = { 'pg_hba_runs_total':             ('counter', 'Number of runs of modify_pg_hba.py'),
+                'pg_hba_changes_total':          ('counter', 'Number of runs that changed the file'),
+                'pg_hba_bytes_written_total':    ('counter', 'Bytes written to the file'),
+                'pg_hba_cache_hits_total':       ('counter', 'Runs that used the cache instead of parsing the file'),
+                'pg_hba_rules':                  ('gauge',   'Number of rules in the file'),
+                'pg_hba_file_bytes':             ('gauge',   'Size of the file'),
+                'pg_hba_reload_seconds':         ('gauge',   'Time of the last reload of postgres'),
+                'pg_hba_phase_seconds':          ('gauge',   'Wall time per phase of the last run'),
+                'pg_hba_last_run_timestamp_seconds': ('gauge', 'Time of the last run') }
+
+    def __init__(self):
+        self.started  = time.time()
+        self.phases   = {}
+        self.counters = {}
+
+    def phase(self, name):
         '''
-        This function creates a new rule that fits to the parsed parameters.
+        This function returns a context manager that adds the time spent in it to a phase.
         '''
+        return PgHbaPhase(self, name)
 
-        #Check validity of method and contype parameters
-        if method not in PgHbaMethods:
-            raise PgHbaError("invalid method {0} (should be one of '{1}').".format(method, "', '".join(PgHbaMethods)))
-        if contype not in PgHbaTypes:
-            raise PgHbaError("invalid connection type {0} (should be one of '{1}').".format(contype, "', '".join(PgHbaTypes)))
-
-        #Loop through databases (if option was like db1,db2,db3 )
-        #and create a new rule for every database
-        for db in databases.split(','):
-            #Loop through users (if option was like user1,user2,user3 )
-            #and create a new rule for every user
-            for usr in users.split(','):
-                #Create a dictionary contaning the specified rule config
-                rule = dict(zip(PgHbaHDR, [contype, db, usr, source, netmask, method, options]))
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
 
-                #Cleanup some weird combinations
-                if contype == 'local':
-                    del rule['src']
-                    del rule['mask']
-                elif '/' in source:
-                    del rule['mask']
-                elif ipv4_re.search(source):
-                    if not netmask:
-                        rule['src'] += '/32'
-                elif '/' in source:
-                    if not netmask:
-                        rule['src'] += '/128'
-                else:
-                    del rule['mask']
-                #Cleanup keys with empty values
-                self.cleanEmptyRuleKeys(rule)
+    def set(self, name, value):
+        self.counters[name] = value
 
-                #Generate a line that conforms to this rule
-                line = [ rule[k] for k in PgHbaHDR if k in rule.keys() ]
-                rule['line'] = "\t".join(line)
+    def as_dict(self):
+        return { 'seconds': time.time() - self.started, 'phases': dict(self.phases), 'counters': dict(self.counters) }
 
-                #return a rule per db per user
-                yield rule
+    def label(self, pg_hba_file):
+        '''
+        This function returns the label for the metrics of a pg_hba file.
+        '''
+        return 'file="{0}"'.format(pg_hba_file.replace('\\', '\\\\').replace('"', '\\"'))
 
-    def add_rule(self, rule):
+    def samples(self, pg_hba_file):
         '''
-        This function adds (or replaces) a new rule.
-        It tries to find original and checks for differences.
-        If original doesn't exist, new rule is added.
-        If original exists, but differs, it is replaced by the new rule.
+        This function returns the metrics of this run as a dict of 'name{labels}' to (name, value).
         '''
-        #First find the key
-        key = self.rule2key(rule)
-        try:
-            #Try to find the original rule with this key
-            oldrule = self.rules[key]
-            #find keys of elements in the original rule
-            ekeys = set(oldrule.keys() + rule.keys())
-            #But skip line (that doesn;t need to be exactly the same)
-            ekeys.remove('line')
-            for k in ekeys:
-                #Loop through keys and check values with new rule
-                if oldrule[k] != rule[k]:
-                    #A value is different. So, go to the exception block and replace the rule
-                    raise Exception('')
-        except:
-            #Seems that original rule differs from new, or doesn't exist. Add new rule (in its place)
-            self.rules[key] = rule
-            #Also tell hba object that it is changed since last reading from or writing to file
-            self.changed = True
-            
-    def remove_rule(self, rule):
+        label = self.label(pg_hba_file)
+        values = { 'pg_hba_runs_total': 1,
+                   'pg_hba_changes_total': 1 if self.counters.get('written') else 0,
+                   'pg_hba_bytes_written_total': self.counters.get('bytes_written', 0),
+                   'pg_hba_cache_hits_total': self.counters.get('cache_hits', 0),
+                   'pg_hba_last_run_timestamp_seconds': time.time() }
+        for name, counter in (('pg_hba_rules', 'rules'), ('pg_hba_file_bytes', 'file_bytes'),
+                              ('pg_hba_reload_seconds', 'reload_seconds')):
+            if counter in self.counters:
+                values[name] = self.counters[counter]
+        ret = dict( ('{0}{{{1}}}'.format(name, label), (name, value)) for name, value in values.items() )
+        for phase, seconds in self.phases.items():
+            ret['pg_hba_phase_seconds{{{0},phase="{1}"}}'.format(label, phase)] = ('pg_hba_phase_seconds', seconds)
+        return ret
+
+    def write_textfile(self, path, pg_hba_file):
         '''
-        This procedure finds a rule and removes it from the object.
+        This procedure adds the metrics of this run to a textfile of the prometheus node exporter.
+        Samples of other files (and other metrics) in the textfile are kept, counters are increased,
+        and the textfile is replaced atomically, so that the node exporter never reads half a file.
         '''
-        #First find the key of the rule
-        keys = self.rule2key(rule)
+        import tempfile
+        samples = {}
         try:
-            #Try to remove the rule
-            del self.rules[keys]
-            #Found and removed. Tell hba object that it is changed since last reading from or writing to file
-            self.changed = True
-        except:
+            with open(path) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line or line[0] == '#':
+                        continue
+                    sample, value = line.rsplit(' ', 1)
+                    samples[sample] = (sample.split('{', 1)[0], float(value))
+        except (IOError, OSError, ValueError):
             pass
-        
-    def get_rules(self):
-        '''
-        This function returns a list of all the rules.
-        '''
-        ret = []
-        for rk in self.rules.keys():
-            #This zip of list comprehension basically creates a copy of the rule
-            #but without the 'line' item. It creates a copy rather than modifying the original.
-            rule = dict( [ (k, rules[rk][k]) for k in rules[rk].keys() if k != 'line' ] )
-            #Return this rule
-            yield(rule)
+        new_samples = self.samples(pg_hba_file)
+        #Phases of the previous run of this file could be other phases than in this run
+        prefix = 'pg_hba_phase_seconds{{{0},'.format(self.label(pg_hba_file))
+        samples = dict( (sample, v) for sample, v in samples.items() if not sample.startswith(prefix) )
+        for sample, (name, value) in new_samples.items():
+            if self.metrics[name][0] == 'counter' and sample in samples:
+                value += samples[sample][1]
+            samples[sample] = (name, value)
+        lines = []
+        for name in sorted(set( name for name, value in samples.values() )):
+            if name in self.metrics:
+                lines.append('# HELP {0} {1}'.format(name, self.metrics[name][1]))
+                lines.append('# TYPE {0} {1}'.format(name, self.metrics[name][0]))
+            for sample in sorted( sample for sample, (n, v) in samples.items() if n == name ):
+                lines.append('{0} {1}'.format(sample, repr(float(samples[sample][1]))))
+        filed, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.pg_hba_prom')
+        with os.fdopen(filed, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.chmod(tmp_file, 0o644)
+        os.rename(tmp_file, path)
 
-    def render(self):
-        '''
-        This function returns the contents that the altered pg_hba file should have.
-        '''
-        #First return the comments that where already there, line by line
-        for comment in self.comment:
-            yield(comment)
-        #Then sort the rules by the weight of the rules and return them ruke by rule
-        for rule in sorted(self.rules.values(), key=self.rule2weight):
-            yield(rule['line'])
+'''
+This class is the context manager returned by PgHbaStats.phase().
+'''
+class PgHbaPhase(object):
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name  = name
 
-# ===========================================
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats.phases[self.name] = self.stats.phases.get(self.name, 0.0) + time.time() - self.start
+
+'''
+This function returns True if a process with pid is running.
+EPERM means the process exists, but belongs to another user.
+'''
+def pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+'''
+This class reloads the configuration of postgres (like after the pg_hba file has changed).
+It reads the pid of the postmaster from postmaster.pid in the data folder and sends it a SIGHUP,
+instead of forking the init script (which is slow and doesn't work for every service setup).
+Without a pid file, the init script is used like before.
+
+Reload requests that arrive within window seconds are grouped into one SIGHUP: every request writes a token
+to the stamp file, waits window seconds, and only sends the SIGHUP if no newer request has overwritten the token.
+That newer request will send the SIGHUP itself, after its changes are in place. So the last request always reloads.
+Requests are made without holding the lock of the pg_hba file (see apply_merged), so that other processes can write
+their changes (and their token) within the window.
+
+The result of a request is a dict with:
+- reloaded: True if the reload was done (by this request), False if not
+- method: 'signal' or 'init' (or None if no reload was done)
+- pid: the pid of the postmaster (if known)
+- seconds: time it took, from the request until the postmaster took the signal (or the init script finished)
+- reason: why no reload was done ('not running', 'debounced', 'timeout' when the postmaster didn't take the signal
+  within timeout seconds, or an error)
+'''
+class PgHbaReloader(object):
+    #The init script that was used before pid files were supported
+    init_cmd = ['/etc/init.d/postgres', 'reload']
+    #Maximum time to wait for the postmaster to take the signal
+    timeout  = 5.0
+
+    def __init__(self, pid_file=None, window=0.0, stamp_file=None):
+        self.pid_file   = pid_file
+        self.window     = window
+        self.stamp_file = stamp_file
+        self.results    = []
+
+    def postmaster_pid(self):
+        '''
+        This function returns the pid of the running postmaster, or None if postgres isn't running.
+        The first line of postmaster.pid is the pid. If that process doesn't exist, the pid file is stale.
+        '''
+        try:
+            with open(self.pid_file) as f:
+                pid = int(f.readline().strip())
+        except (IOError, OSError, ValueError):
+            return None
+        return pid if pid_running(pid) else None
+
+    def signal_pending(self, pid):
+        '''
+        This function returns True if a SIGHUP is still pending for a process (not yet taken by its signal handler).
+        It uses /proc, and returns False where that is not available.
+        '''
+        import signal
+        mask = 1 << (signal.SIGHUP - 1)
+        try:
+            with open('/proc/{0}/status'.format(pid)) as f:
+                for line in f:
+                    if line.startswith('SigPnd:') or line.startswith('ShdPnd:'):
+                        if int(line.split(':', 1)[1], 16) & mask:
+                            return True
+        except (IOError, OSError, ValueError):
+            pass
+        return False
+
+    def debounce(self):
+        '''
+        This function waits for window seconds and returns True if this is still the latest request.
+        '''
+        if not self.window or not self.stamp_file:
+            return True
+        token = '{0}.{1}'.format(os.getpid(), time.time())
+        try:
+            with open(self.stamp_file, 'w') as f:
+                f.write(token)
+            time.sleep(self.window)
+            with open(self.stamp_file) as f:
+                return f.read() == token
+        except (IOError, OSError):
+            #Without a stamp file, just reload
+            return True
+
+    def request(self):
+        '''
+        This function requests a reload and returns the result (see class description).
+        '''
+        start  = time.time()
+        result = { 'reloaded': False, 'method': None, 'pid': None, 'seconds': 0.0, 'reason': None }
+        if self.pid_file:
+            if self.postmaster_pid() is None:
+                result['reason'] = 'not running'
+            elif not self.debounce():
+                result['reason'] = 'debounced'
+            else:
+                #Read pid again, since postgres could have been restarted while waiting
+                result.update(self.send_signal(self.postmaster_pid()))
+        else:
+            result.update(self.run_init())
+        result['seconds'] = time.time() - start
+        self.results.append(result)
+        return result
+
+    def send_signal(self, pid):
+        '''
+        This function sends a SIGHUP to the postmaster and waits (at most timeout seconds) until the postmaster took it.
+        If the signal cannot be sent because of permissions, the init script is used instead.
+        '''
+        import signal
+        if pid is None:
+            return { 'reason': 'not running' }
+        try:
+            os.kill(pid, signal.SIGHUP)
+        except OSError as e:
+            if e.errno == errno.EPERM:
+                return self.run_init()
+            return { 'pid': pid, 'reason': str(e) }
+        deadline = time.time() + self.timeout
+        while self.signal_pending(pid):
+            if time.time() >= deadline:
+                #The postmaster doesn't take signals (like when it is stuck), so the reload cannot be confirmed
+                return { 'method': 'signal', 'pid': pid, 'reason': 'timeout' }
+            time.sleep(0.001)
+        return { 'reloaded': True, 'method': 'signal', 'pid': pid }
+
+    def run_init(self):
+        '''
+        This function reloads with the init script.
+        '''
+        import subprocess
+        try:
+            rc = subprocess.call(self.init_cmd)
+        except OSError as e:
+            return { 'method': 'init', 'reason': str(e) }
+        if rc:
+            return { 'method': 'init', 'reason': '{0} returned {1}'.format(' '.join(self.init_cmd), rc) }
+        return { 'reloaded': True, 'method': 'init' }
+
+'''
+This class is an advisory lock (flock) on a lock file, used around a read, change and write of a pg_hba file.
+It can be used as a context manager. It measures how long it waited for the lock (wait) and how long it was held (hold).
+'''
+class PgHbaLock(object):
+    def __init__(self, lock_file):
+        self.lock_file = lock_file
+        self.fileh     = None
+        self.wait      = 0.0
+        self.hold      = 0.0
+        self.acquired  = None
+
+    def acquire(self):
+        start = time.time()
+        self.fileh = open(self.lock_file, 'a')
+        fcntl.flock(self.fileh.fileno(), fcntl.LOCK_EX)
+        self.acquired = time.time()
+        self.wait = self.acquired - start
+
+    def release(self):
+        if self.fileh:
+            self.hold = time.time() - self.acquired
+            fcntl.flock(self.fileh.fileno(), fcntl.LOCK_UN)
+            self.fileh.close()
+            self.fileh = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+'''
+This class is a spool folder for edits of a pg_hba file by processes that wait for the lock on it (see apply_merged).
+Every process puts its edit (a list of rule specifications, and if they should be reconciled, see PgHba.apply_edit)
+in the spool before it waits for the lock.
+The process that holds the lock applies all edits in the spool (in order of arrival) with one write and one reload,
+and leaves the results for the other processes in a result file next to their edit.
+Files in the spool are named after the time and the pid of the process that submitted the edit. Edits of a process
+that is gone (crashed or killed while it waited) are dropped instead of applied, and so are results that were never
+picked up.
+'''
+class PgHbaSpool(object):
+    def __init__(self, folder):
+        self.folder = folder
+        if not os.path.isdir(folder):
+            try:
+                os.mkdir(folder, 0o700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise PgHbaError("Could not create spool folder '{0}': {1}".format(folder, e))
+
+    def write_json(self, path, data):
+        '''
+        This procedure writes data as json to path, atomically (so that readers never see half of it).
+        '''
+        tmp_file = path + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp_file, path)
+
+    def submit(self, specs, settings, reload, reconcile=False, purge=False):
+        '''
+        This function puts an edit in the spool and returns its name.
+        The name starts with the time, so that sorting by name sorts by arrival.
+        settings are those of the process that submits it (see pg_hba_settings).
+        '''
+        name = '{0:017.6f}.{1}.edit'.format(time.time(), os.getpid())
+        self.write_json(os.path.join(self.folder, name), { 'specs': specs, 'settings': settings, 'reload': reload,
+                                                          'reconcile': reconcile, 'purge': purge })
+        return name
+
+    def take(self, settings):
+        '''
+        This function returns all edits in the spool for settings, as a list of (name, edit), oldest first.
+        Edits with other settings (like another order, or without backup) are left to their own process.
+        '''
+        edits = []
+        for name in sorted(os.listdir(self.folder)):
+            if not self.owner_running(name):
+                self.discard(name)
+                continue
+            if not name.endswith('.edit'):
+                continue
+            try:
+                with open(os.path.join(self.folder, name)) as f:
+                    edit = json.load(f)
+            except (IOError, ValueError):
+                continue
+            if edit.get('settings') == settings:
+                edit['specs'] = [ dict( (k, native_str(v)) for k, v in spec.items() ) for spec in edit['specs'] ]
+                edits.append((name, edit))
+        return edits
+
+    def owner_running(self, name):
+        '''
+        This function returns True if the process that submitted an edit (or left a result or temp file) is running.
+        Names that are not like those of submit are kept.
+        '''
+        try:
+            return pid_running(int(name.split('.')[2]))
+        except (IndexError, ValueError):
+            return True
+
+    def finish(self, name, result):
+        '''
+        This procedure leaves the result of an edit for its process, and removes the edit from the spool.
+        '''
+        self.write_json(os.path.join(self.folder, name[:-len('.edit')] + '.done'), result)
+        self.discard(name)
+
+    def discard(self, name):
+        '''
+        This procedure removes an edit (or another file) from the spool, if it is still there.
+        '''
+        try:
+            os.remove(os.path.join(self.folder, name))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def pending(self, name):
+        '''
+        This function returns True if an edit is still in the spool (not yet applied by another process).
+        '''
+        return os.path.exists(os.path.join(self.folder, name))
+
+    def result(self, name):
+        '''
+        This function returns the result that another process left for an edit, and removes it from the spool.
+        '''
+        done_file = os.path.join(self.folder, name[:-len('.edit')] + '.done')
+        try:
+            with open(done_file) as f:
+                result = json.load(f)
+            os.remove(done_file)
+        except (IOError, OSError, ValueError) as e:
+            raise PgHbaError("Edit {0} was taken from spool '{1}', but has no result: {2}".format(name, self.folder, e))
+        return result
+
+'''
+This function applies a list of rule specifications (see read_batch) to a pg_hba file, safe for concurrent processes.
+The edit is put in a spool, and then the lock on the file is taken (see PgHbaLock and PgHbaSpool).
+If another process applied the edit while this process waited for the lock, its result is returned.
+Else this process reads the file (new_pg_hba should return a new PgHba object for it, with settings as returned by
+pg_hba_settings), applies all waiting edits with the same settings, and writes and reloads once for all of them. The reload is requested after the lock is released, so that the
+next process can write while this one waits for the reload window.
+With reconcile (and purge) set, specs are reconciled (see PgHba.reconcile) instead of applied.
+An edit that fails is left out of the write (see apply_edits), and raises a PgHbaError in its own process.
+It returns a tuple of (results of apply_edit for specs, stats), where stats is a dict with:
+- wait: seconds waited for the lock
+- hold: seconds the lock was held
+- merged: number of edits applied in the write that applied this edit
+- holder: pid of the process that applied this edit
+'''
+def apply_merged(pg_hba_file, specs, settings, reload, new_pg_hba, reconcile=False, purge=False):
+    spool = PgHbaSpool(pg_hba_file + '.spool')
+    name  = spool.submit(specs, settings, reload, reconcile, purge)
+    lock  = PgHbaLock(pg_hba_file + '.lock')
+    reload_hba = None
+    try:
+        with lock:
+            if not spool.pending(name):
+                #Applied by the process that held the lock before
+                result = spool.result(name)
+            else:
+                edits = spool.take(settings)
+                pg_hba, results, errors = apply_edits(new_pg_hba, edits)
+                #The reload is requested after the lock is released (see PgHbaReloader)
+                if pg_hba.write() and any( edit['reload'] for n, edit in edits if n not in errors ):
+                    reload_hba = pg_hba
+                result = None
+                for n, edit in edits:
+                    if n in errors:
+                        edit_result = { 'error': errors[n] }
+                    else:
+                        edit_result = { 'rules': results[n] }
+                    edit_result.update({ 'merged': len(edits) - len(errors), 'holder': os.getpid() })
+                    if n == name:
+                        result = edit_result
+                    else:
+                        spool.finish(n, edit_result)
+    finally:
+        #Also when this process failed (or was interrupted), its edit should not be left for others
+        spool.discard(name)
+    if reload_hba:
+        reload_hba.request_reload()
+    if 'error' in result:
+        raise PgHbaError(result['error'])
+    stats = { 'wait': lock.wait, 'hold': lock.hold, 'merged': result['merged'], 'holder': result['holder'] }
+    return result['rules'], stats
+
+'''
+This function applies edits (as returned by PgHbaSpool.take) to a new PgHba object (from new_pg_hba).
+An edit that fails (like for a users file that can't be read) is left out: the object is read again, and the other
+edits are applied without it, so that a failing edit never blocks the edits of other processes, and never leaves
+part of its changes behind.
+It returns a tuple of (the PgHba object, results by edit name, errors by edit name).
+'''
+def apply_edits(new_pg_hba, edits):
+    errors = {}
+    while True:
+        pg_hba  = new_pg_hba()
+        results = {}
+        for n, edit in edits:
+            if n in errors:
+                continue
+            try:
+                results[n] = pg_hba.apply_edit(edit['specs'], edit.get('reconcile'), edit.get('purge'))
+            except Exception as e:
+                errors[n] = str(e) if isinstance(e, PgHbaError) else '{0}: {1}'.format(e.__class__.__name__, e)
+                break
+        else:
+            return pg_hba, results, errors
+
+'''
+This class is a file with a list of names, for a @file item in a rule (like @app_users).
+Rule specifications with a users_file keep their users in such a file, instead of having a rule per user.
+Adding a user then changes a small file, instead of adding a rule to a (possibly large) pg_hba file.
+Names are written one per line and sorted, after the comments that where in the file.
+'''
+class PgHbaList(object):
+    def __init__(self, path):
+        self.path      = path
+        self.comment   = []
+        self.members   = set()
+        self.changed   = False
+        #Identity of the file when it was read or written (None when it doesn't exist yet)
+        self.file_stat = stat_identity(path)
+        if self.file_stat is None:
+            return
+        try:
+            with open(path, 'rb') as f:
+                for lineno, fields, comment in tokenize_hba(f, path):
+                    if comment:
+                        self.comment.append(comment)
+                    for field in fields:
+                        self.members.update( name for name in field.split(',') if name )
+        except IOError as e:
+            raise PgHbaError("list file '{0}' could not be read: {1}".format(path, e))
+
+    def add(self, names):
+        '''
+        This function adds names to the list, and returns True if any of them was not in the list yet.
+        '''
+        new = set(names) - self.members
+        if new:
+            self.members |= new
+            self.changed = True
+        return bool(new)
+
+    def remove(self, names):
+        '''
+        This function removes names from the list, and returns True if any of them was in the list.
+        '''
+        old = self.members & set(names)
+        if old:
+            self.members -= old
+            self.changed = True
+        return bool(old)
+
+    def set(self, names):
+        '''
+        This function sets the list to exactly names, and returns True if that changed the list.
+        '''
+        names = set(names)
+        if names == self.members:
+            return False
+        self.members = names
+        self.changed = True
+        return True
+
+    def content(self):
+        '''
+        This function returns the contents of the file (as bytes).
+        '''
+        content = ''.join( line+'\n' for line in self.comment + sorted(self.members) )
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        return content
+
+'''
+This function reads an included file into a PgHba object, and returns its parsed state (see PgHba.parsed).
+It runs in another process when included files are parsed in parallel (see PgHba.parse_shards),
+so it takes one argument: a tuple of (path, compact).
+'''
+def parse_shard(args):
+    path, compact = args
+    return PgHba(path, compact=compact, source=path).parsed()
+
+'''
+This class is used to read and process a pg_hba file.
+The file can include other files (include, include_if_exists and include_dir). Every included file (a shard) is
+read into a PgHba object of its own (see read_shards), and is only written when its own rules change.
+'''
+class PgHba(object):
+    def __init__(self, pg_hba_file=None, order="sdu", backup=False, cache=None, use_mmap=False, backup_dir=None,
+                 backup_count=5, reloader=None, stats=None, compact=False, traffic=None, source=None, parsed=None):
+        '''
+        Initialize a pg_hba object.
+        - pg_hba_file should be the path of a pg_hba file.
+        - order should be a string of three characters 's', 'd', and 'u'. Every character exactly once.
+        - backup should be set to true to keep a backup of the original file, or to false not to keep a backup.
+        - backup_dir is the folder to keep backups in (by default the folder of the pg_hba file).
+        - backup_count is the number of backups to keep (see rotate_backups).
+        - reloader is the PgHbaReloader used to reload postgres after a write (by default one using the init script).
+        - stats is the PgHbaStats to keep timings and counters in (by default a new one).
+        - cache can be set to the path of a cache file to keep the parsed state of the pg_hba file in (see PgHbaCache).
+        - use_mmap can be set to true to read the file through mmap.
+        - compact can be set to true to write the rules compacted (see PgHbaCompactor). The file is then read with
+          lists of databases and users expanded into a rule per database per user, like new_rules creates them.
+          Merged networks can not be expanded. Use a cache to keep the rules as they where before compaction.
+        - traffic can be set to the path of a json file with counts of connections per rule, to order rules by
+          traffic (see PgHbaTraffic).
+        - source is set for a file that is included by another pg_hba file (a shard, see read_shards).
+          It is the path that is reported for its rules.
+        - parsed can be set to the parsed state of the file (as returned by parsed()), to use instead of reading the file.
+        '''
+
+        #Check that order is one of "sdu", "sud", "dsu", "dus", "usd", "uds"
+        if order not in PgHbaOrders:
+            raise PgHbaError("invalid order setting {0} (should be one of '{1}').".format(order, "', '".join(PgHbaOrders)))
+        #Copy parameters to new object
+        self.pg_hba_file = pg_hba_file
+        self.rules      = None
+        self.comment    = None
+        self.changed    = True
+        self.order      = order
+        self.backup     = backup
+        self.backup_dir = backup_dir
+        self.backup_count = backup_count
+        self.reloader   = reloader or PgHbaReloader()
+        #Identity of the file when it was last read or written (see stat_identity)
+        self.file_stat  = None
+        self.stats      = stats or PgHbaStats()
+        self.cache      = PgHbaCache(cache, expanded=compact) if cache else None
+        self.use_mmap   = use_mmap
+        self.compact    = compact
+        #A shard shares the traffic of the file that includes it
+        self.traffic    = traffic if isinstance(traffic, PgHbaTraffic) else PgHbaTraffic(traffic) if traffic else None
+        #Compaction and ordering by traffic render rules differently than they are kept
+        self.reorders   = compact or bool(traffic)
+        self.source     = source
+        #Include directives (as lines). Rules after the n-th directive are in section n (see PgHbaRule).
+        self.includes   = []
+        #Per include directive, the paths of the files it includes (set by read_shards)
+        self.included   = []
+        #Included files (as PgHba objects in the order postgres reads them, and by path) and @file lists by path.
+        #Included files are read when they are first needed (see shards).
+        self._shards    = None
+        self._shard_keys = None
+        self.shard_files = {}
+        self.lists      = {}
+        #Identity of include folders and of included files that don't exist (see graph_identity)
+        self.graph      = []
+
+        #Read the rules of the hba file
+        with self.stats.phase('read'):
+            self.read(parsed)
+
+    @property
+    def rules(self):
+        '''
+        The rules of this object, as a dict of rule by key.
+        When read from cache, they are only loaded from the cache when they are actually needed.
+        '''
+        if self._rules is None:
+            self._rules = dict(self.cache.rules())
+        return self._rules
+
+    @rules.setter
+    def rules(self, rules):
+        self._rules = rules
+
+    def read(self, parsed=None):
+        '''
+        This procedure read the rules from the pg_hba file (or from parsed, see parsed()).
+        Include directives are kept in includes. The included files are read by read_shards.
+        '''
+
+        #Reset self.rules, self.comment and self.includes
+        self.rules = {}
+        self.comment = []
+        self.includes = []
+        #Reset the indexes, which keep the rules in order (see sorted_rules)
+        self.indexes = {}
+
+        if not self.pg_hba_file:
+           return
+
+        if parsed is not None:
+            #Parsed by parse_shard in another process
+            self.comment   = list(parsed['comment'])
+            self.includes  = list(parsed['includes'])
+            self.file_stat = tuple(parsed['file_stat'])
+            for row in parsed['rows']:
+                self.add_own_rule(row_to_rule(row)[1])
+            self.changed = self.reorders
+            return
+
+        try:
+            fstat = os.stat(self.pg_hba_file)
+        except OSError:
+            raise PgHbaError("pg_hba file '{0}' doesn't exist. Use create option to autocreate.".format(self.pg_hba_file))
+
+        self.stats.set('file_bytes', fstat.st_size)
+        self.file_stat = (fstat.st_ino, fstat.st_size, fstat.st_mtime, fstat.st_ctime)
+        if self.cache and self.cache.load(self.pg_hba_file, fstat):
+            #The cache holds the state of this exact file. Rules are loaded from cache when needed.
+            self.rules = None
+            self.comment = list(self.cache.comment)
+            self.includes = list(self.cache.includes)
+            self.changed = False
+            self.stats.count('cache_hits')
+            if self.cache.count is not None:
+                self.stats.set('rules', self.cache.count)
+            return
+        elif self.cache:
+            self.stats.count('cache_misses')
+
+        sha1 = hashlib.sha1()
+        try:
+            # open the pg_hbafile
+            f = open(self.pg_hba_file, 'rb')
+        except IOError:
+            raise PgHbaError("pg_hba file '{0}' doesn't exist. Use create option to autocreate.".format(self.pg_hba_file))
+        with f:
+            #Process al lines, streaming
+            for lineno, fields, comment in tokenize_hba(self.read_lines(f, sha1), self.pg_hba_file):
+                if comment:
+                    self.comment.append(comment)
+                if fields and fields[0] in PgHbaIncludes:
+                    self.add_include(fields, lineno)
+                elif fields:
+                    #Convert line to rule and add rule to this object
+                    rule = fields_to_rule(fields, self.pg_hba_file, lineno)
+                    rule.section = len(self.includes)
+                    if self.compact:
+                        for rule in self.expand_rule(rule):
+                            self.add_own_rule(rule)
+                    else:
+                        self.add_own_rule(rule)
+        # Since we have read contents, this object represents file without changes, so write should do anything.
+        # Unless compacting or ordering by traffic, since the file might not be in that form yet. write() finds out.
+        self.changed = self.reorders
+        self.stats.set('rules', len(self.rules))
+
+        if self.cache:
+            #Keep parsed state in cache for next time
+            ident = file_identity(self.pg_hba_file, fstat, sha1)
+            if ident:
+                self.cache.set_rules(ident, self.comment, self.includes, self.rules)
+                self.cache.save()
+
+    def add_include(self, fields, lineno):
+        '''
+        This procedure adds an include directive (include, include_if_exists or include_dir with a file or folder).
+        Rules after it are in the next section.
+        '''
+        if len(fields) != 2:
+            raise PgHbaError("{0}:{1}: {2} should be followed by one file name".format(self.pg_hba_file, lineno, fields[0]))
+        self.includes.append(' '.join(fields))
+
+    def parsed(self):
+        '''
+        This function returns the parsed state of this object (comments, include directives, rules as rows
+        and the identity of the file), as a dict that can be passed to another process.
+        '''
+        return { 'comment': self.comment, 'includes': self.includes, 'file_stat': self.file_stat,
+                 'rows': [ rule_to_row(key, rule) for key, rule in self.rules.items() ] }
+
+    @property
+    def shards(self):
+        '''
+        The files included by this file (and the files they include) as PgHba objects, in the order postgres reads them.
+        They are read when they are used for the first time.
+        '''
+        if self._shards is None:
+            if self.includes and self.source is None:
+                with self.stats.phase('read_shards'):
+                    self.read_shards()
+            else:
+                self._shards = []
+        return self._shards
+
+    def read_shards(self):
+        '''
+        This procedure reads the files included by this file, and the files they include, into a PgHba object per file.
+        Files are read level by level (the files included by this file, then the files they include, etc.).
+        The files of a level are parsed in parallel processes when that pays off (see parse_shards).
+        '''
+        self.shard_files = { os.path.abspath(self.pg_hba_file): self }
+        self.graph = []
+        level = [ self ]
+        while level:
+            paths = []
+            for pg_hba in level:
+                pg_hba.included = [ self.resolve_include(pg_hba, line) for line in pg_hba.includes ]
+                for included in pg_hba.included:
+                    paths += [ path for path in included if path not in self.shard_files and path not in paths ]
+            parsed = self.parse_shards(paths)
+            level = []
+            for path in paths:
+                shard = PgHba(path, self.order, self.backup, use_mmap=self.use_mmap, backup_dir=self.backup_dir,
+                              backup_count=self.backup_count, compact=self.compact, traffic=self.traffic, source=path,
+                              parsed=parsed.get(path))
+                self.shard_files[path] = shard
+                level.append(shard)
+        self._shards = []
+        self.walk_shards(self, [], set())
+        self.stats.set('shards', len(self._shards))
+        self.stats.set('shard_rules', sum( len(shard.rules) for shard in self._shards ))
+
+    def resolve_include(self, pg_hba, line):
+        '''
+        This function returns the paths of the files that an include directive (line) of pg_hba includes.
+        Relative paths are relative to the folder of pg_hba. include_dir includes the files ending in .conf in
+        the folder (except hidden files), in the order of their names. Folders of include_dir, and files of
+        include_if_exists that don't exist, are kept in graph, so that a change to them is noticed.
+        '''
+        directive, name = line.split(None, 1)
+        if name[0] == '"':
+            name = name[1:-1].replace('""', '"')
+        path = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(pg_hba.pg_hba_file)), name))
+        if directive == 'include_dir':
+            try:
+                names = sorted(os.listdir(path))
+            except OSError as e:
+                raise PgHbaError("{0}: folder '{1}' of include_dir could not be read: {2}".format(pg_hba.pg_hba_file, path, e))
+            self.graph.append(graph_entry(path))
+            return [ os.path.join(path, n) for n in names
+                     if n.endswith('.conf') and not n.startswith('.') and os.path.isfile(os.path.join(path, n)) ]
+        if not os.path.isfile(path):
+            if directive == 'include_if_exists':
+                self.graph.append(graph_entry(path))
+                return []
+            raise PgHbaError("{0}: included file '{1}' doesn't exist".format(pg_hba.pg_hba_file, path))
+        return [ path ]
+
+    def parse_shards(self, paths):
+        '''
+        This function parses files in parallel processes (see parse_shard), and returns their parsed state by path.
+        It returns an empty dict when there are not enough files or bytes for that to pay off.
+        Then every shard reads its file itself.
+        '''
+        if len(paths) < 2:
+            return {}
+        size = 0
+        for path in paths:
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        if size < PgHbaParallelBytes:
+            return {}
+        import multiprocessing
+        try:
+            #The cpus this process may run on (python 3 on linux), which can be less than all cpus
+            cpus = len(os.sched_getaffinity(0))
+        except AttributeError:
+            cpus = multiprocessing.cpu_count()
+        workers = min(len(paths), cpus)
+        if workers < 2:
+            return {}
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(parse_shard, [ (path, self.compact) for path in paths ])
+        finally:
+            pool.close()
+            pool.join()
+        self.stats.set('parallel_shards', len(paths))
+        return dict(zip(paths, results))
+
+    def walk_shards(self, pg_hba, stack, seen):
+        '''
+        This procedure adds the shards included by pg_hba to shards, in the order postgres reads them.
+        stack holds the paths of the files that include pg_hba, to find files that include themselves.
+        '''
+        path = os.path.abspath(pg_hba.pg_hba_file)
+        if path in stack:
+            raise PgHbaError("'{0}' includes itself (through '{1}')".format(path, "', '".join(stack)))
+        if len(stack) >= PgHbaMaxDepth:
+            raise PgHbaError("'{0}' is included more than {1} levels deep".format(path, PgHbaMaxDepth))
+        for included in pg_hba.included:
+            for shard_path in included:
+                shard = self.shard_files[shard_path]
+                if shard_path not in seen:
+                    seen.add(shard_path)
+                    self._shards.append(shard)
+                self.walk_shards(shard, stack + [ path ], seen)
+
+    @property
+    def shard_keys(self):
+        '''
+        The shard of every key of a rule in an included file (and not in this file), as a dict.
+        When more than one included file has a rule for a key, it is the first of them (which is the one postgres uses).
+        '''
+        if self._shard_keys is None:
+            self._shard_keys = {}
+            for shard in self.shards:
+                for key in shard.rules:
+                    self._shard_keys.setdefault(key, shard)
+        return self._shard_keys
+
+    def shard(self, path):
+        '''
+        This function returns the PgHba object of a file in the include graph, by path
+        (relative to the folder of this file).
+        '''
+        path = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(self.pg_hba_file or '.')), path))
+        if self.pg_hba_file and path == os.path.abspath(self.pg_hba_file):
+            return self
+        self.shards
+        if path not in self.shard_files:
+            raise PgHbaError("'{0}' is not included by pg_hba file '{1}'".format(path, self.pg_hba_file))
+        return self.shard_files[path]
+
+    def owner_of(self, key, shard=None):
+        '''
+        This function returns the PgHba object of the file that the rule with key belongs in: the file that has it,
+        or else shard (the path of an included file) when set, or else this file.
+        '''
+        if self.source is not None or (not self.includes and not shard) or key in self.rules:
+            return self
+        owner = self.shard_keys.get(key) if self.includes else None
+        if owner is None and shard:
+            owner = self.shard(shard)
+        return owner or self
+
+    def graph_items(self):
+        '''
+        This function yields a tuple of (key, rule) for all rules of this file and of the files it includes.
+        '''
+        for item in self.rules.items():
+            yield item
+        if self.includes and self.source is None:
+            for key, shard in list(self.shard_keys.items()):
+                yield key, shard.rules[key]
+
+    def graph_identity(self):
+        '''
+        This function returns the identity of the included files, include folders and @file lists that
+        this object has read, as a list of [path, identity] (see graph_current).
+        '''
+        graph = list(self.graph)
+        graph += [ [ shard.pg_hba_file, list(shard.file_stat) if shard.file_stat else None ] for shard in self._shards or [] ]
+        graph += [ [ path, list(lst.file_stat) if lst.file_stat else None ] for path, lst in sorted(self.lists.items()) ]
+        return graph
+
+    def pending(self):
+        '''
+        This function returns True if this object, an included file or a list has changes that are not written.
+        '''
+        return (self.changed or any( shard.changed for shard in self._shards or [] ) or
+                any( lst.changed for lst in self.lists.values() ))
+
+    def in_sync(self):
+        '''
+        This function returns True if this object is in sync with its files: no changes that are not written,
+        and the file, the traffic file, included files and lists are as they where when they where read or written.
+        '''
+        return (not self.pending() and self.file_stat == stat_identity(self.pg_hba_file) and
+                (not self.traffic or self.traffic.file_stat == stat_identity(self.traffic.path)) and
+                graph_current(self.graph_identity()))
+
+    def user_list(self, owner, name):
+        '''
+        This function returns the PgHbaList for @name in a rule of owner (a PgHba object).
+        The path is relative to the folder of the file of owner, like postgres does.
+        '''
+        folder = os.path.dirname(os.path.abspath(owner.pg_hba_file)) if owner.pg_hba_file else os.getcwd()
+        path = os.path.abspath(os.path.join(folder, name))
+        if path not in self.lists:
+            self.lists[path] = PgHbaList(path)
+        return self.lists[path]
+
+    def read_lines(self, f, sha1):
+        '''
+        This function yields the lines of an opened file (optionally through mmap),
+        and hashes the contents, so that the cache can check it against the file later.
+        '''
+        if self.use_mmap and os.fstat(f.fileno()).st_size > 0:
+            import mmap
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                sha1.update(mm)
+                for line in iter(mm.readline, b''):
+                    yield line
+            finally:
+                mm.close()
+        else:
+            for line in f:
+                sha1.update(line)
+                yield line
+
+    def expand_rule(self, rule):
+        '''
+        This function yields a rule per database per user for a rule with lists (like a folded rule of a compacted file).
+        '''
+        if ',' not in rule.db and ',' not in rule.usr:
+            yield rule
+            return
+        for db in rule.db.split(','):
+            for usr in rule.usr.split(','):
+                expanded = PgHbaRule(rule.type, db, usr, rule.src, rule.mask, rule.method, rule.options)
+                expanded.lineno = rule.lineno
+                expanded.section = rule.section
+                yield expanded
+
+    def line_to_rule(self, line):
+        '''
+        This function converts one line of a pg_hba file into a rule.
+        It returns None for lines without a rule (like empty lines and comments).
+        '''
+        for lineno, fields, comment in tokenize_hba([ line ], self.pg_hba_file):
+            if fields:
+                return fields_to_rule(fields, self.pg_hba_file, lineno)
+        return None
+
+    def rule2key(self, rule):
+        '''
+        This function returns the key of a rule. The key consists of source, db and usr (see rule_key).
+        '''
+        return rule.key
+
+    def rule2weight(self, rule, order=None):
+        '''
+        This function can calculate the weight from a rule, for the order setting of this object (or order if set).
+        It returns the same as order_weight(self.rule2weights(rule), order).
+        '''
+        return order_weight(self.rule2weights(rule), order or self.order)
+
+    def rule2weights(self, rule):
+        '''
+        This function can calculate the weights from a rule.
+        It is only used to keep the rules in correct order for the render function.
+        It returns a tuple of (-srcweight, dbweight, uweight, db, usr, gateway),
+        which is converted into the weight for a specific order setting by order_weight().
+
+        The weigth actually defines the grainness of the rule (how specific is this rule).
+        For networks, every 1 in 'netmask in binary' makes the subnet more specific.
+        Therefore network prefix has an important imact on the weight.
+        So a single IP (/32) should have twice the weight of a /16 network.
+        To keep everything in the same weight scale for IPv6,
+        - a scale of 0 - 128 from 0 bits to 32 bits is chosen for ipv4 and 
+        - a scale of 0 - 128 from 0 bits to 128 bits is chosen for ipv6.
+        In addition to weight, also the db, username and the gateway is added to sort on that too.
+        '''
+        #The parsed network of the source (None for local and for sources that are no ip address)
+        net = parse_network(rule.src, rule.mask) if rule.type != 'local' else None
+        if rule.type == 'local':
+            #local is always 'this server' and therefore considered /32
+            srcweight = 128 #(ipv4 /32 is considered equivalent to ipv6 /128)
+            gw = 0
+        elif net:
+            #prefix tells how much 1's there are in netmask, so lets use that for sourceweight
+            srcweight = net.weight
+            gw = net.gateway
+        else:
+            #You can also write all to match any IP address, samehost to match any of the server's own IP addresses, or samenet to match any address in any subnet that the server is directly connected to.
+            if rule.src == 'all':
+                #every ip is ok. Lets put this one on the very bottom of the file.
+                srcweight = 0
+                gw = 1
+            elif rule.src == 'samehost':
+                #All i's from this host is ok. Lets consider this is only one ip.
+                srcweight = 128 #(ipv4 /32 is considered equivalent to ipv6 /128)
+                gw = 0
+            elif rule.src == 'samenet':
+                #Might write some fancy code to determine all prefix's 
+                #from all interfaces and find a sane value for this one.
+                #For now, let's assume /24...
+                srcweight = 96 #(ipv4 /24 is considered equivalent to ipv6 /96)
+                gw = 0
+            elif rule.src[0] == '.':
+                # suffix matching, let's asume a very large scale and therefore a very low weight.
+                srcweight = 64 #(ipv4 /16 is considered equivalent to ipv6 /64)
+                gw = -1
+            else:
+                #This seems to be a hostname. Let's asume only one host matches
+                srcweight = 128 #(ipv4 /32 is considered equivalent to ipv6 /128)
+                gw = -1
+
+        #dbweight is equal to the number of databases.
+        if rule.db == 'all':
+            #More than one, make it huge and sink to the bottom.
+            dbweight = 1000
+        else:
+            #Count comma's to find number of databases
+            dbweight = rule.db.count(',') + 1
+
+        #uweight is equal to the number of users
+
+        if rule.usr == 'all':
+            #All users, so (probably) more than one. Sink to bottom.
+            uweight = 1000
+        else:
+            #More than one, sink to the bottom
+            uweight = rule.usr.count(',') + 1
+
+        #Return the weights. The source weight is negative, since larger networks should sink to the bottom.
+        #dbname, username and gateway are added for sort when all else is the same.
+        return (-srcweight, dbweight, uweight, rule.db, rule.usr, gw)
+
+    def write(self, reload=False):
+        '''
+        This function writes the @file lists, included files and the hba file that have changes (in that order,
+        so that the hba file never refers to something that is not written yet), and reloads once when set.
+        It returns True if any file was written and False if not.
+        '''
+        written = False
+        for path, lst in sorted(self.lists.items()):
+            if lst.changed:
+                with self.stats.phase('write'):
+                    self.replace_file(lst.content(), path)
+                lst.file_stat = stat_identity(path)
+                lst.changed = False
+                written = True
+        for shard in self._shards or []:
+            written = shard.write_file() or written
+        written = self.write_file() or written
+        if written and self.graph:
+            #Writing files into an include folder changes the folder
+            self.graph = [ graph_entry(path) for path, ident in self.graph ]
+        if written and reload:
+            self.request_reload()
+        return written
+
+    def request_reload(self):
+        '''
+        This procedure reloads postgres (see PgHbaReloader), after the files have changed.
+        '''
+        if not self.pg_hba_file:
+            return
+        #The result is kept in the reloader, so errors don't stop us here.
+        with self.stats.phase('reload'):
+            result = self.reloader.request()
+        self.stats.set('reload_seconds', result['seconds'])
+        self.stats.set('reloaded', 1 if result['reloaded'] else 0)
+
+    def write_file(self):
+        '''
+        This function writes the hba file (of this object only) if it has added or deleted rules.
+        The file is replaced atomically (see replace_file), so postgres never sees a partly written file.
+        If the rendered contents are the same as the contents of the file, the file is left alone.
+        It returns True if the file was written and False if not.
+        '''
+        import tempfile
+        if not self.changed:
+            #No changes, then don't write either.
+            return False
+
+        #render altered contents
+        with self.stats.phase('render'):
+            content = self.content()
+
+        if not self.pg_hba_file:
+            #no file path was set. create temp file
+            filed, path = tempfile.mkstemp(prefix='pg_hba')
+            with os.fdopen(filed, 'wb') as fileh:
+                fileh.write(content)
+            #Print location of temp file
+            print('Writing changed data to {0}'.format(path))
+            self.changed = False
+            return True
+
+        if content == self.read_file():
+            #Rules have changed, but they render the same (like a rule that was removed and added again). Nothing to write.
+            self.changed = False
+            if self.compact:
+                #The rules before compaction can differ from what was read, so keep them in cache
+                self.save_cache(content)
+            return False
+
+        with self.stats.phase('write'):
+            self.replace_file(content)
+        self.file_stat = stat_identity(self.pg_hba_file)
+        self.stats.count('bytes_written', len(content))
+        self.stats.set('written', 1)
+        self.stats.set('rules', len(self.rules))
+        self.stats.set('file_bytes', len(content))
+        #file was written, so file and object are in sync
+        self.changed = False
+        #Keep the state that was just written in cache for next time
+        self.save_cache(content)
+        return True
+
+    def content(self):
+        '''
+        This function returns the rendered contents of the file (as bytes).
+        '''
+        content = ''.join( line+'\n' for line in self.render() )
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        return content
+
+    def read_file(self):
+        '''
+        This function returns the current contents of the file (as bytes), or None if it cannot be read.
+        '''
+        try:
+            with open(self.pg_hba_file, 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def save_cache(self, content):
+        '''
+        This procedure keeps the rules of this object in cache, as the state of the file with content (bytes).
+        '''
+        if not self.cache:
+            return
+        ident = file_identity(self.pg_hba_file, os.stat(self.pg_hba_file), hashlib.sha1(content))
+        if ident:
+            self.cache.set_rules(ident, self.comment, self.includes, self.rules)
+            self.cache.save()
+
+    def replace_file(self, content, path=None):
+        '''
+        This procedure replaces the pg_hba file (or the file at path, like a @file list) with content (bytes).
+        content is written to a temp file in the same folder, which gets the owner and mode of the original file,
+        is synced to disk and then renamed over the original file. The rename is atomic.
+        A file that doesn't exist yet gets the owner and mode of the pg_hba file.
+        When backup is set, the original pg_hba file is kept as a backup (see rotate_backups).
+        '''
+        import tempfile
+        path   = path or self.pg_hba_file
+        folder = os.path.dirname(os.path.abspath(path))
+        try:
+            fstat = original = os.stat(path)
+        except OSError:
+            original = None
+            try:
+                fstat = os.stat(self.pg_hba_file)
+            except OSError:
+                fstat = None
+        filed, tmp_file = tempfile.mkstemp(dir=folder, prefix='.{0}.'.format(os.path.basename(path)))
+        try:
+            with os.fdopen(filed, 'wb') as fileh:
+                fileh.write(content)
+                fileh.flush()
+                if fstat:
+                    #Same ownership and permissions as the original file (as set by touch)
+                    os.fchmod(fileh.fileno(), stat.S_IMODE(fstat.st_mode))
+                    if (fstat.st_uid, fstat.st_gid) != (os.geteuid(), os.getegid()):
+                        os.fchown(fileh.fileno(), fstat.st_uid, fstat.st_gid)
+                os.fsync(fileh.fileno())
+            if original and self.backup and path == self.pg_hba_file:
+                #The original file is not changed by the rename, so it can be kept as backup by a hardlink.
+                with self.stats.phase('backup'):
+                    self.rotate_backups()
+            os.rename(tmp_file, path)
+        except (IOError, OSError) as e:
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
+            raise PgHbaError("Could not write pg_hba file '{0}': {1}".format(path, e))
+        #Also sync the folder, so that the rename itself is on disk
+        try:
+            dird = os.open(folder, os.O_RDONLY)
+            try:
+                os.fsync(dird)
+            finally:
+                os.close(dird)
+        except OSError:
+            pass
+
+    def rotate_backups(self):
+        '''
+        This procedure keeps the current pg_hba file as backup number 1 in the backup folder.
+        Older backups are renamed (1 becomes 2, 2 becomes 3, etc.) and backups after backup_count are removed.
+        The backup is a hardlink to the current file. Only if that is not possible (like for a backup folder on
+        another filesystem), the file is copied.
+        '''
+        import shutil
+        folder = self.backup_dir or os.path.dirname(os.path.abspath(self.pg_hba_file))
+        prefix = os.path.join(folder, os.path.basename(self.pg_hba_file))
+        count  = max(self.backup_count, 1)
+        #Remove the oldest backup(s) and shift the others
+        for i in range(count, 0, -1):
+            backup_file = '{0}.{1}'.format(prefix, i)
+            if not os.path.exists(backup_file):
+                continue
+            if i == count:
+                os.remove(backup_file)
+            else:
+                os.rename(backup_file, '{0}.{1}'.format(prefix, i+1))
+        backup_file = '{0}.1'.format(prefix)
+        try:
+            os.link(self.pg_hba_file, backup_file)
+        except OSError:
+            shutil.copy2(self.pg_hba_file, backup_file)
+        #Print location of backup file
+        print('Backup written to {0}'.format(backup_file))
+
+    def new_rules(self, contype, databases, users, source, netmask, method, options):
+        '''
+        This function creates a new rule that fits to the parsed parameters.
+        '''
+
+        #Check validity of method and contype parameters
+        if method not in PgHbaMethods:
+            raise PgHbaError("invalid method {0} (should be one of '{1}').".format(method, "', '".join(PgHbaMethods)))
+        if contype not in PgHbaTypes:
+            raise PgHbaError("invalid connection type {0} (should be one of '{1}').".format(contype, "', '".join(PgHbaTypes)))
+
+        #Loop through databases (if option was like db1,db2,db3 )
+        #and create a new rule for every database
+        for db in databases.split(','):
+            #Loop through users (if option was like user1,user2,user3 )
+            #and create a new rule for every user
+            for usr in users.split(','):
+                src, mask = source, netmask
+                #Cleanup some weird combinations
+                if contype == 'local':
+                    src, mask = None, None
+                elif '/' in source:
+                    mask = None
+                elif not parse_network(source, netmask):
+                    #Not an ip address (hostname, all, samenet, etc.). A netmask makes no sense.
+                    mask = None
+                elif not netmask:
+                    #Single ip address. Add the prefix for a single ip (/32 for ipv4, /128 for ipv6)
+                    src += '/{0}'.format(parse_network(source).bits)
+                rule = PgHbaRule(contype, db, usr, src, mask, method, options)
+
+                #return a rule per db per user
+                yield rule
+
+    def add_rule(self, rule, shard=None):
+        '''
+        This function adds (or replaces) a new rule.
+        It tries to find original and checks for differences.
+        If original doesn't exist, new rule is added (to the included file shard, when set).
+        If original exists, but differs, it is replaced by the new rule (in the file that has it, see owner_of).
+        '''
+        if isinstance(rule, dict):
+            rule = PgHbaRule.from_dict(rule)
+        owner = self.owner_of(rule.key, shard)
+        if owner is not self:
+            if not owner.add_rule(rule):
+                return False
+            self.shard_keys.setdefault(rule.key, owner)
+            return True
+        return self.add_own_rule(rule)
+
+    def add_own_rule(self, rule):
+        '''
+        This function adds (or replaces) a rule in this file, like add_rule.
+        A rule that replaces another takes its place (its section).
+        '''
+        #First find the key
+        key = rule.key
+        #Try to find the original rule with this key, and check if it is the same
+        oldrule = self.rules.get(key)
+        if oldrule is not None and oldrule == rule:
+            return False
+        if oldrule is not None:
+            rule.section = oldrule.section
+        #Seems that original rule differs from new, or doesn't exist. Add new rule (in its place)
+        self.unindex_rule(key)
+        self.rules[key] = rule
+        self.index_rule(key, rule)
+        #Also tell hba object that it is changed since last reading from or writing to file
+        self.changed = True
+        return True
+
+    def remove_rule(self, rule):
+        '''
+        This procedure finds a rule and removes it from the object.
+        It returns True if the rule was found (and removed), and False otherwise.
+        '''
+        if isinstance(rule, dict):
+            rule = PgHbaRule.from_dict(rule)
+        owner = self.owner_of(rule.key)
+        if owner is not self:
+            if not owner.remove_rule(rule):
+                return False
+            #Another included file can have a rule with the same key
+            del self.shard_keys[rule.key]
+            for shard in self.shards:
+                if rule.key in shard.rules:
+                    self.shard_keys[rule.key] = shard
+                    break
+            return True
+        #First find the key of the rule
+        keys = rule.key
+        try:
+            #Try to remove the rule
+            self.unindex_rule(keys)
+            del self.rules[keys]
+            #Found and removed. Tell hba object that it is changed since last reading from or writing to file
+            self.changed = True
+            return True
+        except:
+            return False
+
+    def apply(self, contype, databases, users, source, netmask, method, options, state='present', users_file='',
+              shard=''):
+        '''
+        This function adds (state present) or removes (state absent) all rules that fit to the parsed parameters.
+        With users_file, the users are kept in that file (see PgHbaList) and the rules have @users_file as user.
+        Then state present adds the users to the file, and state absent removes them. The rules are removed
+        when no users are left in the file (or when users is 'all').
+        With shard (the path of an included file), new rules are added to that file instead of to the pg_hba file.
+        It returns True if this object was changed by it, and False if all rules where already as requested.
+        '''
+        if state not in PgHbaStates:
+            raise PgHbaError("invalid state {0} (should be one of '{1}').".format(state, "', '".join(PgHbaStates)))
+        names = []
+        if users_file:
+            names = [ name for name in users.split(',') if name != 'all' ]
+            if state == 'present' and not names:
+                raise PgHbaError("users_file {0} needs a list of users.".format(users_file))
+            users = '@' + users_file
+        changed = False
+        for rule in self.new_rules(contype, databases, users, source, netmask, method, options):
+            if users_file:
+                members = self.user_list(self.owner_of(rule.key, shard), users_file)
+                if state == "present":
+                    changed = members.add(names) or changed
+                else:
+                    changed = members.remove(names) or changed
+                    if names and members.members:
+                        #There are users left, so the rule stays
+                        continue
+            if state == "present":
+                #Add the rule
+                changed = self.add_rule(rule, shard) or changed
+            else:
+                #Remove the rule
+                changed = self.remove_rule(rule) or changed
+        return changed
+
+    def apply_batch(self, specs):
+        '''
+        This function applies a list of rule specifications (as returned by read_batch) against this object.
+        It returns a list with a result per specification, telling if it changed anything.
+        Nothing is written. Call write() afterwards to write (and reload) once for the complete batch.
+        '''
+        results = []
+        with self.stats.phase('apply'):
+            for spec in specs:
+                result = { 'state': spec['state'] }
+                if 'name' in spec:
+                    result['name'] = spec['name']
+                result['changed'] = self.apply(spec['contype'], spec['databases'], spec['users'], spec['source'],
+                                               spec['netmask'], spec['method'], spec['options'], spec['state'],
+                                               spec.get('users_file'), spec.get('shard'))
+                results.append(result)
+        self.stats.count('specs', len(specs))
+        return results
+
+    def reconcile(self, specs, purge=False):
+        '''
+        This function makes the rules of this object match a complete list of rule specifications
+        (as returned by read_batch). Rules of specs with state present are added or replaced, and rules of
+        specs with state absent are removed (a later specification for the same rule wins).
+        Rules that are in no specification are unmanaged. They are removed if purge is set, and kept otherwise.
+        This includes the rules of included files. New rules are added to the shard of their specification.
+        A @file list of specifications with a users_file is set to the users of the specifications with state present
+        (without those of later specifications with state absent).
+        The difference is found in one pass over the rules of this object.
+        It returns a summary of the difference, as a dict with:
+        - added, updated and removed: the lines of the rules that where added, replaced or removed
+        - lists: the paths of the @file lists that changed
+        - unchanged and unmanaged: the number of rules that where already as specified, and that where kept
+        - changed: True if this object was changed
+        Nothing is written. Call write() afterwards to write (and reload) once.
+        '''
+        desired = {}
+        absent  = set()
+        shards  = {}
+        lists   = {}
+        summary = { 'added': [], 'updated': [], 'removed': [], 'lists': [], 'unchanged': 0, 'unmanaged': 0 }
+        with self.stats.phase('apply'):
+            for spec in specs:
+                if spec['state'] not in PgHbaStates:
+                    raise PgHbaError("invalid state {0} (should be one of '{1}').".format(spec['state'], "', '".join(PgHbaStates)))
+                users, names, shard = spec['users'], [], spec.get('shard')
+                if spec.get('users_file'):
+                    names = [ name for name in users.split(',') if name != 'all' ]
+                    users = '@' + spec['users_file']
+                for rule in self.new_rules(spec['contype'], spec['databases'], users, spec['source'],
+                                           spec['netmask'], spec['method'], spec['options']):
+                    if names:
+                        members = self.user_list(self.owner_of(rule.key, shard), spec['users_file'])
+                        members = lists.setdefault(members.path, (members, set()))[1]
+                        if spec['state'] == 'present':
+                            members.update(names)
+                        else:
+                            members.difference_update(names)
+                            continue
+                    if spec['state'] == 'present':
+                        desired[rule.key] = rule
+                        shards[rule.key] = shard
+                        absent.discard(rule.key)
+                    else:
+                        desired.pop(rule.key, None)
+                        absent.add(rule.key)
+            for key, rule in list(self.graph_items()):
+                new = desired.pop(key, None)
+                if new is None:
+                    if purge or key in absent:
+                        self.remove_rule(rule)
+                        summary['removed'].append(rule.line)
+                    else:
+                        summary['unmanaged'] += 1
+                elif new == rule:
+                    summary['unchanged'] += 1
+                else:
+                    self.add_rule(new)
+                    summary['updated'].append(new.line)
+            #What is left is not in this object yet
+            for key, rule in desired.items():
+                self.add_rule(rule, shards[key])
+                summary['added'].append(rule.line)
+            for path, (members, names) in sorted(lists.items()):
+                if members.set(names):
+                    summary['lists'].append(path)
+        summary['changed'] = bool(summary['added'] or summary['updated'] or summary['removed'] or summary['lists'])
+        self.stats.count('specs', len(specs))
+        for kind in ('added', 'updated', 'removed'):
+            self.stats.set(kind, len(summary[kind]))
+        return summary
+
+    def apply_edit(self, specs, reconcile=False, purge=False):
+        '''
+        This function applies a list of rule specifications (see apply_batch),
+        or reconciles it when reconcile (or purge) is set (see reconcile).
+        '''
+        if reconcile or purge:
+            return self.reconcile(specs, purge)
+        return self.apply_batch(specs)
+
+    def check_batch(self, specs, reconcile=False, purge=False):
+        '''
+        This function checks a list of rule specifications (as returned by read_batch) against this object.
+        It returns the same results as apply_edit would.
+        When compacting or ordering by traffic, every result tells if the file would change,
+        since rules are not written one to one.
+        When a cache is used, and the same specifications where checked against the same file before,
+        the result is returned from the cache, without processing any rule.
+        '''
+        fingerprint = None
+        if self.cache and self.cache.ident:
+            fingerprint = specs_fingerprint([ self.order, self.traffic and self.traffic.signature,
+                                              reconcile or purge, purge ] + specs)
+            #The result also depends on included files and lists, so they should be as they where for the check
+            if fingerprint in self.cache.checks and graph_current(self.cache.graph):
+                self.stats.count('check_cache_hits')
+                return self.cache.checks[fingerprint]
+        results = self.apply_edit(specs, reconcile, purge)
+        if self.reorders and self.pg_hba_file:
+            #Changed rules can compact to the same file (like a network that is part of a merged network),
+            #and unchanged rules can render another file (when the file wasn't compacted or ordered yet). So compare the files.
+            files   = [ self ] + self.shards
+            changed = any( pg_hba.content() != pg_hba.read_file() for pg_hba in files ) or \
+                      any( lst.changed for lst in self.lists.values() )
+            for result in results if isinstance(results, list) else [ results ]:
+                result['changed'] = changed
+            if not changed:
+                #The files are already as they would be written
+                for pg_hba in files:
+                    pg_hba.changed = False
+        if fingerprint:
+            self.cache.set_check(fingerprint, results, self.graph_identity())
+            self.cache.save()
+        return results
+
+    def get_rules(self):
+        '''
+        This function returns a list of all the rules.
+        '''
+        for rule in self.rules.values():
+            #Return a dict with the columns of this rule
+            yield(rule.as_dict())
+
+    def render(self):
+        '''
+        This function returns the contents that the altered pg_hba file should have.
+        '''
+        #First return the comments that where already there, line by line
+        for comment in self.comment:
+            yield(comment)
+        #Then return the rules, rule by rule, with the include directives between their sections
+        section = 0
+        for rule in self.rendered_rules():
+            while section < rule.section:
+                yield(self.includes[section])
+                section += 1
+            yield(rule.line)
+        for line in self.includes[section:]:
+            yield(line)
+
+    def rendered_rules(self, traffic=True):
+        '''
+        This function returns the rules in the order they are rendered in: ordered by weight, compacted
+        when compacting, and ordered by traffic when a traffic file is set (and traffic is True).
+        Rules are never moved past an include directive, so every section is compacted and ordered on its own.
+        '''
+        rules = self.sorted_rules()
+        if not self.compact and not (traffic and self.traffic and self.traffic.hits):
+            return rules
+        if not self.includes:
+            return self.reordered(rules, traffic)
+        ret = []
+        for section, group in itertools.groupby(rules, lambda rule: rule.section):
+            for rule in self.reordered(list(group), traffic):
+                #Compacted rules are new rules
+                rule.section = section
+                ret.append(rule)
+        if self.compact:
+            self.stats.set('compacted_lines', len(self.rules) - len(ret))
+        return ret
+
+    def reordered(self, rules, traffic):
+        '''
+        This function returns rules (in sorted order) compacted when compacting,
+        and ordered by traffic when a traffic file is set (and traffic is True).
+        '''
+        if self.compact:
+            with self.stats.phase('compact'):
+                compactor = PgHbaCompactor(rules)
+                rules = compactor.compact()
+            self.stats.set('compacted_lines', compactor.removed)
+        if traffic and self.traffic and self.traffic.hits:
+            with self.stats.phase('traffic'):
+                rules, moved = self.traffic.reorder(rules)
+            self.stats.set('traffic_moved', moved)
+        return rules
+
+    def graph_rules(self, traffic=True):
+        '''
+        This function returns the rules of this file and the files it includes in the order postgres reads them:
+        the rules of an included file take the place of its include directive (see rendered_rules).
+        '''
+        if not self.includes or self.source is not None:
+            return self.rendered_rules(traffic)
+        self.shards
+        rules = []
+        self.flatten(self, traffic, rules)
+        return rules
+
+    def flatten(self, pg_hba, traffic, rules):
+        '''
+        This procedure adds the rendered rules of pg_hba to rules, with those of the files it includes in their place.
+        The source of every rule is set to the file it is in.
+        '''
+        section = 0
+        for rule in list(pg_hba.rendered_rules(traffic)) + [ None ]:
+            last = len(pg_hba.included) if rule is None else rule.section
+            while section < last:
+                for path in pg_hba.included[section]:
+                    self.flatten(self.shard_files[path], traffic, rules)
+                section += 1
+            if rule is not None:
+                rule.source = pg_hba.source
+                rules.append(rule)
+
+    def count_traffic(self, paths, members=None, server_networks=None):
+        '''
+        This function counts connections per rule in log files of postgres, and keeps the counts in the traffic file.
+        It returns the number of connections, and the average number of lines scanned per connection
+        in the order without and with ordering by traffic.
+        '''
+        if not self.traffic:
+            #Count without keeping the counts
+            self.traffic = PgHbaTraffic()
+            for shard in self._shards or []:
+                shard.traffic = self.traffic
+        rules = list(self.graph_rules(traffic=False))
+        with self.stats.phase('count'):
+            count = self.traffic.count_logs(paths, self.matcher(members, server_networks, rules))
+        self.traffic.save()
+        before = self.traffic.scanned(rules)
+        #Every file (and every section of a file) is ordered by traffic on its own
+        after = self.traffic.scanned(self.graph_rules())
+        self.stats.set('connections', count)
+        return count, before, after
+
+    def index_rule(self, key, rule):
+        '''
+        This function adds a rule to the indexes.
+        The weights of the rule are calculated once, and kept until the rule is removed.
+        As long as there are no indexes (when nothing was rendered yet), nothing is calculated.
+        '''
+        if not self.indexes:
+            return
+        weights = rule.weights = self.rule2weights(rule)
+        #Rules are sorted within their section. The key keeps items with the same weight unique (and in a fixed order).
+        for order, index in self.indexes.items():
+            index.add(((rule.section, ) + order_weight(weights, order), key))
+
+    def unindex_rule(self, key):
+        '''
+        This function removes a rule from the indexes.
+        '''
+        rule = self.rules.get(key)
+        if rule is None or rule.weights is None:
+            return
+        weights = rule.weights
+        for order, index in self.indexes.items():
+            index.remove(((rule.section, ) + order_weight(weights, order), key))
+
+    def sorted_rules(self, order=None):
+        '''
+        This function returns the rules sorted by section and weight for the order setting of this object (or order if set).
+        There is an index per order setting. It is created when it is used for the first time,
+        and after that it is kept up to date by add_rule and remove_rule. So no sorting is required after that.
+        '''
+        order = order or self.order
+        if order not in self.indexes:
+            with self.stats.phase('sort'):
+                for rule in self.rules.values():
+                    if rule.weights is None:
+                        rule.weights = self.rule2weights(rule)
+                items = [ ((rule.section, ) + order_weight(rule.weights, order), key) for key, rule in self.rules.items() ]
+                self.indexes[order] = SortedIndex(items)
+        for weight, key in self.indexes[order]:
+            yield self.rules[key]
+
+    def matcher(self, members=None, server_networks=None, rules=None):
+        '''
+        This function returns a PgHbaMatcher, to find the rule that postgres would use for connections
+        (with the rules of this file and included files in rendered order, or rules if set).
+        '''
+        include_dir = os.path.dirname(os.path.abspath(self.pg_hba_file)) if self.pg_hba_file else '.'
+        return PgHbaMatcher(self.graph_rules() if rules is None else rules, members, server_networks, include_dir)
+
+    def analyze(self):
+        '''
+        This function returns shadowed, duplicate and redundant rules (of this file and included files),
+        in the order the rules are rendered in. See PgHbaAnalyzer.
+        '''
+        return PgHbaAnalyzer(self.graph_rules()).findings()
+
+'''
+These are items of the database and user columns that can match other names than their own (like a user called
+the same as the database for sameuser, or members of a group for +group). When it is not known which names they
+match, the analyzer considers them to match anything for overlaps, and only themselves for coverage.
+'''
+PgHbaWildItems = ('sameuser', 'samerole', 'samegroup')
+
+'''
+This function returns True if the items (of a database or user column) of a rule match every name
+that the other items match. 'all' matches every name, except 'replication' for databases.
+'''
+def items_cover(items, other):
+    if 'all' in items:
+        return 'replication' not in other or 'replication' in items
+    return other <= items
+
+'''
+This function returns True if the items (of a database or user column) of two rules can match the same name.
+'''
+def items_overlap(items, other):
+    if items & other:
+        return True
+    for a, b in ((items, other), (other, items)):
+        if 'all' in a and b - set(['replication']):
+            return True
+        if any( i in PgHbaWildItems or i[0] in '+@' for i in a ):
+            return True
+    return False
+
+'''
+This class holds the rules with one outcome (method and options) for PgHbaAnalyzer, by where they could overlap:
+- nets has rules by the key of their network (see PgHbaAnalyzer.net_key)
+- ranges has per family a list of (network, position), for rules with a network contained in a range
+- locals, hosts and others have local rules, host rules and host rules with a source that is no ip address,
+  by database item (see add_by_db)
+'''
+class PgHbaOverlapIndex(object):
+    def __init__(self):
+        self.nets   = {}
+        self.ranges = {}
+        self.locals = {}
+        self.hosts  = {}
+        self.others = {}
+
+    def add(self, pos, rule, net, key, dbs):
+        self.nets.setdefault(key, []).append(pos)
+        if rule.type == 'local':
+            self.add_by_db(self.locals, dbs, pos)
+        else:
+            self.add_by_db(self.hosts, dbs, pos)
+            if net:
+                self.ranges.setdefault(net.family, []).append((net.network, pos))
+            else:
+                self.add_by_db(self.others, dbs, pos)
+
+    def add_by_db(self, index, dbs, pos):
+        '''
+        This procedure adds a rule to an index by database item. Rules for 'all' (or an item that can match any
+        database) are kept under '*'. Under None, all rules of the index are kept.
+        '''
+        index.setdefault(None, []).append(pos)
+        if 'all' in dbs or any( db in PgHbaWildItems or db[0] == '@' for db in dbs ):
+            index.setdefault('*', []).append(pos)
+        else:
+            for db in dbs:
+                index.setdefault(db, []).append(pos)
+
+    def by_db(self, index, dbs):
+        '''
+        This function returns the lists of an index by database item with all rules that could overlap with dbs.
+        '''
+        if 'all' in dbs or any( db in PgHbaWildItems or db[0] == '@' for db in dbs ):
+            return [ index.get(None, []) ]
+        return [ index.get(db, []) for db in dbs ] + [ index.get('*', []) ]
+
+'''
+This class finds rules that have no effect in a list of rules, in the order they are rendered in (first match wins):
+- shadowed: an earlier rule matches every connection this rule matches, so this rule is never used
+- duplicate: an earlier rule matches exactly the same connections
+- redundant: a later rule with the same method and options matches every connection this rule matches,
+  and no rule in between matches any of them with another method or options. Removing it changes nothing.
+
+To stay fast for large files, rules are not compared to every other rule. Instead there are indexes:
+- cover_index finds rules that can cover a rule, by the key of every network (prefix) that contains its source,
+  combined with the database and user items of the rule (or 'all').
+- overlap_index finds rules that could overlap with a rule. For a rule, only rules with another outcome
+  (method and options) are relevant, so there is an index per outcome (see PgHbaOverlapIndex).
+All lists in the indexes hold positions in rendered order, so they are sorted.
+'''
+class PgHbaAnalyzer(object):
+    def __init__(self, rules):
+        self.rules   = list(rules)
+        self.nets    = []
+        self.items   = []
+        self.cover_index = {}
+        self.overlap_index = {}
+        self.prefixes = { 4: set(), 6: set() }
+        for pos, rule in enumerate(self.rules):
+            net = parse_network(rule.src, rule.mask) if rule.type != 'local' else None
+            self.nets.append(net)
+            dbs, usrs = frozenset(rule.db.split(',')), frozenset(rule.usr.split(','))
+            self.items.append((dbs, usrs))
+            key = self.net_key(pos)
+            for db in dbs:
+                for usr in usrs:
+                    self.cover_index.setdefault((key, db, usr), []).append(pos)
+            if net:
+                self.prefixes[net.family].add(net.prefix)
+            outcome = (rule.method, rule.options)
+            if outcome not in self.overlap_index:
+                self.overlap_index[outcome] = PgHbaOverlapIndex()
+            self.overlap_index[outcome].add(pos, rule, net, key, dbs)
+        for index in self.overlap_index.values():
+            index.ranges = dict( (family, sorted(starts)) for family, starts in index.ranges.items() )
+
+    def net_key(self, pos, prefix=None):
+        '''
+        This function returns the key of the network of a rule (or of the network with prefix that contains it).
+        '''
+        rule, net = self.rules[pos], self.nets[pos]
+        if rule.type == 'local':
+            return ('local', )
+        elif not net:
+            return ('src', rule.src)
+        if prefix is None:
+            prefix = net.prefix
+        return (net.family, prefix, net.addr >> (net.bits - prefix))
+
+    def covering_keys(self, pos):
+        '''
+        This function returns the keys of all networks that could contain the source of a rule.
+        '''
+        rule, net = self.rules[pos], self.nets[pos]
+        if rule.type == 'local':
+            return [ ('local', ) ]
+        keys = [ ('src', 'all') ]
+        if net:
+            keys += [ self.net_key(pos, p) for p in self.prefixes[net.family] if p <= net.prefix ]
+        elif rule.src != 'all':
+            keys.append(('src', rule.src))
+        return keys
+
+    def covers(self, a, b):
+        '''
+        This function returns True if rule a matches every connection rule b matches.
+        '''
+        ra, rb = self.rules[a], self.rules[b]
+        if ra.type != rb.type and not (ra.type == 'host' and rb.type != 'local'):
+            return False
+        if ra.type != 'local' and ra.src != 'all':
+            na, nb = self.nets[a], self.nets[b]
+            if na and nb:
+                if not na.contains(nb):
+                    return False
+            elif na or nb or ra.src != rb.src:
+                return False
+        (dba, usra), (dbb, usrb) = self.items[a], self.items[b]
+        return items_cover(dba, dbb) and items_cover(usra, usrb)
+
+    def overlaps(self, a, b):
+        '''
+        This function returns True if rules a and b could both match the same connection.
+        Sources that are no ip address (like hostnames) are considered to overlap with every source.
+        '''
+        ra, rb = self.rules[a], self.rules[b]
+        if (ra.type == 'local') != (rb.type == 'local'):
+            return False
+        if ra.type != rb.type and 'host' not in (ra.type, rb.type):
+            return False
+        na, nb = self.nets[a], self.nets[b]
+        if na and nb and not (na.contains(nb) or nb.contains(na)):
+            return False
+        (dba, usra), (dbb, usrb) = self.items[a], self.items[b]
+        return items_overlap(dba, dbb) and items_overlap(usra, usrb)
+
+    def cover_candidates(self, pos):
+        '''
+        This function yields the lists (from cover_index) with positions of rules that could cover a rule.
+        '''
+        dbs, usrs = self.items[pos]
+        #A rule that covers this rule has all of its items, or 'all'. Replication is not part of 'all'.
+        db_items  = [ 'replication' ] if 'replication' in dbs else [ 'all', min(dbs) ]
+        usr_items = [ 'all', min(usrs) ]
+        for key in self.covering_keys(pos):
+            for db in db_items:
+                for usr in usr_items:
+                    positions = self.cover_index.get((key, db, usr))
+                    if positions:
+                        yield positions
+
+    def first_cover(self, pos, after=False):
+        '''
+        This function returns the position of the first rule that covers a rule, before it (or after it if after is set).
+        It returns None if there is no such rule.
+        '''
+        found = None
+        for positions in self.cover_candidates(pos):
+            if after:
+                candidates = positions[bisect.bisect_right(positions, pos):]
+            else:
+                candidates = positions[:bisect.bisect_left(positions, pos)]
+            for other in candidates:
+                if found is not None and other >= found:
+                    break
+                if other != pos and self.covers(other, pos):
+                    found = other
+                    break
+        return found
+
+    def between(self, pos, start, end, same=False):
+        '''
+        This function yields the positions of rules between start and end (exclusive) with another outcome
+        than a rule (or also with the same outcome if same is set), that could overlap with it.
+        '''
+        rule, net = self.rules[pos], self.nets[pos]
+        dbs = self.items[pos][0]
+        if net:
+            containing = [ self.net_key(pos, p) for p in self.prefixes[net.family] if p < net.prefix ]
+        for outcome, index in self.overlap_index.items():
+            if outcome == (rule.method, rule.options) and not same:
+                continue
+            if rule.type == 'local':
+                lists = index.by_db(index.locals, dbs)
+            elif not net:
+                lists = index.by_db(index.hosts, dbs)
+            else:
+                lists = index.by_db(index.others, dbs)
+                lists += [ index.nets.get(key, []) for key in containing ]
+                #Networks contained in this network start within its range
+                ranges = index.ranges.get(net.family, [])
+                first  = bisect.bisect_left(ranges, (net.network, -1))
+                last   = bisect.bisect_right(ranges, (net.network + (1 << (net.bits - net.prefix)) - 1, len(self.rules)))
+                for n, other in ranges[first:last]:
+                    if start < other < end:
+                        yield other
+            for positions in lists:
+                for other in positions[bisect.bisect_right(positions, start):bisect.bisect_left(positions, end)]:
+                    yield other
+
+    def findings(self):
+        '''
+        This function returns a list of findings. Every finding is a dict with
+        kind (shadowed, duplicate or redundant), rule and lineno of the rule, and by and by_lineno of the other rule.
+        For rules of included files, file (or by_file) is the path of that file.
+        '''
+        findings = []
+        for kind, pos, other in self.scan():
+            rule, by = self.rules[pos], self.rules[other]
+            finding = { 'kind': kind, 'rule': rule.line, 'lineno': rule.lineno, 'by': by.line, 'by_lineno': by.lineno }
+            #Rules of included files tell which file they are in
+            if rule.source:
+                finding['file'] = rule.source
+            if by.source:
+                finding['by_file'] = by.source
+            findings.append(finding)
+        return findings
+
+    def scan(self):
+        '''
+        This function yields a tuple of (kind, position, position of the other rule) for every rule without effect.
+        '''
+        for pos, rule in enumerate(self.rules):
+            other = self.first_cover(pos)
+            if other is not None:
+                kind = 'duplicate' if self.covers(pos, other) else 'shadowed'
+            else:
+                other = self.first_cover(pos, after=True)
+                if other is None:
+                    continue
+                by = self.rules[other]
+                outcome = (rule.method, rule.options)
+                if (by.method, by.options) != outcome:
+                    continue
+                if any( self.overlaps(pos, x) for x in self.between(pos, pos, other) ):
+                    continue
+                kind = 'redundant'
+            yield kind, pos, other
+
+'''
+This function returns True if two rules could both match the same connection (like PgHbaAnalyzer.overlaps).
+'''
+def rules_overlap(ra, rb):
+    if (ra.type == 'local') != (rb.type == 'local'):
+        return False
+    if ra.type != rb.type and 'host' not in (ra.type, rb.type):
+        return False
+    if ra.type != 'local':
+        na, nb = parse_network(ra.src, ra.mask), parse_network(rb.src, rb.mask)
+        if na and nb and not (na.contains(nb) or nb.contains(na)):
+            return False
+    return (items_overlap(set(ra.db.split(',')), set(rb.db.split(','))) and
+            items_overlap(set(ra.usr.split(',')), set(rb.usr.split(','))))
+
+'''
+This class compacts a list of rules (in the order they are rendered in), without changing which connections
+are allowed with which method. It removes lines in three ways:
+- rules without effect (shadowed, duplicate or redundant, see PgHbaAnalyzer) are dropped
+- rules that only differ in database (or user) are folded into one rule with a list (like db1,db2)
+- rules for sibling networks (like 10.0.0.0/25 and 10.0.0.128/25) that are the same otherwise are merged into
+  one rule for their supernet (10.0.0.0/24)
+A fold or merge moves the connections of the later rule up to the place of the earlier rule. That is only done
+if no rule in between could match any of those connections with another method or options.
+Rules are folded and merged in one pass, so this is checked against the compacted list so far (done), which holds
+exactly the rules that end up in between. To find those rules fast, there is an index per outcome (method and options)
+with positions in done by database item (like PgHbaOverlapIndex.add_by_db).
+'''
+class PgHbaCompactor(object):
+    def __init__(self, rules):
+        self.rules   = list(rules)
+        self.removed = 0
+
+    def compact(self):
+        '''
+        This function returns the compacted list of rules. The number of lines removed is kept in removed.
+        '''
+        rules = self.drop(self.rules)
+        rules = self.fold(rules, 'db')
+        rules = self.fold(rules, 'usr')
+        rules = self.drop(self.merge(rules))
+        self.removed = len(self.rules) - len(rules)
+        return rules
+
+    def drop(self, rules):
+        '''
+        This function returns rules without the rules that have no effect.
+        Dropping rules can leave other rules without effect, so this is repeated until nothing is dropped.
+        '''
+        while True:
+            dropped = set( pos for kind, pos, other in PgHbaAnalyzer(rules).scan() )
+            if not dropped:
+                return rules
+            rules = [ rule for pos, rule in enumerate(rules) if pos not in dropped ]
+
+    def start(self):
+        #Reset the compacted list and its index
+        self.done  = []
+        self.index = {}
+
+    def add(self, rule):
+        '''
+        This function adds a rule to the end of the compacted list, and returns its position.
+        '''
+        self.done.append(rule)
+        pos = len(self.done) - 1
+        self.index.setdefault((rule.method, rule.options), {}).setdefault(None, []).append(pos)
+        self.index_items(pos, rule.db.split(','))
+        return pos
+
+    def index_items(self, pos, dbs):
+        '''
+        This procedure adds the position of a rule to the index, for database items dbs.
+        Items that can match any database are kept under '*', and under None all positions are kept.
+        Folding adds items to a rule that is already in the list, so positions are inserted in order.
+        '''
+        rule  = self.done[pos]
+        index = self.index[(rule.method, rule.options)]
+        for db in dbs:
+            if db == 'all' or db in PgHbaWildItems or db[0] == '@':
+                db = '*'
+            positions = index.setdefault(db, [])
+            i = bisect.bisect_left(positions, pos)
+            if i == len(positions) or positions[i] != pos:
+                positions.insert(i, pos)
+
+    def moves_safely(self, start, rule):
+        '''
+        This function returns True if the connections of rule can be moved up to position start in the compacted list.
+        That is when no rule after start could match any of them with another outcome.
+        '''
+        dbs = rule.db.split(',')
+        for outcome, index in self.index.items():
+            if outcome == (rule.method, rule.options):
+                continue
+            if any( db == 'all' or db in PgHbaWildItems or db[0] == '@' for db in dbs ):
+                lists = [ index.get(None, []) ]
+            else:
+                lists = [ index.get(db, []) for db in dbs ] + [ index.get('*', []) ]
+            for positions in lists:
+                for pos in positions[bisect.bisect_right(positions, start):]:
+                    other = self.done[pos]
+                    if other is not None and rules_overlap(other, rule):
+                        return False
+        return True
+
+    def fold(self, rules, column):
+        '''
+        This function folds rules that only differ in column (db or usr) into one rule with a list.
+        '''
+        self.start()
+        groups = {}
+        for rule in rules:
+            if column == 'db':
+                group = (rule.type, rule.key[0], rule.usr, rule.method, rule.options)
+            else:
+                group = (rule.type, rule.key[0], rule.db, rule.method, rule.options)
+            pos = groups.get(group)
+            if pos is None or not self.moves_safely(pos, rule):
+                groups[group] = self.add(rule)
+                continue
+            #Fold into the earlier rule
+            first = self.done[pos]
+            items = getattr(first, column).split(',')
+            new   = [ item for item in getattr(rule, column).split(',') if item not in items ]
+            columns = dict(zip(PgHbaHDR, first.columns()))
+            columns[column] = ','.join(items + new)
+            self.done[pos] = PgHbaRule.from_dict(columns)
+            if column == 'db':
+                self.index_items(pos, new)
+        return self.done
+
+    def merge(self, rules):
+        '''
+        This function merges rules for sibling networks into a rule for their supernet.
+        The supernet can have a sibling itself, so merging goes on until there is no sibling to merge with.
+        '''
+        self.start()
+        groups = {}
+        for rule in rules:
+            net = parse_network(rule.src, rule.mask) if rule.type != 'local' else None
+            if not net or net.addr != net.network:
+                #Not a network (or a network with host bits set, which is better left alone)
+                self.add(rule)
+                continue
+            at = None
+            while net.prefix > 0:
+                group = (rule.type, rule.db, rule.usr, rule.method, rule.options, net.family, net.prefix)
+                pos = groups.get(group + (net.network ^ (1 << (net.bits - net.prefix)), ))
+                if pos is None:
+                    break
+                #The part at the later position moves up to the earlier position
+                if at is None or pos < at:
+                    first, later = pos, rule
+                else:
+                    first, later = at, self.done[pos]
+                if not self.moves_safely(first, later):
+                    break
+                del groups[group + (net.network ^ (1 << (net.bits - net.prefix)), )]
+                if at is not None:
+                    del groups[group + (net.network, )]
+                    self.done[at] = None
+                self.done[pos] = None
+                net  = IPNetwork(net.family, net.network & ~(1 << (net.bits - net.prefix)), net.prefix - 1)
+                rule = PgHbaRule(rule.type, rule.db, rule.usr, str(net), None, rule.method, rule.options)
+                at   = first
+                self.done[at] = rule
+                groups[group[:-1] + (net.prefix, net.network)] = at
+            if at is None:
+                group = (rule.type, rule.db, rule.usr, rule.method, rule.options, net.family, net.prefix, net.network)
+                groups[group] = self.add(rule)
+        return [ rule for rule in self.done if rule is not None ]
+
+'''
+These regular expressions find connections in the log of postgres (with log_connections on, see logging.conf):
+- log_authorized_re: 'connection authorized: user=app database=app SSL enabled (...)'
+  (or 'replication connection authorized: user=rep')
+- log_refused_re: 'no pg_hba.conf entry for host "10.0.0.1", user "app", database "app", SSL off'
+  and 'pg_hba.conf rejects connection for host ...' (and the same for replication connections)
+- log_received_re: 'connection received: host=10.0.0.1 port=5432', to find the address by process id
+  when it is not in the log_line_prefix (ip:%h) of the line that authorized the connection
+- log_ip_re and log_pid_re find address and process id in the log_line_prefix (or the pid of a syslog line)
+'''
+log_authorized_re = LazyRegex(r'(replication )?connection authorized: user=(\S+)(?: database=(\S+))?(.*)')
+log_refused_re    = LazyRegex(r'(?:no pg_hba\.conf entry for|pg_hba\.conf rejects)( replication)?(?: connection)?(?: from| for)? '
+                               r'host "([^"]*)", user "([^"]*)"(?:, database "([^"]*)")?(, SSL on)?')
+log_received_re   = LazyRegex(r'connection received: host=(\S+)')
+log_ip_re         = LazyRegex(r'\bip:(\S*)')
+log_pid_re        = LazyRegex(r'\bpid:(\d+)|\w\[(\d+)\]:')
+
+'''
+This class orders rules by traffic: how often every rule matched a connection, as counted from the log of postgres.
+Rules that match most connections are moved up, so that postgres finds them after scanning less lines.
+A rule is only moved up past rules it cannot overlap with (see PgHbaAnalyzer.overlaps), so every connection
+is still matched by exactly the same rule.
+
+The number of matches is kept by rule line in a json file (path), so that the next render uses the same order.
+Counts from new logs are added to it. Remove the file to start counting over.
+'''
+class PgHbaTraffic(object):
+    def __init__(self, path=None):
+        self.path      = path
+        self.hits      = {}
+        self.unmatched = 0
+        self.signature = None
+        self.file_stat = None
+        if path:
+            self.load()
+
+    def load(self):
+        self.file_stat = stat_identity(self.path)
+        try:
+            with open(self.path, 'rb') as f:
+                content = f.read()
+        except (IOError, OSError):
+            return
+        try:
+            data = json.loads(content.decode('utf-8'))
+        except ValueError:
+            raise PgHbaError("traffic file '{0}' is not valid json.".format(self.path))
+        self.hits      = dict( (native_str(line), count) for line, count in data.get('hits', {}).items() )
+        self.unmatched = data.get('unmatched', 0)
+        #Checks against the file depend on the order, so the cache needs to know which counts where used
+        self.signature = hashlib.sha1(content).hexdigest()
+
+    def save(self):
+        '''
+        This procedure writes the counts to the json file (through a temp file and rename).
+        '''
+        import tempfile
+        if not self.path:
+            return
+        content = json.dumps({ 'hits': self.hits, 'unmatched': self.unmatched }, sort_keys=True).encode('utf-8')
+        filed, path = tempfile.mkstemp(prefix='.pg_hba_traffic', dir=os.path.dirname(os.path.abspath(self.path)))
+        with os.fdopen(filed, 'wb') as f:
+            f.write(content)
+        os.rename(path, self.path)
+        self.signature = hashlib.sha1(content).hexdigest()
+        self.file_stat = stat_identity(self.path)
+
+    def read_log(self, path):
+        '''
+        This function yields the lines of a log file ('-' for stdin). Rotated logs can be gzipped.
+        '''
+        if path == '-':
+            for line in sys.stdin:
+                yield line
+            return
+        if path.endswith('.gz'):
+            import gzip
+            f = gzip.open(path, 'rt') if sys.version_info[0] > 2 else gzip.open(path)
+        else:
+            f = open(path)
+        with f:
+            for line in f:
+                yield line
+
+    def connections(self, lines):
+        '''
+        This function yields a tuple of (contype, database, user, address) for every connection in log lines.
+        contype is local, hostssl or host (like for PgHbaMatcher.match).
+        '''
+        addresses = {}
+        for line in lines:
+            if 'connection' not in line and 'pg_hba.conf' not in line:
+                continue
+            pid = log_pid_re.search(line)
+            pid = pid and (pid.group(1) or pid.group(2))
+            match = log_received_re.search(line)
+            if match:
+                addresses[pid] = match.group(1)
+                continue
+            match = log_authorized_re.search(line)
+            if match:
+                replication, user, database, rest = match.groups()
+                address = log_ip_re.search(line)
+                address = address.group(1) if address else addresses.pop(pid, None)
+                ssl = 'SSL enabled' in rest
+            else:
+                match = log_refused_re.search(line)
+                if not match:
+                    continue
+                replication, address, user, database, ssl = match.groups()
+            if replication:
+                database = 'replication'
+            if not address or address == '[local]':
+                yield 'local', database, user, None
+            else:
+                yield 'hostssl' if ssl else 'host', database, user, address
+
+    def count_logs(self, paths, matcher):
+        '''
+        This function counts the rule (of matcher) that matches every connection in log files, and adds the counts
+        to hits. It returns the number of connections.
+        '''
+        count = 0
+        for path in paths:
+            for contype, database, user, address in self.connections(self.read_log(path)):
+                rule = matcher.match(contype, database, user, address)
+                if rule:
+                    self.hits[rule.line] = self.hits.get(rule.line, 0) + 1
+                else:
+                    self.unmatched += 1
+                count += 1
+        return count
+
+    def scanned(self, rules):
+        '''
+        This function returns the average number of lines postgres scans per connection (for the counted connections)
+        with rules in this order. A connection without a rule scans all lines.
+        '''
+        rules = list(rules)
+        total = self.unmatched
+        lines = self.unmatched * len(rules)
+        for pos, rule in enumerate(rules):
+            hits = self.hits.get(rule.line, 0)
+            total += hits
+            lines += hits * (pos + 1)
+        return float(lines) / total if total else 0.0
+
+    def reorder(self, rules):
+        '''
+        This function returns rules (in rendered order) ordered by traffic, and the number of rules moved up.
+        Rules without hits keep their order. A rule with hits moves up past rules with less hits, but never past
+        a rule that it could overlap with (which must stay before it).
+        Rules with hits are kept in slots: the rules in slot c come right after the rule without hits at position c
+        (slot -1 is the start). Rules are placed one by one, in rendered order, in the first slot that has no rule with
+        as many hits or an overlapping rule after it, after the last of those rules in that slot.
+        '''
+        rules = list(rules)
+        hits  = [ self.hits.get(rule.line, 0) for rule in rules ]
+        if not any(hits):
+            return rules, 0
+        analyzer = PgHbaAnalyzer(rules)
+        slots = {}
+        slot_of = {}
+        #Last slot with a rule for every number of hits
+        last_slot = {}
+        cold  = -1
+        moved = 0
+        for pos, rule in enumerate(rules):
+            if not hits[pos]:
+                cold = pos
+                continue
+            #Rules with as many hits stay before this rule
+            slot = max([ slot_of[other] for other in self.hotter(last_slot, hits[pos]) ] + [ -1 ])
+            #And so do overlapping rules. A rule is never in a slot after its position, so check from the last
+            #rule down, and stop at the slot found so far.
+            for other in sorted(set(analyzer.between(pos, -1, pos, same=True)), reverse=True):
+                if other <= slot:
+                    break
+                if slot_of.get(other, other) > slot and analyzer.overlaps(pos, other):
+                    slot = slot_of.get(other, other)
+            slot_rules = slots.setdefault(slot, [])
+            at = len(slot_rules)
+            while at > 0 and hits[slot_rules[at-1]] < hits[pos] and not analyzer.overlaps(pos, slot_rules[at-1]):
+                at -= 1
+            if slot != cold or at < len(slot_rules):
+                moved += 1
+            slot_rules.insert(at, pos)
+            slot_of[pos] = slot
+            if slot >= slot_of.get(last_slot.get(hits[pos]), -1):
+                last_slot[hits[pos]] = pos
+        order = slots.get(-1, [])[:]
+        for pos in range(len(rules)):
+            if not hits[pos]:
+                order.append(pos)
+                order.extend(slots.get(pos, []))
+        return [ rules[pos] for pos in order ], moved
+
+    def hotter(self, last_slot, hits):
+        '''
+        This function yields the rule in the last slot for every number of hits that is at least hits.
+        '''
+        for count, pos in last_slot.items():
+            if count >= hits:
+                yield pos
+
+'''
+This function splits a database or user column of a rule into its items, as a list of tuples (keyword, name):
+- keywords (like all, sameuser, replication) become (keyword, None)
+- names become (None, name). Quotes are removed from quoted names (a quoted keyword is just a name).
+- group names (+group) become ('+', group), and files with names (@file) become ('@', file)
+'''
+def column_items(column):
+    items = []
+    for item in column.split(','):
+        if item[0] == '"':
+            items.append((None, item[1:-1].replace('""', '"')))
+        elif item in ('all', 'sameuser', 'samerole', 'samegroup', 'replication'):
+            items.append((item, None))
+        elif item[0] in '+@':
+            items.append((item[0], item[1:]))
+        else:
+            items.append((None, item))
+    return items
+
+'''
+This class finds the rule that postgres would use for a connection (first match in the rendered order).
+Connections are tuples of (contype, database, user, address):
+- contype is 'local', 'hostssl' (ssl connection over tcp) or 'host' / 'hostnossl' (connection over tcp without ssl)
+- database is the name of the database, or 'replication' for a (physical) replication connection
+- address is the ip address of the client (not used for local connections)
+Some items need information from outside the file, which can be set when creating the object:
+- members is a dict of role name to the names of its members, for +group and samerole
+- server_networks is a list of networks (like '192.168.0.10/24') of the server itself, for samehost and samenet
+Without this information, these items don't match. Sources with a hostname never match, since that requires dns.
+
+Rules are found through an index by network, then database item, then user item:
+- the network key is the key of the network (prefix) of the source (like PgHbaAnalyzer.net_key).
+  For an address, only the keys for the prefixes that are used in the file are looked up.
+- the item is the name, the keyword 'all' (or 'replication'), or '*' for rules with an item that needs more checks.
+Every list in the index holds positions in rendered order, so the first match in a list is the first match there.
+'''
+class PgHbaMatcher(object):
+    #Maximum number of answers to remember (connections in audits repeat a lot)
+    max_memo = 100000
+
+    def __init__(self, rules, members=None, server_networks=None, include_dir='.'):
+        self.rules     = list(rules)
+        self.members   = dict( (role, set(names)) for role, names in (members or {}).items() )
+        self.server_networks = [ parse_network(n) for n in server_networks or [] ]
+        self.include_dir = include_dir
+        self.items     = []
+        self.index     = {}
+        self.prefixes  = { 4: set(), 6: set() }
+        self.memo      = {}
+        self.files     = {}
+        for pos, rule in enumerate(self.rules):
+            dbs, usrs = column_items(rule.db), column_items(rule.usr)
+            if rule.source:
+                #@file items of an included file are relative to the folder of that file
+                folder = os.path.dirname(rule.source)
+                dbs  = [ (k, os.path.join(folder, n) if k == '@' else n) for k, n in dbs ]
+                usrs = [ (k, os.path.join(folder, n) if k == '@' else n) for k, n in usrs ]
+            self.items.append((dbs, usrs))
+            if rule.type == 'local':
+                net, key = None, ('local', )
+            else:
+                net = parse_network(rule.src, rule.mask)
+                if net:
+                    self.prefixes[net.family].add(net.prefix)
+                    key = (net.family, net.prefix, net.addr >> (net.bits - net.prefix))
+                else:
+                    key = ('src', rule.src)
+            node = self.index.setdefault(key, {})
+            for db in set( self.index_item(item) for item in dbs ):
+                for usr in set( self.index_item(item) for item in usrs ):
+                    node.setdefault(db, {}).setdefault(usr, []).append(pos)
+        self.prefixes = dict( (family, sorted(prefixes)) for family, prefixes in self.prefixes.items() )
+
+    def index_item(self, item):
+        '''
+        This function returns the item a database or user item is kept under in the index.
+        '''
+        keyword, name = item
+        if keyword in ('all', 'replication'):
+            return keyword
+        elif keyword:
+            return '*'
+        return name
+
+    def net_keys(self, contype, parsed):
+        '''
+        This function returns the network keys of all rules that could match the source of a connection
+        (with parsed the address of the connection, as returned by parse_address).
+        '''
+        if contype == 'local':
+            return [ ('local', ) ]
+        keys = [ ('src', 'all') ]
+        if self.server_networks:
+            keys += [ ('src', 'samehost'), ('src', 'samenet') ]
+        if parsed:
+            family, addr = parsed
+            bits = 32 if family == 4 else 128
+            keys += [ (family, prefix, addr >> (bits - prefix)) for prefix in self.prefixes[family] ]
+        return keys
+
+    def match(self, contype, database, user, address=None):
+        '''
+        This function returns the first rule that matches a connection, or None if no rule matches
+        (then postgres rejects the connection).
+        '''
+        query = (contype, database, user, address)
+        try:
+            return self.memo[query]
+        except KeyError:
+            pass
+        if contype not in PgHbaTypes:
+            raise PgHbaError("invalid connection type '{0}' (should be one of '{1}').".format(contype, "', '".join(PgHbaTypes)))
+        parsed    = parse_address(address) if address and contype != 'local' else None
+        db_items  = [ 'replication' ] if database == 'replication' else [ database, 'all', '*' ]
+        usr_items = [ user, 'all', '*' ]
+        found = None
+        for key in self.net_keys(contype, parsed):
+            node = self.index.get(key)
+            if not node:
+                continue
+            for db in db_items:
+                usr_node = node.get(db)
+                if not usr_node:
+                    continue
+                for usr in usr_items:
+                    for pos in usr_node.get(usr, ()):
+                        if found is not None and pos >= found:
+                            break
+                        if self.matches(pos, contype, database, user, parsed):
+                            found = pos
+                            break
+        rule = self.rules[found] if found is not None else None
+        if len(self.memo) >= self.max_memo:
+            self.memo.clear()
+        self.memo[query] = rule
+        return rule
+
+    def matches(self, pos, contype, database, user, parsed):
+        '''
+        This function returns True if a rule matches a connection (all columns are checked).
+        parsed is the address of the connection, as returned by parse_address.
+        '''
+        rule = self.rules[pos]
+        if rule.type != contype and not (rule.type == 'host' and contype != 'local') and \
+           not (rule.type == 'hostnossl' and contype == 'host'):
+            return False
+        if rule.type != 'local' and not self.source_matches(rule, parsed):
+            return False
+        dbs, usrs = self.items[pos]
+        return self.db_matches(dbs, database, user) and self.user_matches(usrs, user)
+
+    def source_matches(self, rule, parsed):
+        if not parsed:
+            return False
+        net = parse_network(rule.src, rule.mask)
+        if net:
+            return net.family == parsed[0] and (net.addr ^ parsed[1]) >> (net.bits - net.prefix) == 0
+        address = IPNetwork(parsed[0], parsed[1], 32 if parsed[0] == 4 else 128)
+        if rule.src == 'all':
+            return True
+        elif rule.src == 'samehost':
+            return any( n.family == address.family and n.addr == address.addr for n in self.server_networks )
+        elif rule.src == 'samenet':
+            return any( n.contains(address) for n in self.server_networks )
+        return False
+
+    def is_member(self, user, role):
+        return user == role or user in self.members.get(role, ())
+
+    def file_items(self, path):
+        '''
+        This function returns the items in a file (for @file), relative to the folder of the pg_hba file.
+        '''
+        if path not in self.files:
+            items = []
+            try:
+                with open(os.path.join(self.include_dir, path)) as f:
+                    for lineno, fields, comment in tokenize_hba(f, path):
+                        for field in fields:
+                            items += column_items(field)
+            except (IOError, OSError):
+                pass
+            self.files[path] = items
+        return self.files[path]
+
+    def db_matches(self, items, database, user):
+        for keyword, name in items:
+            if keyword == '@':
+                if self.db_matches(self.file_items(name), database, user):
+                    return True
+            elif database == 'replication':
+                #Replication connections only match the replication keyword
+                if keyword == 'replication':
+                    return True
+            elif keyword == 'all':
+                return True
+            elif keyword == 'sameuser':
+                if database == user:
+                    return True
+            elif keyword in ('samerole', 'samegroup'):
+                if self.is_member(user, database):
+                    return True
+            elif keyword is None and name == database:
+                return True
+        return False
+
+    def user_matches(self, items, user):
+        for keyword, name in items:
+            if keyword == '@':
+                if self.user_matches(self.file_items(name), user):
+                    return True
+            elif keyword == 'all':
+                return True
+            elif keyword == '+':
+                if self.is_member(user, name):
+                    return True
+            elif keyword is None and name == user:
+                return True
+        return False
+
+    def match_csv(self, infile, outfile):
+        '''
+        This function reads connections from a csv file (contype,database,user,address per line) and writes
+        them to a csv file with the method and the rule that would be used (method 'none' if no rule matches).
+        Lines starting with '#' are skipped. It returns the number of connections.
+        '''
+        import csv
+        reader = csv.reader(infile)
+        writer = csv.writer(outfile, lineterminator='\n')
+        count  = 0
+        for row in reader:
+            if not row or row[0].startswith('#'):
+                continue
+            if len(row) < 3:
+                raise PgHbaError("line {0} of connections has too few columns: {1}".format(reader.line_num, ','.join(row)))
+            contype, database, user = row[:3]
+            address = row[3] if len(row) > 3 else None
+            rule = self.match(contype, database, user, address)
+            if rule:
+                writer.writerow([ contype, database, user, address or '', rule.method, rule.line.replace('\t', ' ') ])
+            else:
+                writer.writerow([ contype, database, user, address or '', 'none', '' ])
+            count += 1
+        return count
+
+'''
+This function reads a list of rule specifications from a json file (or from stdin if path is '-').
+The file should hold a list of objects, or an object with such a list under the key 'rules'.
+Every object can have the keys of PgHbaSpecDefaults (missing keys get the default) and an optional 'name',
+which is returned as is in the results, so that the caller can recognize the rules.
+Example:
+  [ { "name": "app", "databases": "app", "users": "app_user", "source": "10.0.0.0/8" },
+    { "name": "old", "users": "old_user", "source": "10.0.0.0/8", "state": "absent" } ]
+'''
+def read_batch(path):
+    try:
+        if path == '-':
+            specs = json.load(sys.stdin)
+        else:
+            with open(path) as f:
+                specs = json.load(f)
+    except IOError:
+        raise PgHbaError("batch file '{0}' could not be read.".format(path))
+    except ValueError as e:
+        raise PgHbaError("batch file '{0}' is not valid json: {1}".format(path, e))
+    if isinstance(specs, dict):
+        specs = specs.get('rules', [])
+    if not isinstance(specs, list):
+        raise PgHbaError("batch file '{0}' should contain a list of rules.".format(path))
+    ret = []
+    for spec in specs:
+        if not isinstance(spec, dict):
+            raise PgHbaError("batch file '{0}' contains a rule that is not an object: {1}".format(path, spec))
+        unknown = [ k for k in spec.keys() if k != 'name' and k not in PgHbaSpecDefaults ]
+        if unknown:
+            raise PgHbaError("batch file '{0}' contains a rule with unknown keys: {1}".format(path, ', '.join(sorted(unknown))))
+        #Start with the defaults, and overwrite with what is set in the file
+        full_spec = dict(PgHbaSpecDefaults)
+        for k, v in spec.items():
+            #Values like null, or a netmask of 0 are cleaned just like empty cli options
+            full_spec[k] = native_str(v) if v is not None else ''
+        ret.append(full_spec)
+    return ret
+
+'''
+This function checks rule specifications (as returned by read_batch) before they are applied: the connection type,
+method, state and source (and netmask) of every specification should be valid. It raises a PgHbaError for the first one
+that isn't, so that an invalid specification is never put in the spool of a file (see apply_merged).
+'''
+def validate_specs(specs):
+    for pos, spec in enumerate(specs):
+        where = "rule {0}".format(spec['name'] if 'name' in spec else pos + 1)
+        if spec['contype'] not in PgHbaTypes:
+            raise PgHbaError("{0}: invalid connection type {1} (should be one of '{2}').".format(where, spec['contype'],
+                             "', '".join(PgHbaTypes)))
+        if spec['method'] not in PgHbaMethodSet:
+            raise PgHbaError("{0}: invalid method {1} (should be one of '{2}').".format(where, spec['method'],
+                             "', '".join(PgHbaMethods)))
+        if spec['state'] not in PgHbaStates:
+            raise PgHbaError("{0}: invalid state {1} (should be one of '{2}').".format(where, spec['state'],
+                             "', '".join(PgHbaStates)))
+        if spec['contype'] == 'local':
+            continue
+        try:
+            #Like new_rules: with a prefix, the netmask is not used
+            parse_network(spec['source'], None if '/' in spec['source'] else spec['netmask'] or None)
+        except IPError as e:
+            raise PgHbaError("{0}: invalid source {1}: {2}".format(where, spec['source'], e))
+
+# ===========================================
 # Module execution.
 #
 
-if __name__ == "__main__":
+'''
+This class keeps PgHba objects in memory for PgHbaDaemon, by file and the settings they where created with.
+An object is only reused while it is in sync with its files (see PgHba.in_sync): the file (and the traffic file,
+included files and lists) should still have the same inode, size, mtime and ctime as when the object read or wrote it,
+and the object should have no changes that are not written (like after a check that would change something).
+Else the file is read again.
+So edits by others are picked up on the next request, and checking the file costs a stat per request.
+'''
+class PgHbaModels(object):
+    def __init__(self):
+        self.models = {}
+
+    def get(self, key, new_pg_hba, reloader, stats):
+        '''
+        This function returns the PgHba object for key, or a new one (from new_pg_hba) if there is none that is in sync.
+        reloader and stats are set on a reused object, since they are per request.
+        '''
+        model = self.models.get(key)
+        if model is not None and model.in_sync():
+            model.reloader = reloader
+            model.stats    = stats
+            stats.count('model_hits')
+            return model
+        model = self.models[key] = new_pg_hba()
+        return model
+
+'''
+This class is a daemon that keeps parsed pg_hba files in memory (see PgHbaModels) and runs modify_pg_hba.py
+requests for clients on a unix socket, so that a check or apply doesn't have to start an interpreter and parse the file.
+The protocol is a line of json per request and per response:
+- request: { "argv": [ arguments of modify_pg_hba.py ], "cwd": working directory of the client }
+- response: { "exit": exit code, "stdout": output, "stderr": errors }, or { "fallback": true } for requests that
+  the client should run itself (requests that read from stdin, profile, or are invalid).
+Requests are handled one at a time. Only the user the daemon runs as (and root) can use it.
+A client that doesn't send its request (or doesn't take the response) within timeout seconds is disconnected,
+so that it can't block the requests of other clients.
+'''
+class PgHbaDaemon(object):
+    #Seconds to wait for a client to send a request, or to take a response
+    timeout = 5.0
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.models = PgHbaModels()
+        self.parser = cli_parser()
+        self.sock   = None
+
+    def serve(self):
+        '''
+        This procedure listens on the socket and handles requests until it gets a SIGTERM or SIGINT.
+        '''
+        import signal, socket
+        if os.path.exists(self.socket_path):
+            #Left by an earlier daemon. Only remove if nobody answers on it.
+            try:
+                probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                probe.connect(self.socket_path)
+                probe.close()
+                raise PgHbaError("a daemon is already listening on '{0}'.".format(self.socket_path))
+            except socket.error:
+                os.remove(self.socket_path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            self.sock.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        self.sock.listen(16)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        try:
+            while self.sock:
+                try:
+                    conn, addr = self.sock.accept()
+                except socket.error as e:
+                    if self.sock is None:
+                        #Stopped
+                        break
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                try:
+                    self.handle(conn)
+                except Exception as e:
+                    sys.stderr.write('Request failed: {0}\n'.format(e))
+                finally:
+                    conn.close()
+        finally:
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def stop(self, signum, frame):
+        sock, self.sock = self.sock, None
+        if sock:
+            sock.close()
+
+    def allowed(self, conn):
+        '''
+        This function returns True if the client runs as root or as the user of the daemon (by SO_PEERCRED).
+        '''
+        import socket
+        try:
+            import struct
+            creds = conn.getsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_PEERCRED', 17), struct.calcsize('3i'))
+            pid, uid, gid = struct.unpack('3i', creds)
+        except (socket.error, ImportError):
+            return False
+        return uid in (0, os.getuid())
+
+    def handle(self, conn):
+        '''
+        This procedure reads a request from a connection, runs it, and sends the response.
+        '''
+        conn.settimeout(self.timeout)
+        f = conn.makefile('rb')
+        try:
+            line = f.readline()
+        finally:
+            f.close()
+        if not line.strip():
+            #Just a connect (like the check if a daemon is running)
+            return
+        request = json.loads(line.decode('utf-8'))
+        if not self.allowed(conn):
+            response = { 'exit': 1, 'stdout': '', 'stderr': 'Not allowed to use this daemon\n' }
+        else:
+            response = self.run(request['argv'], request.get('cwd') or '/')
+        conn.sendall((json.dumps(response)+'\n').encode('utf-8'))
+
+    def run(self, argv, cwd):
+        '''
+        This function runs a request with output to strings, and returns the response.
+        '''
+        argv = [ native_str(arg) for arg in argv ]
+        try:
+            options = self.parser.parse_args(argv)
+        except SystemExit:
+            return { 'fallback': True }
+        if (options.daemon or options.profile or options.cluster or
+                '-' in [ options.batch, options.match ] + options.log):
+            return { 'fallback': True }
+        return run_captured(argv, options, self.models, cwd)
+
+'''
+This function runs main (with arguments argv or options) with output to strings, and returns
+{ "exit": exit code, "stdout": output, "stderr": errors }. Exceptions are reported in stderr, with exit code 1.
+'''
+def run_captured(argv, options, models=None, cwd=None):
+    try:
+        from StringIO import StringIO
+    except ImportError:
+        from io import StringIO
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = StringIO(), StringIO()
+    old_cwd = os.getcwd()
+    try:
+        if cwd:
+            os.chdir(cwd)
+        code = main(argv, models, options)
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 1
+    except Exception as e:
+        sys.stderr.write('{0}: {1}\n'.format(e.__class__.__name__, e))
+        code = 1
+    finally:
+        response = { 'stdout': sys.stdout.getvalue(), 'stderr': sys.stderr.getvalue() }
+        sys.stdout, sys.stderr = stdout, stderr
+        os.chdir(old_cwd)
+    response['exit'] = code
+    return response
+
+'''
+This function returns the folders of the clusters for --cluster: config folders (PGDATA, like
+/etc/pgpure/postgres/9.6/main for instance main of postgres-9.6@.service) with a pg_hba.conf.
+Patterns (like /etc/pgpure/postgres/9.6/*) are expanded, and every folder is returned once, sorted.
+'''
+def cluster_folders(patterns):
+    import glob
+    folders = set()
+    for pattern in patterns:
+        paths = glob.glob(os.path.expanduser(pattern)) if glob.has_magic(pattern) else [ os.path.expanduser(pattern) ]
+        for path in paths:
+            path = os.path.abspath(path)
+            if os.path.isfile(os.path.join(path, 'pg_hba.conf')):
+                folders.add(path)
+            elif not glob.has_magic(pattern):
+                raise PgHbaError("cluster folder '{0}' has no pg_hba.conf.".format(pattern))
+    return sorted(folders)
+
+'''
+This function returns the postmaster.pid of a cluster: in the data_directory that its postgresql.conf sets
+(when the config folder is not the data folder), else in the folder itself.
+'''
+def cluster_pid_file(folder):
+    data_dir = folder
+    try:
+        with open(os.path.join(folder, 'postgresql.conf')) as f:
+            for line in f:
+                match = re.match(r"\s*data_directory\s*=?\s*'([^']*)'", line)
+                if match:
+                    data_dir = os.path.join(folder, match.group(1))
+    except (IOError, OSError):
+        pass
+    return os.path.join(data_dir, 'postmaster.pid')
+
+'''
+This function applies (or checks) the rules of options for one cluster folder, and returns its result.
+It runs in a worker process of run_clusters, with the options of the cli for a single pg_hba file:
+the pg_hba.conf and postmaster.pid of the cluster (so that every cluster has its own lock, spool and reload),
+and a cache and backup folder relative to the cluster folder.
+'''
+def run_cluster(args):
+    folder, options = args
+    import copy
+    options = copy.copy(options)
+    options.cluster  = []
+    options.file     = os.path.join(folder, 'pg_hba.conf')
+    options.pid_file = cluster_pid_file(folder)
+    if options.cache:
+        options.cache = os.path.join(folder, options.cache)
+    if options.backup_dir:
+        options.backup_dir = os.path.join(folder, options.backup_dir)
+        if options.backup and not os.path.isdir(options.backup_dir):
+            os.makedirs(options.backup_dir)
+    if options.prom_file:
+        options.prom_file = os.path.abspath(options.prom_file)
+    start  = time.time()
+    response = run_captured(None, options, cwd=folder)
+    result = { 'file': options.file, 'exit': response['exit'], 'seconds': round(time.time() - start, 3) }
+    messages = []
+    for line in response['stdout'].splitlines():
+        if line.startswith('{'):
+            #The json report of the batch
+            result.update(json.loads(line))
+        elif line.strip():
+            messages.append(line)
+    if messages:
+        result['messages'] = messages
+    if response['stderr'].strip():
+        result['errors'] = response['stderr'].strip().splitlines()
+    if 'changed' not in result:
+        #No report: the run failed before it was done
+        result['failed'] = True
+    return result
+
+'''
+This function applies (or checks) the rules of a batch (one policy) to the pg_hba files of many clusters (--cluster),
+in parallel worker processes (--jobs, default one per cpu), and prints one report for all clusters as json.
+It returns the exit code: 1 when a cluster failed (or with --check, when a cluster would change), else 0.
+'''
+def run_clusters(options):
+    if not options.batch:
+        raise PgHbaError('--cluster needs the rules in a batch file (--batch).')
+    for name in ('cache', 'backup_dir'):
+        if getattr(options, name) and os.path.isabs(getattr(options, name)):
+            raise PgHbaError('--{0} should be relative to the cluster folders with --cluster.'.format(name.replace('_', '-')))
+    folders = cluster_folders(options.cluster)
+    if not folders:
+        raise PgHbaError('no cluster folders with a pg_hba.conf found for {0}.'.format(', '.join(options.cluster)))
+    start = time.time()
+    temp_batch = None
+    if options.batch == '-':
+        #Every worker reads the batch itself, so stdin is read once, into a file
+        import tempfile
+        filed, temp_batch = tempfile.mkstemp(prefix='.pg_hba_batch')
+        with os.fdopen(filed, 'w') as f:
+            f.write(sys.stdin.read())
+        options.batch = temp_batch
+    try:
+        #Validate the batch once, before any cluster is changed
+        validate_specs(read_batch(options.batch))
+        options.batch = os.path.abspath(options.batch)
+        jobs = options.jobs
+        if not jobs:
+            try:
+                jobs = len(os.sched_getaffinity(0))
+            except AttributeError:
+                import multiprocessing
+                jobs = multiprocessing.cpu_count()
+        jobs = max(1, min(jobs, len(folders)))
+        work = [ (folder, options) for folder in folders ]
+        if jobs > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(jobs)
+            try:
+                results = pool.map(run_cluster, work, 1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [ run_cluster(item) for item in work ]
+    finally:
+        if temp_batch:
+            os.remove(temp_batch)
+    clusters = dict(zip(folders, results))
+    changed  = any( result.get('changed') for result in results )
+    failed   = sorted( folder for folder, result in clusters.items() if result.get('failed') or
+                       (result['exit'] and not options.check) )
+    print(json.dumps({ 'changed': changed, 'clusters': clusters, 'failed': failed, 'jobs': jobs,
+                       'seconds': round(time.time() - start, 3) }, indent=2, sort_keys=True, separators=(',', ': ')))
+    if failed or (options.check and changed):
+        return 1
+    return 0
 
-    #Declare the argument parser
+'''
+This function returns the parser for the arguments of the cli.
+'''
+def cli_parser():
     import argparse
     parser = argparse.ArgumentParser(description='Modify entries in pg_hba')
+    parser.add_argument(      '--analyze',        help='Report shadowed, duplicate and redundant rules',  action='store_true')
     parser.add_argument('-b', '--backup',         help='Create a backup of the file before changing it.', action='store_true')
+    parser.add_argument(      '--backup-count',   help='Number of backups to keep',                       default=5, type=int)
+    parser.add_argument(      '--backup-dir',     help='Folder for backups (default: folder of file)',    default=None)
+    parser.add_argument(      '--batch',          help="Json file with rules to apply ('-' for stdin)",   default='')
+    parser.add_argument(      '--cache',          help='Cache file for the parsed state of the file',     default='')
+    parser.add_argument(      '--compact',        help='Merge networks, fold lists and drop rules without effect', action='store_true')
     parser.add_argument('-c', '--create',         help="Create the file if it doesn't exist",             action='store_true')
     parser.add_argument(      '--check',          help="Only check if changes are required.",             action='store_true')
-    parser.add_argument('-d', '--databases',      help='List of databases',                               default='all')
+    parser.add_argument(      '--cluster',        help='Config folder of a cluster to apply the batch to (glob)', action='append', default=[])
+    parser.add_argument(      '--daemon',         help='Serve requests of modify_pg_hba_client.py on this unix socket', default='')
+    parser.add_argument('-d', '--databases',      help='List of databases',                               default=PgHbaSpecDefaults['databases'])
     parser.add_argument('-f', '--file', '--dest', help='Path to file',                                    default='')
     parser.add_argument('-g', '--group',          help='Default group ownership of file',                 default='postgres')
+    parser.add_argument(      '--jobs',           help='Clusters to handle in parallel (default: cpus)',  default=0, type=int)
     parser.add_argument('--mode',                 help='Default access mode of file',                     default='640')
-    parser.add_argument('-m', '--method',         help='pg_hba connection method',                        default='md5')
-    parser.add_argument('-n', '--netmask',        help='Connection netmask',                              default='')
+    parser.add_argument(      '--match',          help="Csv file with connections to match ('-' for stdin)", default='')
+    parser.add_argument(      '--log',            help="Count connections per rule in postgres log ('-' for stdin)", action='append', default=[])
+    parser.add_argument('-m', '--method',         help='pg_hba connection method',                        default=PgHbaSpecDefaults['method'])
+    parser.add_argument('-n', '--netmask',        help='Connection netmask',                              default=PgHbaSpecDefaults['netmask'])
     parser.add_argument('--owner',                help='Default ownership of file',                       default='postgres')
-    parser.add_argument('--options',              help='Connection options',                              default='')
+    parser.add_argument('--options',              help='Connection options',                              default=PgHbaSpecDefaults['options'])
     parser.add_argument('-o', '--order',          help='Order in hba file',                               default='sdu')
-    parser.add_argument('--state',                help='Should it be present or absent',                  default='present')
+    parser.add_argument('--state',                help='Should it be present or absent',                  default=PgHbaSpecDefaults['state'])
+    parser.add_argument(      '--profile',        help='Write a cProfile of the run to this file',        default='')
+    parser.add_argument(      '--prom-file',      help='Add metrics to this node exporter textfile',      default='')
+    parser.add_argument(      '--pid-file',       help='postmaster.pid of postgres, to reload by signal', default=None)
+    parser.add_argument(      '--purge',          help='Reconcile, and remove rules that are not specified', action='store_true')
+    parser.add_argument(      '--reconcile',      help='Rules are the complete set (see --purge)',       action='store_true')
     parser.add_argument('-r', '--reload',         help='Reload config when changed and postgres running', action='store_true')
-    parser.add_argument('-s', '--source',         help='Source network',                                  default='samehost')
-    parser.add_argument('-t', '--contype',        help='Connection type',                                 default='host')
-    parser.add_argument('-u', '--users',          help='List of users',                                   default='all')
+    parser.add_argument(      '--reload-window',  help='Group reloads within this many seconds',          default=0.0, type=float)
+    parser.add_argument(      '--server-network', help='Network of the server (for samehost / samenet)', action='append', default=[])
+    parser.add_argument(      '--stats',          help='Print timings and counters as json on stderr',    action='store_true')
+    parser.add_argument(      '--shard',          help='Included file to add new rules to',               default=PgHbaSpecDefaults['shard'])
+    parser.add_argument('-s', '--source',         help='Source network',                                  default=PgHbaSpecDefaults['source'])
+    parser.add_argument(      '--traffic',        help='Json file with connections per rule, to order rules by', default=None)
+    parser.add_argument('-t', '--contype',        help='Connection type',                                 default=PgHbaSpecDefaults['contype'])
+    parser.add_argument('-u', '--users',          help='List of users',                                   default=PgHbaSpecDefaults['users'])
+    parser.add_argument(      '--users-file',     help='Keep users in this @file list',                   default=PgHbaSpecDefaults['users_file'])
+    return parser
+
+'''
+This function returns the settings of the cli (options) that change how a PgHba object edits and writes its file.
+Edits are only merged with edits of the same settings (see apply_merged), and PgHbaModels keeps an object per file
+and settings. Paths are made absolute, so that they are the same for processes in another working folder.
+'''
+def pg_hba_settings(options):
+    abspath = lambda path: os.path.abspath(os.path.expanduser(path)) if path else path
+    return [ options.order, options.backup, abspath(options.backup_dir), options.backup_count, abspath(options.cache),
+             options.compact, abspath(options.traffic) ]
 
+'''
+This function runs the cli with arguments argv (or options, when they are already parsed), and returns the exit code.
+models can be set to a PgHbaModels, to reuse the PgHba objects it keeps in memory (see PgHbaDaemon).
+'''
+def main(argv, models=None, options=None):
     #Parse the arguments
-    options = parser.parse_args()
+    options = options or cli_parser().parse_args(argv)
+
+    if options.daemon:
+        PgHbaDaemon(options.daemon).serve()
+        return 0
+
+    if options.cluster:
+        #Apply the batch to the pg_hba file of every cluster, in parallel
+        return run_clusters(options)
 
     #Find the expanded path of the file. '~' is expanded to $HOMEDIR, and 'subfolder/../' is expanded to '/'.
     dest      = os.path.expanduser(options.file)
 
+    if options.batch:
+        #Read all rules from the batch file
+        specs = read_batch(options.batch)
+    else:
+        #One rule, as specified with the cli options
+        specs = [ dict( (k, getattr(options, k)) for k in PgHbaSpecDefaults.keys() ) ]
+    validate_specs(specs)
+
     #If the file should exist, test if it exists, or create it
     if dest and options.create:
         touch(dest, options.owner, options.group, options.mode)
-    #Parse the hba file
-    pg_hba = PgHba(dest, options.order, options.backup)
-
-    if options.contype:
-        #Generate the new rules
-        for rule in pg_hba.new_rules(options.contype, options.databases, options.users, options.source, options.netmask, options.method, options.options):
-            if options.state == "present":
-                #Add the rule
-                pg_hba.add_rule(rule)
-            else:
-                #Remove the rule
-                pg_hba.remove_rule(rule)
-        if options.check:
-            #Only pretend
-            if pg_hba.changed:
-                #Changed, so return exitcode other then 0
-                sys.exit(1)
+    reloader = PgHbaReloader(options.pid_file, options.reload_window, dest + '.reload' if dest else None)
+    if options.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    #Statistics are reported at the end of every run (also when exiting early, like for --check)
+    stats = PgHbaStats()
+    settings = pg_hba_settings(options)
+    try:
+        create = lambda: PgHba(dest, options.order, options.backup, options.cache, backup_dir=options.backup_dir,
+                               backup_count=options.backup_count, reloader=reloader, stats=stats,
+                               compact=options.compact, traffic=options.traffic)
+        if models is not None and dest:
+            #Reuse the object in memory for the same file and settings, while it is in sync with the file
+            key = tuple([ os.path.abspath(dest) ] + settings)
+            new_pg_hba = lambda: models.get(key, create, reloader, stats)
+        else:
+            new_pg_hba = create
+        lock_stats = None
+
+        if options.match:
+            #Only report the rule that would be used for every connection, as csv.
+            matcher = new_pg_hba().matcher(server_networks=options.server_network)
+            if options.match == '-':
+                matcher.match_csv(sys.stdin, sys.stdout)
             else:
-                #Not changed, so return 0
-                sys.exit(0)
+                with open(options.match) as f:
+                    matcher.match_csv(f, sys.stdout)
+            return 0
+        elif options.log:
+            #Count connections per rule, report the effect of ordering by traffic, and write the file in that order.
+            count, before, after = new_pg_hba().count_traffic(options.log, server_networks=options.server_network)
+            print('Counted {0} connections'.format(count))
+            print('Average lines scanned per connection: {0:.1f}, ordered by traffic: {1:.1f} ({2:.1f}% less)'.format(
+                  before, after, 100.0 * (before - after) / before if before else 0.0))
+            if not (dest and options.traffic):
+                return 0
+            results, lock_stats = apply_merged(dest, [], settings, options.reload, new_pg_hba)
+        elif options.analyze:
+            #Only report rules without effect, as json.
+            findings = new_pg_hba().analyze()
+            print(json.dumps({ 'findings': findings }, indent=2, sort_keys=True))
+            return 0
+        elif options.check:
+            #Only pretend. Check (or find in cache) if anything would change.
+            #No lock is needed, since the file is always replaced atomically.
+            results = new_pg_hba().check_batch(specs, options.reconcile, options.purge)
+        elif dest:
+            #Apply all rules (and those of processes waiting for the same file) under lock, with one write and reload.
+            results, lock_stats = apply_merged(dest, specs, settings, options.reload, new_pg_hba,
+                                               options.reconcile, options.purge)
+            stats.phases['lock_wait'] = lock_stats['wait']
+            stats.phases['lock_hold'] = lock_stats['hold']
+            stats.set('merged', lock_stats['merged'])
         else:
-            #Write contents (write cecks if it has changed and if not, skips)
+            #Apply all rules against the one parsed hba object, and write the result to a temp file.
+            pg_hba = new_pg_hba()
+            results = pg_hba.apply_edit(specs, options.reconcile, options.purge)
             pg_hba.write(options.reload)
+        reconciled = options.reconcile or options.purge
+        if reconciled:
+            changed = results['changed']
+        else:
+            changed = any( result['changed'] for result in results )
+
+        if reconciled and not options.batch:
+            print('Reconciled: {0} added, {1} updated, {2} removed, {3} unchanged, {4} unmanaged'.format(
+                  len(results['added']), len(results['updated']), len(results['removed']), results['unchanged'],
+                  results['unmanaged']))
+        if options.batch:
+            #Report per rule if it changed anything (or the difference when reconciling), so that the caller can act on it
+            if reconciled:
+                output = { 'changed': changed, 'diff': results }
+            else:
+                output = { 'changed': changed, 'rules': results }
+            if lock_stats:
+                output['lock'] = lock_stats
+            print(json.dumps(output, sort_keys=True))
+
+        if options.check:
+            #Changed, so return exitcode other then 0. Not changed, so return 0.
+            return 1 if changed else 0
+        else:
+            if 'compacted_lines' in stats.counters:
+                print('Compaction removed {0} lines'.format(stats.counters['compacted_lines']))
+            for result in reloader.results:
+                #Report how the reload went
+                if result['reloaded']:
+                    print('Reloaded postgres by {0} in {1:.3f} seconds'.format(result['method'], result['seconds']))
+                elif result['reason'] == 'debounced':
+                    print('Reload left to a later request')
+                elif result['reason'] != 'not running':
+                    sys.stderr.write('Reload of postgres failed: {0}\n'.format(result['reason']))
+    finally:
+        if options.profile:
+            profiler.disable()
+            profiler.dump_stats(options.profile)
+        if options.stats:
+            sys.stderr.write(json.dumps(stats.as_dict(), sort_keys=True)+'\n')
+        if options.prom_file and dest:
+            try:
+                #Runs for other files (like other clusters) can add their metrics to the same textfile at the same time
+                with PgHbaLock(options.prom_file + '.lock'):
+                    stats.write_textfile(options.prom_file, os.path.abspath(dest))
+            except (IOError, OSError) as e:
+                sys.stderr.write('Could not write metrics to {0}: {1}\n'.format(options.prom_file, e))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
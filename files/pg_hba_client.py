@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+
+'''
+# Copyright (C) 2017 Collaboration of KPN and Splendid Data
+#
+# This file is part of puppet_pure_postgres.
+#
+# puppet_pure_barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# puppet_pure_postgres is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with puppet_pure_postgres.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+'''
+This is a thin client for the daemon of modify_pg_hba.py (modify_pg_hba.py --daemon SOCKET).
+It takes the same arguments as modify_pg_hba.py, sends them to the daemon, and prints the output and exits with
+the exit code of the daemon. This saves starting and importing modify_pg_hba.py and parsing the pg_hba file.
+If the daemon is not running (or asks to), modify_pg_hba.py (in the same folder) is run instead, so the client can
+always be used in place of modify_pg_hba.py.
+
+The socket is /run/pure_postgres_hba/modify_pg_hba.sock, or the value of environment variable PG_HBA_SOCKET.
+When the daemon doesn't answer within PG_HBA_TIMEOUT seconds (default 60), modify_pg_hba.py is run instead.
+That is safe, since applying the same rules again doesn't change anything.
+
+Example usage:
+  modify_pg_hba_client.py -f /etc/pgpure/postgres/9.6/data/pg_hba.conf --batch rules.json --check
+'''
+
+import os
+import sys
+import json
+import socket
+
+default_socket  = '/run/pure_postgres_hba/modify_pg_hba.sock'
+default_timeout = 60
+#Seconds to wait for connecting to the daemon, and sending the request
+connect_timeout = 5
+
+'''
+This function sends a request to the daemon and returns the response, or None if the daemon could not be reached
+(or didn't answer within timeout seconds).
+'''
+def request(socket_path, argv, timeout=default_timeout):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(min(connect_timeout, timeout))
+        sock.connect(socket_path)
+        sock.sendall((json.dumps({ 'argv': argv, 'cwd': os.getcwd() })+'\n').encode('utf-8'))
+        sock.settimeout(timeout)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    except socket.error:
+        return None
+    finally:
+        sock.close()
+    try:
+        return json.loads(b''.join(chunks).decode('utf-8'))
+    except ValueError:
+        return None
+
+'''
+This procedure replaces this process with modify_pg_hba.py with the same arguments
+(or pg_hba.py, when modify_pg_hba.py is not there).
+'''
+def fallback(argv):
+    folder = os.path.dirname(os.path.abspath(__file__))
+    script = os.path.join(folder, 'modify_pg_hba.py')
+    if not os.path.exists(script):
+        script = os.path.join(folder, 'pg_hba.py')
+    os.execv(sys.executable, [ sys.executable, script ] + argv)
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    try:
+        timeout = float(os.environ.get('PG_HBA_TIMEOUT', default_timeout))
+    except ValueError:
+        timeout = default_timeout
+    response = request(os.environ.get('PG_HBA_SOCKET', default_socket), argv, timeout)
+    if not response or response.get('fallback'):
+        fallback(argv)
+    sys.stdout.write(response['stdout'])
+    sys.stderr.write(response['stderr'])
+    sys.exit(response['exit'])
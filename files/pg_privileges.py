@@ -0,0 +1,566 @@
+#!/usr/bin/python3
+
+'''
+# Copyright (C) 2017 Collaboration of KPN and Splendid Data
+#
+# This file is part of puppet_pure_postgres.
+#
+# puppet_pure_barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# puppet_pure_postgres is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with puppet_pure_postgres.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+'''
+This script reconciles roles and privileges with a desired state (a json file), for pure_postgres::sql::privileges:
+  { "roles":   [ { "name": "app", "login": true, "member_of": [ "readers" ] } ],
+    "grants":  [ { "role": "app", "privilege": "select", "object_type": "table", "object": "public.t", "db": "app" } ],
+    "revokes": [ { "role": "public", "privilege": "create", "object_type": "schema", "object": "public", "db": "app" } ] }
+
+Instead of a has_*_privilege query per grant, it reads the complete privilege state of every database in one
+query (PgPrivilegeSnapshot): the acl of every table, sequence, function, schema, type, language, foreign data wrapper
+and foreign server (and of databases and tablespaces, which are shared by all databases), expanded with aclexplode.
+Objects with default privileges (acl null) are expanded with acldefault, so that they have the privileges postgres
+would use. Roles and memberships are read with one more query. The snapshot is kept in dicts indexed by object and
+by schema, and the names of the desired objects are resolved in one query per database (like to_regclass does).
+
+The difference with the desired state is the minimal set of statements (PgPrivilegeReconciler):
+- CREATE ROLE for missing roles, ALTER ROLE for attributes that differ, GRANT role TO role for missing memberships
+- GRANT for privileges that are not granted to the role itself, and REVOKE for privileges that are
+Privileges for the same object and role(s) are combined in one statement, and 'all functions in schema' (or tables,
+or sequences) becomes one statement for all of them when none of them has the privilege yet.
+Privileges are compared with what is granted to the role itself (the acl), not with what it has through PUBLIC,
+membership or being superuser, so that a grant or revoke converges after it ran once.
+
+By default the statements are printed. With --apply they are run (with one connection per database, see
+pg_sql_batch.py), and with --check the exit code is 1 if any statement is needed.
+
+Example usage:
+  pg_privileges.py --pid-file /var/pgpure/postgres/9.6/data/postmaster.pid --desired privileges.json --apply
+'''
+
+import re
+import sys
+import json
+
+from pg_protocol import PgConnection, PgProtocolError
+from pg_sql_batch import PgSqlBatch
+
+#Object types, with the acldefault code, the privileges that can be granted and the keyword in grant statements
+PgPrivilegeTypes = {
+    'table':                { 'privileges': [ 'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'TRUNCATE', 'REFERENCES', 'TRIGGER' ],
+                              'keyword': 'TABLE' },
+    'sequence':             { 'privileges': [ 'USAGE', 'SELECT', 'UPDATE' ], 'keyword': 'SEQUENCE' },
+    'function':             { 'privileges': [ 'EXECUTE' ], 'keyword': 'FUNCTION' },
+    'schema':               { 'privileges': [ 'USAGE', 'CREATE' ], 'keyword': 'SCHEMA' },
+    'database':             { 'privileges': [ 'CREATE', 'CONNECT', 'TEMPORARY' ], 'keyword': 'DATABASE' },
+    'tablespace':           { 'privileges': [ 'CREATE' ], 'keyword': 'TABLESPACE' },
+    'language':             { 'privileges': [ 'USAGE' ], 'keyword': 'LANGUAGE' },
+    'type':                 { 'privileges': [ 'USAGE' ], 'keyword': 'TYPE' },
+    'domain':               { 'privileges': [ 'USAGE' ], 'keyword': 'DOMAIN' },
+    'foreign data wrapper': { 'privileges': [ 'USAGE' ], 'keyword': 'FOREIGN DATA WRAPPER' },
+    'foreign server':       { 'privileges': [ 'USAGE' ], 'keyword': 'FOREIGN SERVER' },
+}
+
+#'all ... in schema' object types, and the type of the objects they stand for
+PgPrivilegeSchemaTypes = {
+    'all tables in schema':    'table',
+    'all sequences in schema': 'sequence',
+    'all functions in schema': 'function',
+}
+
+#Types of objects that are shared by all databases
+PgPrivilegeSharedTypes = [ 'database', 'tablespace' ]
+
+#Role attributes that can be managed, with their column in pg_roles and their keywords
+PgRoleAttributes = [ ('superuser', 'rolsuper', 'SUPERUSER'), ('login', 'rolcanlogin', 'LOGIN'),
+                     ('replication', 'rolreplication', 'REPLICATION'), ('createdb', 'rolcreatedb', 'CREATEDB'),
+                     ('createrole', 'rolcreaterole', 'CREATEROLE'), ('inherit', 'rolinherit', 'INHERIT') ]
+
+#Acls of all objects of a database. Objects with only revoked privileges have one row, with grantee null.
+PgPrivilegeLocalQuery = '''
+SELECT CASE WHEN c.relkind = 'S' THEN 'sequence' ELSE 'table' END, c.oid, n.nspname, c.relname,
+       a.grantee, a.privilege_type, a.is_grantable
+FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+LEFT JOIN LATERAL aclexplode(coalesce(c.relacl, acldefault((CASE WHEN c.relkind = 'S' THEN 's' ELSE 'r' END)::"char",
+                                                           c.relowner))) a ON true
+WHERE c.relkind IN ('r', 'v', 'm', 'f', 'p', 'S') AND n.nspname <> 'pg_toast'
+UNION ALL
+SELECT 'function', p.oid, n.nspname, p.proname || '(' || pg_get_function_identity_arguments(p.oid) || ')',
+       a.grantee, a.privilege_type, a.is_grantable
+FROM pg_proc p JOIN pg_namespace n ON n.oid = p.pronamespace
+LEFT JOIN LATERAL aclexplode(coalesce(p.proacl, acldefault('f', p.proowner))) a ON true
+UNION ALL
+SELECT 'schema', n.oid, NULL, n.nspname, a.grantee, a.privilege_type, a.is_grantable
+FROM pg_namespace n
+LEFT JOIN LATERAL aclexplode(coalesce(n.nspacl, acldefault('n', n.nspowner))) a ON true
+UNION ALL
+SELECT CASE WHEN t.typtype = 'd' THEN 'domain' ELSE 'type' END, t.oid, n.nspname, t.typname,
+       a.grantee, a.privilege_type, a.is_grantable
+FROM pg_type t JOIN pg_namespace n ON n.oid = t.typnamespace
+LEFT JOIN LATERAL aclexplode(coalesce(t.typacl, acldefault('T', t.typowner))) a ON true
+WHERE NOT (t.typelem <> 0 AND t.typlen = -1) AND n.nspname <> 'pg_toast'
+UNION ALL
+SELECT 'language', l.oid, NULL, l.lanname, a.grantee, a.privilege_type, a.is_grantable
+FROM pg_language l
+LEFT JOIN LATERAL aclexplode(coalesce(l.lanacl, acldefault('l', l.lanowner))) a ON true
+UNION ALL
+SELECT 'foreign data wrapper', w.oid, NULL, w.fdwname, a.grantee, a.privilege_type, a.is_grantable
+FROM pg_foreign_data_wrapper w
+LEFT JOIN LATERAL aclexplode(coalesce(w.fdwacl, acldefault('F', w.fdwowner))) a ON true
+UNION ALL
+SELECT 'foreign server', s.oid, NULL, s.srvname, a.grantee, a.privilege_type, a.is_grantable
+FROM pg_foreign_server s
+LEFT JOIN LATERAL aclexplode(coalesce(s.srvacl, acldefault('S', s.srvowner))) a ON true
+'''
+
+#Acls of the objects that are shared by all databases
+PgPrivilegeSharedQuery = '''
+SELECT 'database', d.oid, NULL, d.datname, a.grantee, a.privilege_type, a.is_grantable
+FROM pg_database d
+LEFT JOIN LATERAL aclexplode(coalesce(d.datacl, acldefault('d', d.datdba))) a ON true
+UNION ALL
+SELECT 'tablespace', t.oid, NULL, t.spcname, a.grantee, a.privilege_type, a.is_grantable
+FROM pg_tablespace t
+LEFT JOIN LATERAL aclexplode(coalesce(t.spcacl, acldefault('t', t.spcowner))) a ON true
+'''
+
+#Roles with their attributes, and the roles they are member of
+PgPrivilegeRolesQuery = '''
+SELECT r.oid, r.rolname, {0},
+       (SELECT string_agg(g.rolname, ',') FROM pg_auth_members m JOIN pg_roles g ON g.oid = m.roleid
+        WHERE m.member = r.oid)
+FROM pg_roles r
+'''.format(', '.join( 'r.' + column for attribute, column, keyword in PgRoleAttributes ))
+
+'''
+This exception is raised for an invalid desired state.
+'''
+class PgPrivilegeError(Exception):
+    pass
+
+'''
+This function returns an identifier as postgres stores it: without quotes when quoted, and lower case otherwise.
+'''
+def normalize_ident(name):
+    name = name.strip()
+    if len(name) > 1 and name[0] == '"' and name[-1] == '"':
+        return name[1:-1].replace('""', '"')
+    return name.lower()
+
+'''
+This function quotes an identifier for a statement.
+'''
+def quote_ident(name):
+    return '"{0}"'.format(name.replace('"', '""'))
+
+'''
+This function quotes a string for a statement.
+'''
+def quote_literal(value):
+    return "'{0}'".format(value.replace("'", "''"))
+
+'''
+This function returns a value of the desired state (true, 'true', 'yes', 1, etc.) as a boolean.
+'''
+def as_bool(value):
+    return str(value).lower() in ('true', 'yes', 'on', '1')
+
+'''
+This function returns the privileges of a grant or revoke (like 'select', 'temp' or 'all') for an object type,
+as a list of privileges like aclexplode returns them.
+'''
+def expand_privileges(privilege, object_type):
+    allowed = PgPrivilegeTypes[object_type]['privileges']
+    privileges = []
+    for item in privilege.split(','):
+        item = item.strip().upper()
+        if item in ('ALL', 'ALL PRIVILEGES', 'ALL PRIVILLEGES'):
+            privileges += allowed
+            continue
+        if item == 'TEMP':
+            item = 'TEMPORARY'
+        if item not in allowed:
+            raise PgPrivilegeError("'{0}' is not a privilege of a {1} (use one of {2})".format(item.lower(), object_type,
+                                                                                           ', '.join(allowed).lower()))
+        privileges.append(item)
+    return privileges
+
+'''
+This class holds the privilege state of a database, as read by read(): objects by (type, oid), their acl as a
+set of (grantee oid, privilege, grantable), and indexes by name and by schema. Roles are kept by name and oid.
+'''
+class PgPrivilegeSnapshot(object):
+    def __init__(self):
+        self.objects   = {}
+        self.acls      = {}
+        self.by_name   = {}
+        self.by_schema = {}
+        self.roles     = {}
+        self.role_oids = {}
+
+    def read(self, conn, shared=True):
+        '''
+        This procedure reads the objects and their acls of the database of conn, and (with shared) the objects that
+        are shared by all databases and the roles.
+        '''
+        query = PgPrivilegeLocalQuery
+        if shared:
+            query += 'UNION ALL' + PgPrivilegeSharedQuery
+        self.add_rows(conn.query(query))
+        if shared:
+            self.add_roles(conn.query(PgPrivilegeRolesQuery))
+
+    def add_rows(self, rows):
+        '''
+        This procedure adds rows of the acl queries.
+        '''
+        for object_type, oid, schema, name, grantee, privilege, grantable in rows:
+            key = (object_type, int(oid))
+            if key not in self.objects:
+                self.objects[key] = (schema, name)
+                self.acls[key] = set()
+                self.by_name[(object_type, schema, name)] = key
+                if schema is not None:
+                    self.by_schema.setdefault((object_type, schema), []).append(key)
+            if grantee is not None:
+                self.acls[key].add((int(grantee), privilege, grantable == 't'))
+
+    def add_roles(self, rows):
+        '''
+        This procedure adds rows of the roles query.
+        '''
+        for row in rows:
+            oid, name = int(row[0]), row[1]
+            role = { 'oid': oid, 'member_of': set(row[-1].split(',')) if row[-1] else set() }
+            for (attribute, column, keyword), value in zip(PgRoleAttributes, row[2:-1]):
+                role[attribute] = value == 't'
+            self.roles[name] = role
+            self.role_oids[oid] = name
+
+    def copy_shared(self, other):
+        '''
+        This procedure copies the shared objects and the roles of another snapshot (of the first database).
+        '''
+        for key, value in other.objects.items():
+            if key[0] in PgPrivilegeSharedTypes:
+                self.objects[key] = value
+                self.acls[key] = other.acls[key]
+                self.by_name[(key[0], None, value[1])] = key
+        self.roles     = other.roles
+        self.role_oids = other.role_oids
+
+    def has(self, key, grantee, privilege, grantable=False):
+        '''
+        This function returns True if the acl of an object grants privilege to grantee (oid, 0 for PUBLIC) itself.
+        With grantable, it also has to be granted with grant option.
+        '''
+        return (grantee, privilege, True) in self.acls[key] or (not grantable and
+                                                                  (grantee, privilege, False) in self.acls[key])
+
+    def name_of(self, key):
+        '''
+        This function returns the name of an object for a statement (quoted, with its schema).
+        '''
+        schema, name = self.objects[key]
+        if key[0] == 'function':
+            #name(identity arguments): only the name is quoted
+            pos = name.index('(')
+            return '{0}.{1}{2}'.format(quote_ident(schema), quote_ident(name[:pos]), name[pos:])
+        if schema is None:
+            return quote_ident(name)
+        return '{0}.{1}'.format(quote_ident(schema), quote_ident(name))
+
+'''
+This class compares a desired state with the snapshots of the databases, and returns the statements that are needed,
+as a list of (database, statement) in the order they should run.
+'''
+class PgPrivilegeReconciler(object):
+    def __init__(self, desired):
+        self.roles   = desired.get('roles', [])
+        self.grants  = [ dict(grant, action='grant') for grant in desired.get('grants', []) ]
+        self.grants += [ dict(revoke, action='revoke') for revoke in desired.get('revokes', []) ]
+        self.errors  = []
+        for grant in self.grants:
+            for key in [ 'role', 'privilege', 'object_type', 'object' ]:
+                if not grant.get(key):
+                    raise PgPrivilegeError('{0} has no {1}: {2}'.format(grant['action'], key, json.dumps(grant)))
+            grant['object_type'] = grant['object_type'].lower()
+            if grant['object_type'] not in PgPrivilegeTypes and grant['object_type'] not in PgPrivilegeSchemaTypes:
+                raise PgPrivilegeError("'{0}' is not a valid object type".format(grant['object_type']))
+            if grant['object_type'] in PgPrivilegeSharedTypes:
+                grant['db'] = None
+            else:
+                grant['db'] = grant.get('db') or 'postgres'
+
+    def databases(self, first='postgres'):
+        '''
+        This function returns the databases with grants, with first (for roles and shared objects) first.
+        '''
+        dbs = [ first ]
+        for grant in self.grants:
+            if grant['db'] and grant['db'] not in dbs:
+                dbs.append(grant['db'])
+        return dbs
+
+    def role_statements(self, snapshot):
+        '''
+        This function returns the statements for roles: create missing roles, alter attributes that differ,
+        and grant missing memberships.
+        '''
+        statements = []
+        memberships = []
+        for role in self.roles:
+            name = role['name']
+            current = snapshot.roles.get(name)
+            keywords = []
+            for attribute, column, keyword in PgRoleAttributes:
+                if attribute not in role:
+                    continue
+                wanted = as_bool(role[attribute])
+                if current is None or current[attribute] != wanted:
+                    keywords.append(keyword if wanted else 'NO' + keyword)
+            if role.get('password_hash'):
+                keywords.append('PASSWORD {0}'.format(quote_literal(role['password_hash'])))
+            if current is None:
+                statements.append('CREATE ROLE {0}{1};'.format(quote_ident(name), ''.join( ' ' + k for k in keywords )))
+            elif [ k for k in keywords if not k.startswith('PASSWORD') ]:
+                statements.append('ALTER ROLE {0}{1};'.format(quote_ident(name), ''.join( ' ' + k for k in keywords
+                                                                                         if not k.startswith('PASSWORD') )))
+            member_of = current['member_of'] if current else set()
+            for group in role.get('member_of', []):
+                if group not in member_of:
+                    memberships.append('GRANT {0} TO {1};'.format(quote_ident(group), quote_ident(name)))
+        return statements + memberships
+
+    def resolve(self, conn, snapshot, grants):
+        '''
+        This function returns the keys (in snapshot) of the objects of grants, as a list of (grant, keys).
+        Names of objects in schemas are resolved by postgres, in one query for all grants, so that search_path,
+        quoting and type names (int or integer) work like they do in a grant statement.
+        Grants for objects that don't exist are added to errors.
+        '''
+        lookups = []
+        for pos, grant in enumerate(grants):
+            object_type = grant['object_type']
+            if object_type in ('table', 'sequence'):
+                lookups.append("({0}, to_regclass({1})::oid)".format(pos, quote_literal(grant['object'])))
+            elif object_type == 'function':
+                function = 'to_regprocedure' if '(' in grant['object'] else 'to_regproc'
+                lookups.append("({0}, {1}({2})::oid)".format(pos, function, quote_literal(grant['object'])))
+            elif object_type in ('type', 'domain'):
+                lookups.append("({0}, to_regtype({1})::oid)".format(pos, quote_literal(grant['object'])))
+        oids = {}
+        if lookups:
+            for pos, oid in conn.query('SELECT * FROM (VALUES {0}) lookup'.format(', '.join(lookups))):
+                oids[int(pos)] = int(oid) if oid is not None else None
+        resolved = []
+        for pos, grant in enumerate(grants):
+            object_type = grant['object_type']
+            if object_type in PgPrivilegeSchemaTypes:
+                object_type = PgPrivilegeSchemaTypes[object_type]
+                keys = snapshot.by_schema.get((object_type, normalize_ident(grant['object'])), [])
+                if (('schema', None, normalize_ident(grant['object'])) not in snapshot.by_name):
+                    keys = None
+            elif pos in oids:
+                key = (object_type, oids[pos])
+                keys = [ key ] if key in snapshot.objects else None
+            else:
+                key = snapshot.by_name.get((object_type, None, normalize_ident(grant['object'])))
+                keys = [ key ] if key else None
+            if keys is None:
+                self.errors.append({ 'db': grant['db'], 'error': "{0} '{1}' does not exist".format(grant['object_type'],
+                                                                                                 grant['object']) })
+                continue
+            resolved.append((grant, object_type, keys))
+        return resolved
+
+    def grant_statements(self, conn, snapshot, grants):
+        '''
+        This function returns the grant and revoke statements that are needed for grants (of one database).
+        '''
+        #(action, object key, grant option) => role => privileges, in the order they were first needed
+        changes = {}
+        order   = []
+        for grant, object_type, keys in self.resolve(conn, snapshot, grants):
+            role = grant['role']
+            if role.lower() == 'public':
+                grantee, role = 0, 'PUBLIC'
+            elif role in snapshot.roles:
+                grantee = snapshot.roles[role]['oid']
+            elif role in [ r['name'] for r in self.roles ]:
+                #Role that is created by the role statements
+                grantee = None
+            else:
+                self.errors.append({ 'db': grant['db'], 'error': "role '{0}' does not exist".format(role) })
+                continue
+            try:
+                privileges = expand_privileges(grant['privilege'], object_type)
+            except PgPrivilegeError as e:
+                self.errors.append({ 'db': grant['db'], 'error': str(e) })
+                continue
+            with_grant = as_bool(grant.get('with_grant', False))
+            for key in keys:
+                for privilege in privileges:
+                    if grant['action'] == 'grant':
+                        needed = grantee is None or not snapshot.has(key, grantee, privilege, with_grant)
+                    else:
+                        needed = grantee is not None and snapshot.has(key, grantee, privilege)
+                    if not needed:
+                        continue
+                    change = (grant['action'], key, with_grant and grant['action'] == 'grant')
+                    if change not in changes:
+                        changes[change] = {}
+                        order.append(change)
+                    privileges_of_role = changes[change].setdefault(role, [])
+                    if privilege not in privileges_of_role:
+                        privileges_of_role.append(privilege)
+        return self.render(snapshot, changes, order, grants)
+
+    def render(self, snapshot, changes, order, grants):
+        '''
+        This function returns the statements for changes: one statement per object, privileges and grant option,
+        for all roles that need the same privileges. When all objects of a schema need the same change
+        (for 'all ... in schema'), that is one statement for the schema.
+        '''
+        #Combine roles that need the same privileges on the same object
+        statements = {}
+        statement_order = []
+        for action, key, with_grant in order:
+            by_privileges = {}
+            for role, privileges in changes[(action, key, with_grant)].items():
+                by_privileges.setdefault(tuple(sorted(privileges)), []).append(role)
+            for privileges, roles in sorted(by_privileges.items()):
+                group = (action, key[0], snapshot.objects[key][0], privileges, tuple(sorted(roles)), with_grant)
+                if group not in statements:
+                    statements[group] = []
+                    statement_order.append(group)
+                statements[group].append(key)
+        schema_grants = set( (grant['action'], PgPrivilegeSchemaTypes[grant['object_type']], normalize_ident(grant['object']))
+                             for grant in grants if grant['object_type'] in PgPrivilegeSchemaTypes )
+        sql = []
+        for group in statement_order:
+            action, object_type, schema, privileges, roles, with_grant = group
+            keys = statements[group]
+            all_keys = snapshot.by_schema.get((object_type, schema), [])
+            if ((action, object_type, schema) in schema_grants and len(keys) > 1 and
+                    sorted(keys) == sorted(all_keys)):
+                targets = [ 'ALL {0}S IN SCHEMA {1}'.format(PgPrivilegeTypes[object_type]['keyword'], quote_ident(schema)) ]
+            else:
+                targets = [ '{0} {1}'.format(PgPrivilegeTypes[object_type]['keyword'], snapshot.name_of(key)) for key in keys ]
+            grantees = ', '.join( role if role == 'PUBLIC' else quote_ident(role) for role in roles )
+            for target in targets:
+                if action == 'grant':
+                    sql.append('GRANT {0} ON {1} TO {2}{3};'.format(', '.join(privileges), target, grantees,
+                                                                    ' WITH GRANT OPTION' if with_grant else ''))
+                else:
+                    sql.append('REVOKE {0} ON {1} FROM {2};'.format(', '.join(privileges), target, grantees))
+        return sql
+
+    def statements(self, connect):
+        '''
+        This function reads the snapshots (with connect, a function that returns a PgConnection for a database),
+        and returns the statements that are needed, as a list of (database, connection, statements).
+        The connections are left open, so that the statements can run over them.
+        A database that can't be connected to or read (like when the connection is lost) is added to errors, and left out.
+        '''
+        result = []
+        first  = None
+        try:
+            for db in self.databases():
+                grants = [ grant for grant in self.grants if grant['db'] == db or (first is None and grant['db'] is None) ]
+                try:
+                    conn = connect(db)
+                except PgProtocolError as e:
+                    self.errors.append({ 'db': db, 'error': e.message })
+                    continue
+                try:
+                    snapshot = PgPrivilegeSnapshot()
+                    if first is None:
+                        snapshot.read(conn, shared=True)
+                        statements = self.role_statements(snapshot)
+                    else:
+                        snapshot.read(conn, shared=False)
+                        snapshot.copy_shared(first)
+                        statements = []
+                    statements += self.grant_statements(conn, snapshot, grants)
+                except PgProtocolError as e:
+                    conn.close()
+                    self.errors.append({ 'db': db, 'error': e.message })
+                    continue
+                if first is None:
+                    first = snapshot
+                result.append((db, conn, statements))
+        except BaseException:
+            for db, conn, statements in result:
+                conn.close()
+            raise
+        return result
+
+def cli_parser():
+    import argparse
+    parser = argparse.ArgumentParser(description='Reconcile roles and privileges with a desired state')
+    parser.add_argument('--apply',    help='Run the statements that are needed',                 action='store_true')
+    parser.add_argument('--check',    help='Only check if statements are needed',                action='store_true')
+    parser.add_argument('--desired',  help="Json file with the desired state ('-' for stdin)",   required=True)
+    parser.add_argument('--host',     help='Folder of the unix socket (or host)',                default=None)
+    parser.add_argument('--pid-file', help='postmaster.pid of postgres, for the socket and port', default=None)
+    parser.add_argument('--port',     help='Port of postgres',                                   default=None)
+    parser.add_argument('--timeout',  help='Seconds to wait for postgres',                       type=float, default=30)
+    parser.add_argument('--user',     help='User to connect as',                                 default=None)
+    return parser
+
+def main(argv):
+    options = cli_parser().parse_args(argv)
+    if options.desired == '-':
+        desired = json.load(sys.stdin)
+    else:
+        with open(options.desired) as f:
+            desired = json.load(f)
+
+    def connect(db):
+        kwargs = { 'host': options.host, 'port': options.port, 'user': options.user, 'database': db,
+                   'timeout': options.timeout }
+        if options.pid_file:
+            return PgConnection.connect_pid_file(options.pid_file, **kwargs)
+        return PgConnection(**kwargs)
+
+    reconciler = PgPrivilegeReconciler(desired)
+    output = []
+    failed = False
+    for db, conn, statements in reconciler.statements(connect):
+        try:
+            if options.apply and not options.check and statements:
+                batch = PgSqlBatch([ { 'name': sql, 'sql': sql, 'db': db } for sql in statements ], None)
+                try:
+                    batch.apply(conn, batch.items)
+                except PgProtocolError as e:
+                    #The connection was lost
+                    for item in batch.items:
+                        if 'status' not in item:
+                            batch.set_status(item, 'failed', e.message)
+                for item in batch.items:
+                    output.append(dict( (key, item[key]) for key in [ 'db', 'sql', 'status', 'error' ] if key in item ))
+                    failed = failed or item['status'] == 'failed'
+            else:
+                output += [ { 'db': db, 'sql': sql, 'status': 'needed' } for sql in statements ]
+        finally:
+            conn.close()
+    print(json.dumps({ 'changed': bool(output), 'statements': output, 'errors': reconciler.errors }, indent=2,
+                     sort_keys=True, separators=(',', ': ')))
+    if failed or reconciler.errors:
+        return 1
+    if options.check and output:
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,313 @@
+#!/usr/bin/python3
+
+'''
+# Copyright (C) 2017 Collaboration of KPN and Splendid Data
+#
+# This file is part of puppet_pure_postgres.
+#
+# puppet_pure_barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# puppet_pure_postgres is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with puppet_pure_postgres.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+'''
+This module is a minimal client for the frontend/backend protocol (version 3) of postgres, so that the scripts of
+pure_postgres can run many queries over one connection without forking psql for each, and without depending on
+a driver that may not be installed (like psycopg2).
+
+It supports what the scripts need:
+- connecting over the unix socket (a folder, like psql -h) or tcp, as the user the script runs as
+- authentication by trust and peer, and by password (cleartext or md5) from PGPASSWORD
+- the simple query protocol: every query returns its rows as lists of strings (or None for null)
+Errors of the server are raised as PgProtocolError with the sqlstate in code.
+
+Example usage:
+  conn = PgConnection.connect_pid_file('/var/pgpure/postgres/9.6/data/postmaster.pid', database='postgres')
+  rows = conn.query("select datname from pg_database")
+  conn.close()
+'''
+
+import os
+import struct
+
+#Protocol version 3.0
+PgProtocolVersion = 196608
+
+'''
+This exception is raised for errors of the server (with its sqlstate in code), and when the connection fails.
+'''
+class PgProtocolError(Exception):
+    def __init__(self, message, code=None, severity=None):
+        Exception.__init__(self, message)
+        self.message  = message
+        self.code     = code
+        self.severity = severity
+
+'''
+This function returns the folder of the unix socket and the port of a running postgres from its postmaster.pid,
+or (None, None) when it can't be read.
+'''
+def pid_file_address(pid_file):
+    try:
+        with open(pid_file) as f:
+            lines = f.read().splitlines()
+    except (IOError, OSError):
+        return None, None
+    port   = int(lines[3]) if len(lines) > 3 and lines[3].strip().isdigit() else None
+    socket = lines[4].strip() if len(lines) > 4 and lines[4].strip() else None
+    return socket, port
+
+'''
+This function returns the name of the user this process runs as.
+'''
+def current_user():
+    import pwd
+    return pwd.getpwuid(os.getuid()).pw_name
+
+'''
+This class is a connection to postgres.
+'''
+class PgConnection(object):
+    def __init__(self, host=None, port=None, user=None, database=None, timeout=None, password=None):
+        self.host       = host or os.environ.get('PGHOST') or '/tmp'
+        self.port       = int(port or os.environ.get('PGPORT') or 5432)
+        self.user       = user or os.environ.get('PGUSER') or current_user()
+        self.database   = database or self.user
+        self.password   = password if password is not None else os.environ.get('PGPASSWORD')
+        self.timeout    = timeout
+        self.parameters = {}
+        self.status     = None
+        self.sock       = None
+        self.buffer     = b''
+        self.connect()
+
+    @classmethod
+    def connect_pid_file(cls, pid_file, **kwargs):
+        '''
+        This function returns a connection to the postgres of a postmaster.pid (over its unix socket).
+        '''
+        socket, port = pid_file_address(pid_file)
+        if kwargs.get('host') is None:
+            kwargs['host'] = socket
+        if kwargs.get('port') is None:
+            kwargs['port'] = port
+        return cls(**kwargs)
+
+    def socket_path(self):
+        '''
+        This function returns the path of the unix socket, or None when host is a tcp host.
+        '''
+        if self.host.startswith('/'):
+            return os.path.join(self.host, '.s.PGSQL.{0}'.format(self.port))
+        return None
+
+    def open_socket(self):
+        '''
+        This function opens and returns the socket to the server.
+        '''
+        import socket
+        path = self.socket_path()
+        if path:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            address = path
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            address = (self.host, self.port)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(address)
+        except (socket.error, socket.timeout) as e:
+            sock.close()
+            raise PgProtocolError("Cannot connect to '{0}': {1}".format(path or '{0}:{1}'.format(*address), e))
+        return sock
+
+    def connect(self):
+        '''
+        This procedure opens the connection: it sends the startup message, authenticates,
+        and waits until the server is ready for queries.
+        '''
+        self.sock = self.open_socket()
+        params = b''
+        for key, value in [ ('user', self.user), ('database', self.database), ('application_name', 'pure_postgres'),
+                            ('client_encoding', 'UTF8') ]:
+            params += key.encode('utf-8') + b'\0' + value.encode('utf-8') + b'\0'
+        params += b'\0'
+        self.send_raw(struct.pack('!ii', len(params) + 8, PgProtocolVersion) + params)
+        while True:
+            kind, payload = self.read_message()
+            if kind == b'R':
+                self.authenticate(payload)
+            elif kind == b'E':
+                error = self.parse_error(payload)
+                self.close()
+                raise error
+            elif kind == b'Z':
+                self.status = payload
+                return
+            else:
+                self.handle_async(kind, payload)
+
+    def authenticate(self, payload):
+        '''
+        This procedure answers an authentication request of the server.
+        '''
+        code = struct.unpack('!i', payload[:4])[0]
+        if code == 0:
+            return
+        if code in (3, 5):
+            if self.password is None:
+                self.close()
+                raise PgProtocolError('The server asks for a password of {0}, and PGPASSWORD is not set'.format(self.user))
+            password = self.password.encode('utf-8')
+            if code == 5:
+                import hashlib
+                inner    = hashlib.md5(password + self.user.encode('utf-8')).hexdigest().encode('ascii')
+                password = b'md5' + hashlib.md5(inner + payload[4:8]).hexdigest().encode('ascii')
+            self.send(b'p', password + b'\0')
+            return
+        self.close()
+        raise PgProtocolError('Authentication method {0} of the server is not supported (use peer, trust or md5 for '
+                              'local connections of {1})'.format(code, self.user))
+
+    def lost(self, e):
+        '''
+        This function closes the socket after the connection is lost, and returns the PgProtocolError to raise.
+        '''
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        return PgProtocolError('Connection lost: {0}'.format(e))
+
+    def send_raw(self, data):
+        '''
+        This procedure sends data to the server.
+        '''
+        if self.sock is None:
+            raise PgProtocolError('Connection is closed')
+        try:
+            self.sock.sendall(data)
+        except Exception as e:
+            raise self.lost(e)
+
+    def send(self, kind, payload):
+        '''
+        This procedure sends a message of a kind (one byte) to the server.
+        '''
+        self.send_raw(kind + struct.pack('!i', len(payload) + 4) + payload)
+
+    def read_exact(self, size):
+        '''
+        This function returns exactly size bytes from the server.
+        '''
+        while len(self.buffer) < size:
+            if self.sock is None:
+                raise PgProtocolError('Connection is closed')
+            try:
+                chunk = self.sock.recv(max(65536, size - len(self.buffer)))
+            except Exception as e:
+                raise self.lost(e)
+            if not chunk:
+                raise self.lost('closed by the server')
+            self.buffer += chunk
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def read_message(self):
+        '''
+        This function reads a message from the server, and returns its kind (one byte) and its payload.
+        '''
+        header = self.read_exact(5)
+        length = struct.unpack('!i', header[1:5])[0]
+        return header[0:1], self.read_exact(length - 4)
+
+    def parse_error(self, payload):
+        '''
+        This function returns a PgProtocolError for an ErrorResponse of the server.
+        '''
+        fields = {}
+        for field in payload.split(b'\0'):
+            if field:
+                fields[field[0:1]] = field[1:].decode('utf-8', 'replace')
+        return PgProtocolError(fields.get(b'M', 'unknown error'), code=fields.get(b'C'), severity=fields.get(b'S'))
+
+    def handle_async(self, kind, payload):
+        '''
+        This procedure handles messages that can come at any time: parameter status, backend key and notices.
+        '''
+        if kind == b'S':
+            key, value = payload.split(b'\0')[:2]
+            self.parameters[key.decode('utf-8')] = value.decode('utf-8')
+
+    def query(self, sql):
+        '''
+        This function runs sql (one or more statements) and returns the rows of the last statement that returned rows,
+        as a list of lists of strings (None for null). Errors of the server are raised as PgProtocolError
+        (after the server is ready for the next query, so the connection can still be used).
+        '''
+        self.send(b'Q', sql.encode('utf-8') + b'\0')
+        rows, result, error = [], None, None
+        while True:
+            kind, payload = self.read_message()
+            if kind == b'T':
+                result = []
+            elif kind == b'D':
+                result.append(self.parse_row(payload))
+            elif kind == b'C':
+                if result is not None:
+                    rows, result = result, None
+            elif kind == b'E':
+                error = self.parse_error(payload)
+            elif kind == b'Z':
+                self.status = payload
+                break
+            elif kind in (b'G', b'H', b'W'):
+                raise PgProtocolError('COPY is not supported')
+            else:
+                self.handle_async(kind, payload)
+        if error:
+            raise error
+        return rows
+
+    def parse_row(self, payload):
+        '''
+        This function returns the values of a DataRow message as a list of strings (None for null).
+        '''
+        count = struct.unpack('!h', payload[:2])[0]
+        pos, values = 2, []
+        for i in range(count):
+            size = struct.unpack('!i', payload[pos:pos + 4])[0]
+            pos += 4
+            if size < 0:
+                values.append(None)
+                continue
+            values.append(payload[pos:pos + size].decode('utf-8'))
+            pos += size
+        return values
+
+    def in_transaction(self):
+        '''
+        This function returns True when the connection is in a transaction block (also a failed one).
+        '''
+        return self.status in (b'T', b'E')
+
+    def close(self):
+        '''
+        This procedure ends the connection.
+        '''
+        if self.sock is None:
+            return
+        try:
+            self.sock.sendall(b'X' + struct.pack('!i', 4))
+        except Exception:
+            pass
+        self.sock.close()
+        self.sock = None
@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+
+'''
+# Copyright (C) 2017 Collaboration of KPN and Splendid Data
+#
+# This file is part of puppet_pure_postgres.
+#
+# puppet_pure_barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# puppet_pure_postgres is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with puppet_pure_postgres.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+'''
+This script waits until postgres accepts connections, for pure_postgres::service::started.
+Every probe:
+- reads postmaster.pid: the pid of the postmaster (which should be running), and the status line that postgres 10
+  and newer write (starting, stopping, ready or standby). While it is starting or stopping, nothing else is tried.
+- sends a startup message to the unix socket (see pg_protocol.py). Postgres answers with 'the database system is
+  starting up' (sqlstate 57P03) during startup and crash recovery. Any other answer (a request for a password, an
+  error for a database or user that doesn't exist, or a ready connection) means it accepts connections,
+  like pg_isready reports it. The probe doesn't authenticate.
+Between probes it sleeps with a backoff: from --min-sleep, 1.5 times longer every probe up to --max-sleep, and back to
+--min-sleep when the state changes (like from starting to ready to accept connections), so a postgres that is
+almost ready is found quickly, and a long crash recovery isn't polled every few milliseconds.
+It gives up after --timeout seconds.
+
+The result is printed as json: ready, the last state, the time until ready (or until it gave up), the number of
+probes and how long every state lasted. The exit code is 0 when postgres is ready, and 1 when it isn't.
+
+Example usage:
+  pg_ready.py --pid-file /var/pgpure/postgres/9.6/data/postmaster.pid --timeout 300
+'''
+
+import os
+import sys
+import time
+import json
+import struct
+import errno
+
+from pg_protocol import PgConnection, PgProtocolError, current_user
+
+#Sqlstate of 'the database system is starting up' (and shutting down, and in recovery without hot standby)
+PgReadyCannotConnectNow = '57P03'
+
+#States of a probe, and whether postgres is ready in that state
+PgReadyStates = { 'no pid file': False, 'not running': False, 'starting': False, 'stopping': False, 'no socket': False,
+                  'ready': True, 'standby': True }
+
+'''
+This exception is raised by PgReadyProbe when the server asks for a password.
+'''
+class PgReadyAccepting(Exception):
+    pass
+
+'''
+This class opens a connection only to see if postgres accepts connections: it stops at the first authentication request.
+'''
+class PgReadyProbe(PgConnection):
+    def authenticate(self, payload):
+        '''
+        This procedure ends the connection when the server asks for a password: postgres accepts connections.
+        '''
+        if struct.unpack('!i', payload[:4])[0] != 0:
+            raise PgReadyAccepting()
+
+    def connect(self):
+        '''
+        This procedure opens the connection, and ends it when it is ready or when the server asks for a password.
+        '''
+        try:
+            PgConnection.connect(self)
+        except PgReadyAccepting:
+            pass
+        self.close()
+
+'''
+This function reads postmaster.pid, and returns the pid, the socket folder, the port and the status line
+(None when postgres is older than 10). It returns None when the file doesn't exist (or is being written).
+'''
+def read_pid_file(pid_file):
+    try:
+        with open(pid_file) as f:
+            lines = f.read().splitlines()
+    except (IOError, OSError):
+        return None
+    if not lines or not lines[0].strip().isdigit():
+        return None
+    pid    = int(lines[0])
+    port   = int(lines[3]) if len(lines) > 3 and lines[3].strip().isdigit() else None
+    socket = lines[4].strip() if len(lines) > 4 and lines[4].strip() else None
+    status = lines[7].strip() if len(lines) > 7 and lines[7].strip() else None
+    return pid, socket, port, status
+
+'''
+This function returns True if a process with pid is running.
+'''
+def pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+'''
+This function probes postgres once, and returns its state (one of PgReadyStates) and a detail (like an error).
+'''
+def probe(pid_file, host=None, port=None, user=None, timeout=5):
+    pid_info = read_pid_file(pid_file)
+    if pid_info is None:
+        return 'no pid file', None
+    pid, socket_dir, pid_port, status = pid_info
+    if not pid_running(pid):
+        return 'not running', 'pid {0}'.format(pid)
+    if status in ('starting', 'stopping'):
+        return status, None
+    try:
+        PgReadyProbe(host=host or socket_dir, port=port or pid_port, user=user or current_user(), database='postgres',
+                     timeout=timeout)
+    except PgProtocolError as e:
+        if e.code == PgReadyCannotConnectNow:
+            return 'starting', e.message
+        if e.code is None:
+            #The socket isn't there yet, or the connection was closed before postgres answered
+            return 'no socket', e.message
+    return 'standby' if status == 'standby' else 'ready', None
+
+'''
+This class waits until postgres is ready, and keeps how long it took.
+'''
+class PgReadyWaiter(object):
+    def __init__(self, pid_file, timeout=300, min_sleep=0.01, max_sleep=1, probe_timeout=5, host=None, port=None,
+                 user=None):
+        self.pid_file      = pid_file
+        self.timeout       = timeout
+        self.min_sleep     = min_sleep
+        self.max_sleep     = max_sleep
+        self.probe_timeout = probe_timeout
+        self.host          = host
+        self.port          = port
+        self.user          = user
+        self.probes        = 0
+        self.states        = []
+
+    def wait(self):
+        '''
+        This function probes until postgres is ready or the timeout expired, and returns the result as a dict.
+        '''
+        start    = time.time()
+        deadline = start + self.timeout
+        sleep    = self.min_sleep
+        state, detail = None, None
+        while True:
+            now = time.time()
+            new_state, detail = probe(self.pid_file, self.host, self.port, self.user,
+                                      max(0.1, min(self.probe_timeout, deadline - now)))
+            self.probes += 1
+            now = time.time()
+            if new_state != state:
+                #Keep when every state started, and probe quickly again after a change
+                self.states.append([ new_state, now - start ])
+                state = new_state
+                sleep = self.min_sleep
+            if PgReadyStates[state] or now >= deadline:
+                break
+            time.sleep(min(sleep, deadline - now))
+            sleep = min(sleep * 1.5, self.max_sleep)
+        elapsed = time.time() - start
+        durations = {}
+        for pos, (name, started) in enumerate(self.states):
+            ended = self.states[pos + 1][1] if pos + 1 < len(self.states) else elapsed
+            durations[name] = round(durations.get(name, 0) + ended - started, 3)
+        result = { 'ready': PgReadyStates[state], 'state': state, 'seconds': round(elapsed, 3), 'probes': self.probes,
+                   'states': durations }
+        if detail and not result['ready']:
+            result['detail'] = detail
+        return result
+
+def cli_parser():
+    import argparse
+    parser = argparse.ArgumentParser(description='Wait until postgres accepts connections')
+    parser.add_argument('--host',          help='Folder of the unix socket (default from postmaster.pid)', default=None)
+    parser.add_argument('--max-sleep',     help='Longest sleep between probes (seconds)',                type=float, default=1)
+    parser.add_argument('--min-sleep',     help='Shortest sleep between probes (seconds)',               type=float, default=0.01)
+    parser.add_argument('--pid-file',      help='postmaster.pid of postgres',                            required=True)
+    parser.add_argument('--port',          help='Port of postgres (default from postmaster.pid)',        default=None)
+    parser.add_argument('--probe-timeout', help='Seconds to wait for an answer of postgres per probe',   type=float, default=5)
+    parser.add_argument('--timeout',       help='Seconds to wait until postgres is ready',               type=float, default=300)
+    parser.add_argument('--user',          help='User for the startup message',                          default=None)
+    return parser
+
+def main(argv):
+    options = cli_parser().parse_args(argv)
+    waiter = PgReadyWaiter(options.pid_file, timeout=options.timeout, min_sleep=options.min_sleep,
+                           max_sleep=options.max_sleep, probe_timeout=options.probe_timeout, host=options.host,
+                           port=options.port, user=options.user)
+    result = waiter.wait()
+    print(json.dumps(result, indent=2, sort_keys=True, separators=(',', ': ')))
+    return 0 if result['ready'] else 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
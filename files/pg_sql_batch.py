@@ -0,0 +1,279 @@
+#!/usr/bin/python3
+
+'''
+# Copyright (C) 2017 Collaboration of KPN and Splendid Data
+#
+# This file is part of puppet_pure_postgres.
+#
+# puppet_pure_barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# puppet_pure_postgres is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with puppet_pure_postgres.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+'''
+This script runs sql statements with a guard (like the unless of an exec) for pure_postgres::sql::run_sql and
+pure_postgres::sql::batch. An item is:
+  { "name": "...", "sql": "statement(s)", "unless": "guard query", "db": "database" }
+The statement of an item is needed when its guard returns no rows (or when it has no guard).
+
+Items are grouped by database, and every database is handled over one connection (see pg_protocol.py):
+- the guards of all items of the database are evaluated with one query
+- the needed statements are run in one transaction, in the order of the items, with a savepoint per item,
+  so that an item that fails is rolled back, and doesn't stop the other items
+- statements that can't run in a transaction (like create database) commit the transaction so far,
+  run on their own, and a new transaction is started after them
+Databases are handled in the order they are first used by an item, so a database that is created by an item
+(in database postgres) can be used by later items.
+
+Guards are evaluated before any statement of their database runs. A guard that fails (like has_table_privilege for
+a table that doesn't exist yet) makes its statement needed, like it did for the psql based exec.
+
+The status of every item is printed as json: unchanged (guard returned rows), applied, failed (with the error),
+or needed (with --check). With --check, nothing is changed, and the exit code is 1 if any statement is needed.
+The exit code is 1 if any item failed (also with --check).
+
+Example usage:
+  pg_sql_batch.py --pid-file /var/pgpure/postgres/9.6/data/postmaster.pid --batch grants.json
+  pg_sql_batch.py --pid-file /var/pgpure/postgres/9.6/data/postmaster.pid --db app \
+                  --sql 'CREATE EXTENSION "hstore";' --unless "SELECT * FROM pg_extension where extname = 'hstore';"
+'''
+
+import re
+import sys
+import json
+
+from pg_protocol import PgConnection, PgProtocolError
+
+#Statements that postgres doesn't allow in a transaction block
+PgSqlNoTransaction = re.compile(r'^\s*((create|drop)\s+(database|tablespace)|alter\s+system|vacuum|'
+                                r'reindex\s+(database|system)|create\s+index\s+concurrently|'
+                                r'drop\s+index\s+concurrently)\b', re.I)
+
+PgSqlItemKeys = [ 'name', 'sql', 'unless', 'db' ]
+
+'''
+This exception is raised for an invalid batch.
+'''
+class PgSqlBatchError(Exception):
+    pass
+
+'''
+This function reads a batch file (json list of items, '-' for stdin) and returns the items.
+'''
+def read_batch(path):
+    if path == '-':
+        items = json.load(sys.stdin)
+    else:
+        with open(path) as f:
+            items = json.load(f)
+    if not isinstance(items, list):
+        raise PgSqlBatchError("Batch file '{0}' should contain a list of items".format(path))
+    for pos, item in enumerate(items):
+        if not isinstance(item, dict) or not item.get('sql'):
+            raise PgSqlBatchError("Item {0} of batch file '{1}' has no sql".format(pos, path))
+        unknown = set(item) - set(PgSqlItemKeys)
+        if unknown:
+            raise PgSqlBatchError("Item {0} of batch file '{1}' has unknown keys: {2}".format(pos, path,
+                                                                                            ', '.join(sorted(unknown))))
+    return items
+
+'''
+This function returns a guard query as an expression that can be used in another query (without its trailing ;).
+'''
+def guard_expression(unless):
+    return unless.strip().rstrip(';').strip()
+
+'''
+This class runs a list of items (dicts with name, sql, unless and db).
+connect is a function that returns a PgConnection for a database.
+'''
+class PgSqlBatch(object):
+    def __init__(self, items, connect):
+        self.items   = [ dict(item) for item in items ]
+        self.connect = connect
+        for pos, item in enumerate(self.items):
+            item.setdefault('name', item['sql'])
+            item.setdefault('db', 'postgres')
+            item['pos'] = pos
+
+    def databases(self):
+        '''
+        This function returns the items grouped by database, as a list of (database, items),
+        in the order the databases are first used.
+        '''
+        groups = []
+        by_db  = {}
+        for item in self.items:
+            if item['db'] not in by_db:
+                by_db[item['db']] = []
+                groups.append((item['db'], by_db[item['db']]))
+            by_db[item['db']].append(item)
+        return groups
+
+    def run(self, check=False):
+        '''
+        This function runs (or with check, only checks) all items, and returns their status as a list of dicts.
+        '''
+        for db, items in self.databases():
+            try:
+                conn = self.connect(db)
+            except PgProtocolError as e:
+                for item in items:
+                    self.set_status(item, 'failed', e.message)
+                continue
+            try:
+                needed = self.needed(conn, items)
+                for item in items:
+                    if item['pos'] not in needed:
+                        self.set_status(item, 'unchanged')
+                    elif check:
+                        self.set_status(item, 'needed')
+                if not check:
+                    self.apply(conn, [ item for item in items if item['pos'] in needed ])
+            except PgProtocolError as e:
+                #The connection was lost
+                for item in items:
+                    if 'status' not in item:
+                        self.set_status(item, 'failed', e.message)
+            finally:
+                conn.close()
+        return [ dict( (key, item[key]) for key in [ 'name', 'db', 'status', 'error' ] if key in item )
+                 for item in self.items ]
+
+    def set_status(self, item, status, error=None):
+        item['status'] = status
+        if error:
+            item['error'] = error
+
+    def needed(self, conn, items):
+        '''
+        This function returns the positions of the items whose statement is needed.
+        All guards are evaluated with one query. When that fails, they are evaluated one by one,
+        and an item whose guard fails is needed.
+        '''
+        guarded = [ item for item in items if item.get('unless') ]
+        needed  = set( item['pos'] for item in items if not item.get('unless') )
+        if not guarded:
+            return needed
+        query = ' UNION ALL '.join( 'SELECT {0}, EXISTS ({1})'.format(item['pos'], guard_expression(item['unless']))
+                                    for item in guarded )
+        try:
+            rows = conn.query(query)
+        except PgProtocolError:
+            if conn.sock is None:
+                raise
+            rows = []
+            for item in guarded:
+                try:
+                    rows += conn.query('SELECT {0}, EXISTS ({1})'.format(item['pos'], guard_expression(item['unless'])))
+                except PgProtocolError:
+                    if conn.sock is None:
+                        raise
+                    rows.append([ str(item['pos']), 'f' ])
+        needed.update( int(pos) for pos, met in rows if met != 't' )
+        return needed
+
+    def apply(self, conn, items):
+        '''
+        This procedure runs the statements of items in one transaction, with a savepoint per item.
+        Statements that can't run in a transaction run on their own, between transactions.
+        Items are only applied when the transaction they ran in is committed (see commit).
+        '''
+        pending = []
+        conn.query('BEGIN')
+        for item in items:
+            if PgSqlNoTransaction.match(item['sql']):
+                self.commit(conn, pending)
+                pending = []
+                try:
+                    conn.query(item['sql'])
+                    self.set_status(item, 'applied')
+                except PgProtocolError as e:
+                    if conn.sock is None:
+                        raise
+                    self.set_status(item, 'failed', e.message)
+                conn.query('BEGIN')
+                continue
+            conn.query('SAVEPOINT pure_postgres_item')
+            try:
+                conn.query(item['sql'])
+                conn.query('RELEASE SAVEPOINT pure_postgres_item')
+                pending.append(item)
+            except PgProtocolError as e:
+                if conn.sock is None:
+                    raise
+                self.set_status(item, 'failed', e.message)
+                conn.query('ROLLBACK TO SAVEPOINT pure_postgres_item')
+        self.commit(conn, pending)
+
+    def commit(self, conn, items):
+        '''
+        This procedure commits the transaction of items, and sets their status: applied when the commit succeeds,
+        and failed when it doesn't (like for a deferred constraint or a serialization failure), since then
+        the transaction is rolled back. When the connection is lost, the error is raised (see run).
+        '''
+        try:
+            if conn.status == b'E':
+                #Postgres answers COMMIT of a failed transaction with ROLLBACK, not with an error
+                conn.query('ROLLBACK')
+                raise PgProtocolError('The transaction failed, and was rolled back')
+            conn.query('COMMIT')
+        except PgProtocolError as e:
+            if conn.sock is None:
+                raise
+            for item in items:
+                self.set_status(item, 'failed', e.message)
+            return
+        for item in items:
+            self.set_status(item, 'applied')
+
+def cli_parser():
+    import argparse
+    parser = argparse.ArgumentParser(description='Run sql statements with guards over one connection per database')
+    parser.add_argument('--batch',    help="Json file with items ('-' for stdin)",               default='')
+    parser.add_argument('--check',    help='Only check if statements are needed',                action='store_true')
+    parser.add_argument('--db',       help='Database of the statement (without --batch)',        default='postgres')
+    parser.add_argument('--host',     help='Folder of the unix socket (or host)',                default=None)
+    parser.add_argument('--name',     help='Name of the statement (without --batch)',            default=None)
+    parser.add_argument('--pid-file', help='postmaster.pid of postgres, for the socket and port', default=None)
+    parser.add_argument('--port',     help='Port of postgres',                                   default=None)
+    parser.add_argument('--sql',      help='Statement (without --batch)',                        default='')
+    parser.add_argument('--timeout',  help='Seconds to wait for postgres',                       type=float, default=30)
+    parser.add_argument('--unless',   help='Guard query of the statement (without --batch)',     default='')
+    parser.add_argument('--user',     help='User to connect as',                                 default=None)
+    return parser
+
+def main(argv):
+    options = cli_parser().parse_args(argv)
+    if options.batch:
+        items = read_batch(options.batch)
+    elif options.sql:
+        items = [ { 'name': options.name or options.sql, 'sql': options.sql, 'unless': options.unless, 'db': options.db } ]
+    else:
+        raise PgSqlBatchError('Specify --batch or --sql')
+
+    def connect(db):
+        kwargs = { 'host': options.host, 'port': options.port, 'user': options.user, 'database': db,
+                   'timeout': options.timeout }
+        if options.pid_file:
+            return PgConnection.connect_pid_file(options.pid_file, **kwargs)
+        return PgConnection(**kwargs)
+
+    status = PgSqlBatch(items, connect).run(options.check)
+    changed = any( item['status'] in ('applied', 'needed') for item in status )
+    print(json.dumps({ 'changed': changed, 'items': status }, indent=2, sort_keys=True, separators=(',', ': ')))
+    #With --check, a failed item is reported as needed too, so that puppet runs it and reports the error
+    failed = any( item['status'] == 'failed' for item in status )
+    return 1 if failed or (options.check and changed) else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
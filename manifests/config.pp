@@ -41,14 +41,34 @@ class pure_postgres::config
     }
   }
 
-  #create facts script to add postgres ssh keys to facts
+  #create facts script to add facts of the database and postgres ssh keys to facts
   file { '/etc/facter/facts.d/pure_postgres_facts.sh':
+    ensure => absent,
+  }
+
+  file { '/etc/facter/facts.d/pure_postgres_facts.py':
     ensure  => file,
     content => epp('pure_postgres/pure_postgres_facts.epp'),
     owner   => 'root',
     group   => 'root',
     mode    => '0755',
-    require => File['/etc/facter/facts.d'],
+    require => [ File['/etc/facter/facts.d'], File["${pure_postgres::params::pg_bin_dir}/pg_protocol.py"] ],
+  }
+
+  #modify_pg_hba.py imports pg_hba.py, so that python can use the compiled bytecode of pg_hba.py.
+  #It is compiled as root, since the postgres user cannot write it in the bin folder. The scripts run with
+  #/usr/bin/python3 (their shebang), so they are compiled with it too.
+  file { "${pure_postgres::params::pg_bin_dir}/pg_hba.py":
+    ensure  => file,
+    owner   => $pure_postgres::params::postgres_user,
+    group   => $pure_postgres::params::postgres_group,
+    mode    => '0640',
+    source  => 'puppet:///modules/pure_postgres/pg_hba.py',
+    require => Package[$pure_postgres::params::pg_package],
+  }
+  ~> exec { "compile ${pure_postgres::params::pg_bin_dir}/pg_hba.py":
+    command     => shellquote('/usr/bin/python3', '-m', 'py_compile', "${pure_postgres::params::pg_bin_dir}/pg_hba.py"),
+    refreshonly => true,
   }
 
   file { "${pure_postgres::params::pg_bin_dir}/modify_pg_hba.py":
@@ -56,10 +76,90 @@ class pure_postgres::config
     owner   => $pure_postgres::params::postgres_user,
     group   => $pure_postgres::params::postgres_group,
     mode    => '0750',
-    source  => 'puppet:///modules/pure_postgres/pg_hba.py',
+    source  => 'puppet:///modules/pure_postgres/modify_pg_hba.py',
+    require => File["${pure_postgres::params::pg_bin_dir}/pg_hba.py"],
+  }
+
+  #Thin client for the daemon of modify_pg_hba.py, that runs modify_pg_hba.py itself when the daemon isn't running
+  file { "${pure_postgres::params::pg_bin_dir}/modify_pg_hba_client.py":
+    ensure  => file,
+    owner   => $pure_postgres::params::postgres_user,
+    group   => $pure_postgres::params::postgres_group,
+    mode    => '0750',
+    source  => 'puppet:///modules/pure_postgres/pg_hba_client.py',
     require => Package[$pure_postgres::params::pg_package],
   }
 
+  #Client for the protocol of postgres, imported by pg_sql_batch.py and the facts script (and compiled like pg_hba.py)
+  file { "${pure_postgres::params::pg_bin_dir}/pg_protocol.py":
+    ensure  => file,
+    owner   => $pure_postgres::params::postgres_user,
+    group   => $pure_postgres::params::postgres_group,
+    mode    => '0640',
+    source  => 'puppet:///modules/pure_postgres/pg_protocol.py',
+    require => Package[$pure_postgres::params::pg_package],
+  }
+  ~> exec { "compile ${pure_postgres::params::pg_bin_dir}/pg_protocol.py":
+    command     => shellquote('/usr/bin/python3', '-m', 'py_compile', "${pure_postgres::params::pg_bin_dir}/pg_protocol.py"),
+    refreshonly => true,
+  }
+
+  #Runs the statements of pure_postgres::sql::run_sql and pure_postgres::sql::batch, with one connection per database
+  file { "${pure_postgres::params::pg_bin_dir}/pg_sql_batch.py":
+    ensure  => file,
+    owner   => $pure_postgres::params::postgres_user,
+    group   => $pure_postgres::params::postgres_group,
+    mode    => '0750',
+    source  => 'puppet:///modules/pure_postgres/pg_sql_batch.py',
+    require => File["${pure_postgres::params::pg_bin_dir}/pg_protocol.py"],
+  }
+
+  #Waits until postgres accepts connections, for pure_postgres::service::started (imports pg_protocol.py)
+  file { "${pure_postgres::params::pg_bin_dir}/pg_ready.py":
+    ensure  => file,
+    owner   => $pure_postgres::params::postgres_user,
+    group   => $pure_postgres::params::postgres_group,
+    mode    => '0750',
+    source  => 'puppet:///modules/pure_postgres/pg_ready.py',
+    require => File["${pure_postgres::params::pg_bin_dir}/pg_protocol.py"],
+  }
+
+  #Reconciles roles and privileges of pure_postgres::sql::privileges (imports pg_protocol.py and pg_sql_batch.py)
+  file { "${pure_postgres::params::pg_bin_dir}/pg_privileges.py":
+    ensure  => file,
+    owner   => $pure_postgres::params::postgres_user,
+    group   => $pure_postgres::params::postgres_group,
+    mode    => '0750',
+    source  => 'puppet:///modules/pure_postgres/pg_privileges.py',
+    require => File["${pure_postgres::params::pg_bin_dir}/pg_sql_batch.py"],
+  }
+
+  if $pure_postgres::pg_hba_daemon {
+    file { '/etc/systemd/system/pure_postgres_hba.service':
+      ensure  => file,
+      owner   => 'root',
+      group   => 'root',
+      mode    => '0644',
+      content => epp('pure_postgres/pg_hba_daemon.service.epp'),
+    }
+    ~> exec { 'pure_postgres_hba systemctl daemon-reload':
+      command     => '/bin/systemctl daemon-reload',
+      refreshonly => true,
+    }
+    -> service { 'pure_postgres_hba':
+      ensure    => running,
+      enable    => true,
+      subscribe => [ File["${pure_postgres::params::pg_bin_dir}/modify_pg_hba.py"],
+                      File["${pure_postgres::params::pg_bin_dir}/pg_hba.py"],
+                      File['/etc/systemd/system/pure_postgres_hba.service'] ],
+    }
+  }
+  else {
+    file { '/etc/systemd/system/pure_postgres_hba.service':
+      ensure => absent,
+    }
+  }
+
   file { "${pure_postgres::params::pg_bin_dir}/generate_server_cert.sh":
     ensure  => file,
     owner   => $pure_postgres::params::postgres_user,
@@ -93,14 +193,31 @@ class pure_postgres::config
     notify    => Class['pure_postgres::service::start'],
   }
 
-  file { "${pure_postgres::params::pg_etc_dir}/conf.d/autotune.conf":
-    ensure    => file,
-    owner     => $pure_postgres::params::postgres_user,
-    group     => $pure_postgres::params::postgres_group,
-    mode      => '0640',
-    content   => epp('pure_postgres/autotune.epp'),
-    show_diff => false,
-    notify    => Class['pure_postgres::service::restart'],
+  if ! ($pure_postgres::autotune_profile in [ 'oltp', 'olap', 'mixed' ]) {
+    fail("Not a valid autotune profile: ${pure_postgres::autotune_profile}.")
+  }
+
+  #pg_autotune.py writes settings for the hardware (cpus, memory, numa, huge pages, storage) and the workload.
+  #It runs on the node itself, since the hardware is read from /proc and /sys.
+  file { "${pure_postgres::params::pg_bin_dir}/pg_autotune.py":
+    ensure  => file,
+    owner   => $pure_postgres::params::postgres_user,
+    group   => $pure_postgres::params::postgres_group,
+    mode    => '0750',
+    source  => 'puppet:///modules/pure_postgres/pg_autotune.py',
+    require => Package[$pure_postgres::params::pg_package],
+  }
+
+  $autotune_cmd = shellquote( "${pure_postgres::params::pg_bin_dir}/pg_autotune.py", '--profile', $pure_postgres::autotune_profile,
+                              '--max-connections', $pure_postgres::max_connections, '--pg-version', $pure_postgres::params::pg_version,
+                              '--data-dir', $pure_postgres::pg_data_dir, '--output', "${pure_postgres::params::pg_etc_dir}/conf.d/autotune.conf")
+
+  exec { "exec ${autotune_cmd}":
+    user    => $pure_postgres::params::postgres_user,
+    command => $autotune_cmd,
+    unless  => "${autotune_cmd} --check",
+    require => [ File["${pure_postgres::params::pg_bin_dir}/pg_autotune.py"], File["${pure_postgres::params::pg_etc_dir}/conf.d"] ],
+    notify  => Class['pure_postgres::service::restart'],
   }
 
   if $pure_postgres::do_syslog {
@@ -18,6 +18,9 @@
 # == Class: pure_postgres::config::pg_hba
 #
 # Change pg_hba on a postgrespure database server
+# With $shard, a new rule is added to that file (included by the pg_hba file, relative to its folder).
+# With $users_file, the user is added to (or removed from) that @file list (relative to the folder of the file
+# with the rule), and the rule has @users_file as user. The rule is removed when the list has no users left.
 define pure_postgres::config::pg_hba
 (
   $database        = undef,
@@ -28,18 +31,24 @@ define pure_postgres::config::pg_hba
   $source          = undef,
   $connection_type = undef,
   $user            = undef,
+  $users_file      = '',
+  $shard           = '',
 
 )
 {
 
-  $cmd = shellquote( "${pure_postgres::pg_bin_dir}/modify_pg_hba.py", '-c', '-d', $database, '-f', $pg_hba_file, '-m', $method,
-                      '-n', $netmask, '--state', $state, '-s', $source, '-t', $connection_type, '-u', $user , '--reload')
+  $cmd = shellquote( "${pure_postgres::pg_bin_dir}/modify_pg_hba_client.py", '-c', '-d', $database, '-f', $pg_hba_file, '-m', $method,
+                      '-n', $netmask, '--state', $state, '-s', $source, '-t', $connection_type, '-u', $user , '--reload',
+                      '--users-file', $users_file, '--shard', $shard,
+                      '--pid-file', $pure_postgres::params::pg_pid_file, '--cache', "${pg_hba_file}.cache")
 
   exec { "exec ${cmd}":
-    user    => $pure_postgres::config::postgres_user,
-    command => $cmd,
-    require => File["${pure_postgres::params::pg_bin_dir}/modify_pg_hba.py"],
-    unless  => "${cmd} --check",
+    user        => $pure_postgres::config::postgres_user,
+    command     => $cmd,
+    environment => [ "PG_HBA_SOCKET=${pure_postgres::params::pg_hba_socket}" ],
+    require     => [ File["${pure_postgres::params::pg_bin_dir}/modify_pg_hba.py"],
+                      File["${pure_postgres::params::pg_bin_dir}/modify_pg_hba_client.py"] ],
+    unless      => "${cmd} --check",
   }
 
 }
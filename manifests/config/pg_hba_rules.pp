@@ -0,0 +1,125 @@
+# Copyright (C) 2017 Collaboration of KPN and Splendid Data
+#
+# This file is part of puppet_pure_postgres.
+#
+# puppet_pure_barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# puppet_pure_postgres is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with puppet_pure_postgres.  If not, see <http://www.gnu.org/licenses/>.
+
+# == Define: pure_postgres::config::pg_hba_rules
+#
+# Change many pg_hba rules on a postgrespure database server with one exec.
+# $rules is a hash of rule name => hash with the parameters of pure_postgres::config::pg_hba, like:
+#   { 'app' => { 'database' => 'app', 'user' => 'app_user', 'source' => '10.0.0.0/8' } }
+# All rules are checked and applied in one run of modify_pg_hba.py, which writes and reloads at most once.
+# With $compact, the file is written compacted (sibling networks merged, databases and users folded into lists,
+# and rules without effect dropped), without changing which connections are allowed.
+# With $traffic_file (counts of connections per rule, see modify_pg_hba.py --log), rules that match most connections
+# are written first, where that doesn't change which rule matches a connection.
+# With $purge, $rules is the complete set of rules of the file: all other rules are removed (also the rules of
+# pure_postgres::config::pg_hba). Only use it for the one set of rules that manages the whole file.
+# Rules can be put in a file included by the pg_hba file (shard, relative to the folder of the pg_hba file),
+# and can keep their users in an @file list (users_file), like pure_postgres::config::pg_hba.
+# With $clusters (config folders of instances of postgres-9.6@.service, like '/etc/pgpure/postgres/9.6/*'),
+# the rules are applied to the pg_hba.conf of every cluster instead of $pg_hba_file, in parallel.
+# Every cluster has its own lock, cache and reload (by the postmaster.pid in its data directory).
+define pure_postgres::config::pg_hba_rules
+(
+  $rules        = {},
+  $pg_hba_file  = $pure_postgres::config::pg_hba_conf,
+  $batch_file   = "${pure_postgres::params::pg_etc_dir}/pg_hba_rules_${title}.json",
+  $compact      = false,
+  $traffic_file = undef,
+  $purge        = false,
+  $clusters     = [],
+)
+{
+
+  if $title !~ /(?im-x:^[a-z_][a-z_0-9]*$)/ {
+    fail("Not a valid name for a set of pg_hba rules: ${title}.")
+  }
+
+  #Parameters of pure_postgres::config::pg_hba and their names in a batch file of modify_pg_hba.py
+  $batch_keys = {
+    'connection_type' => 'contype',
+    'database'        => 'databases',
+    'user'            => 'users',
+    'source'          => 'source',
+    'netmask'         => 'netmask',
+    'method'          => 'method',
+    'state'           => 'state',
+    'users_file'      => 'users_file',
+    'shard'           => 'shard',
+  }
+
+  $batch_rules = $rules.map |$rule_name, $rule| {
+    if "${rule_name}" !~ /^[^"\\]*$/ {
+      fail("Not a valid name for a pg_hba rule: ${rule_name}.")
+    }
+    $batch_fields = $rule.map |$key, $value| {
+      if ! ($key in $batch_keys) {
+        fail("Not a valid parameter ${key} for pg_hba rule ${rule_name}.")
+      }
+      if "${value}" !~ /^[^"\\]*$/ {
+        fail("Not a valid value for ${key} of pg_hba rule ${rule_name}: ${value}.")
+      }
+      "\"${batch_keys[$key]}\": \"${value}\""
+    }
+    $name_field = "\"name\": \"${rule_name}\""
+    $rule_fields = join([$name_field] + $batch_fields, ', ')
+    "  { ${rule_fields} }"
+  }
+
+  $batch_content = join($batch_rules, ",\n")
+
+  file { $batch_file:
+    ensure  => file,
+    owner   => $pure_postgres::config::postgres_user,
+    group   => $pure_postgres::config::postgres_group,
+    mode    => '0640',
+    content => "[\n${batch_content}\n]\n",
+  }
+
+  $compact_args = $compact ? {
+    true    => [ '--compact' ],
+    default => [],
+  }
+
+  $purge_args = $purge ? {
+    true    => [ '--purge' ],
+    default => [],
+  }
+
+  $traffic_args = $traffic_file ? {
+    undef   => [],
+    default => [ '--traffic', $traffic_file ],
+  }
+
+  #The cache of every cluster is in its own folder (relative to it)
+  $target_args = $clusters ? {
+    []      => [ '-c', '-f', $pg_hba_file, '--pid-file', $pure_postgres::params::pg_pid_file, '--cache', "${pg_hba_file}.cache" ],
+    default => [ $clusters.map |$cluster| { [ '--cluster', $cluster ] }, '--cache', 'pg_hba.conf.cache' ],
+  }
+
+  $cmd = shellquote( "${pure_postgres::pg_bin_dir}/modify_pg_hba_client.py", $target_args, '--batch', $batch_file, '--reload',
+                      $compact_args, $traffic_args, $purge_args)
+
+  exec { "exec ${cmd}":
+    user        => $pure_postgres::config::postgres_user,
+    command     => $cmd,
+    environment => [ "PG_HBA_SOCKET=${pure_postgres::params::pg_hba_socket}" ],
+    require     => [ File["${pure_postgres::params::pg_bin_dir}/modify_pg_hba.py"],
+                      File["${pure_postgres::params::pg_bin_dir}/modify_pg_hba_client.py"], File[$batch_file] ],
+    unless      => "${cmd} --check",
+  }
+
+}
@@ -58,5 +58,11 @@ class pure_postgres::params
 
   $manage_service     = true
   $autorestart        = true
+
+  $pg_hba_daemon      = false
+  $pg_hba_socket      = '/run/pure_postgres_hba/modify_pg_hba.sock'
+
+  $autotune_profile   = 'mixed'
+  $max_connections    = 100
 }
 
@@ -17,17 +17,41 @@
 
 # == Class: pure_postgres::service::started
 #
-# Wait until postgres is started
+# Wait until postgres is started (accepts connections), for at most $timeout seconds (default 300).
+# pg_ready.py probes with the status in postmaster.pid and a startup message on the unix socket,
+# with a short sleep between probes at first, and a longer sleep (up to 1 second) while postgres is starting.
+#
+# $retries and $sleep are deprecated: they where the number of tries and the seconds between them of the psql loop
+# that pg_ready.py replaced. When $timeout isn't set and either of them is, postgres is waited for as long as that loop
+# would have waited ($retries * $sleep seconds, with the defaults of 5 and 1 that the loop had).
 
 define pure_postgres::service::started
 (
-  $retries     = 5,
-  $sleep       = 1,
+  $timeout     = undef,
+  $retries     = undef,
+  $sleep       = undef,
 )
 {
 
-  $cmd = shellquote( 'bash', '-c', "for ((i=0;i<${retries};i++)); do 
-                        echo 'select datname from pg_database' | psql -q -t 2>&1 && break; sleep ${sleep}; done" )
+  if $timeout != undef {
+    $wait_timeout = $timeout
+  } elsif $retries != undef or $sleep != undef {
+    $wait_retries = $retries ? {
+      undef   => 5,
+      default => $retries,
+    }
+    $wait_sleep = $sleep ? {
+      undef   => 1,
+      default => $sleep,
+    }
+    $wait_timeout = $wait_retries * $wait_sleep
+    warning("pure_postgres::service::started: \$retries and \$sleep are deprecated, use \$timeout (now ${wait_timeout} seconds).")
+  } else {
+    $wait_timeout = 300
+  }
+
+  $cmd = shellquote( "${pure_postgres::params::pg_bin_dir}/pg_ready.py", '--pid-file', $pure_postgres::params::pg_pid_file,
+                      '--timeout', $wait_timeout )
 
   exec { $title:
     user     => $pure_postgres::params::postgres_user,
@@ -35,8 +59,9 @@ define pure_postgres::service::started
     onlyif   => "test -f '${pure_postgres::params::pg_pid_file}'",
     path     => "${pure_postgres::params::pg_bin_dir}:/usr/local/bin:/bin",
     cwd      => $pure_postgres::params::pg_bin_dir,
+    timeout  => $wait_timeout + 10,
     loglevel => 'debug',
+    require  => File["${pure_postgres::params::pg_bin_dir}/pg_ready.py"],
   }
 
 }
-
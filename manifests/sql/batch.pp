@@ -0,0 +1,93 @@
+# Copyright (C) 2017 Collaboration of KPN and Splendid Data
+#
+# This file is part of puppet_pure_postgres.
+#
+# puppet_pure_barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# puppet_pure_postgres is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with puppet_pure_postgres.  If not, see <http://www.gnu.org/licenses/>.
+
+# == Define: pure_postgres::sql::batch
+#
+# Run many sql statements with one exec. $items is a hash of item name => hash with sql, unless (optional) and
+# db (default postgres), like the parameters of pure_postgres::sql::run_sql:
+#   { 'grant select on t to app' => { 'sql' => 'grant select on table t to app;', 'db' => 'app',
+#                                     'unless' => "select 'yes' where has_table_privilege('app', 't', 'select')" } }
+# A statement runs when its unless query returns no rows (or when it has no unless query).
+# pg_sql_batch.py evaluates all unless queries of a database with one query, and runs the statements that are needed
+# in one transaction, over one connection per database. Items that fail are rolled back on their own, and reported.
+define pure_postgres::sql::batch
+(
+  $items      = {},
+  $batch_file = "${pure_postgres::params::pg_etc_dir}/sql_batch_${title}.json",
+)
+{
+
+  if $title !~ /(?im-x:^[a-z_][a-z_0-9]*$)/ {
+    fail("Not a valid name for a batch of sql statements: ${title}.")
+  }
+
+  $batch_items = $items.map |$item_name, $item| {
+    $item.each |$key, $value| {
+      if ! ($key in [ 'sql', 'unless', 'db' ]) {
+        fail("Not a valid parameter ${key} for sql item ${item_name}.")
+      }
+    }
+    if ! $item['sql'] {
+      fail("No sql for sql item ${item_name}.")
+    }
+    $db = $item['db'] ? {
+      undef   => 'postgres',
+      default => $item['db'],
+    }
+    $unless = $item['unless'] ? {
+      undef   => '',
+      default => $item['unless'],
+    }
+    if $db !~ /(?im-x:^[a-z_][a-z_0-9$]*$)/ {
+      fail("Not a valid name for a database: ${db}.")
+    }
+    #Statements and queries have quotes (and can have newlines), which are escaped for json
+    $item_fields = { 'name' => $item_name, 'sql' => $item['sql'], 'unless' => $unless, 'db' => $db }
+    $json_fields = $item_fields.map |$key, $value| {
+      $escaped = regsubst(regsubst(regsubst(regsubst(regsubst("${value}", '\\\\', '\\\\\\\\', 'G'), '"', '\\\\"', 'G'),
+                                                    "\n", '\\\\n', 'G'), "\r", '\\\\r', 'G'), "\t", '\\\\t', 'G')
+      "\"${key}\": \"${escaped}\""
+    }
+    $item_json = join($json_fields, ', ')
+    "  { ${item_json} }"
+  }
+
+  $batch_content = join($batch_items, ",\n")
+
+  file { $batch_file:
+    ensure  => file,
+    owner   => $pure_postgres::params::postgres_user,
+    group   => $pure_postgres::params::postgres_group,
+    mode    => '0640',
+    content => "[\n${batch_content}\n]\n",
+  }
+
+  $cmd = shellquote("${pure_postgres::params::pg_bin_dir}/pg_sql_batch.py", '--pid-file', $pure_postgres::params::pg_pid_file,
+                    '--batch', $batch_file)
+
+  exec { "exec ${cmd}":
+    user    => $pure_postgres::params::postgres_user,
+    command => $cmd,
+    unless  => "${cmd} --check",
+    onlyif  => "/bin/test -f ${pure_postgres::params::pg_data_dir}/PG_VERSION",
+    cwd     => $pure_postgres::params::pg_bin_dir,
+    require => [ File["${pure_postgres::params::pg_bin_dir}/pg_sql_batch.py"], File[$batch_file] ],
+  }
+
+  Pure_postgres::Service::Started['postgres started'] -> Exec["exec ${cmd}"]
+
+}
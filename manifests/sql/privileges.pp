@@ -0,0 +1,145 @@
+# Copyright (C) 2017 Collaboration of KPN and Splendid Data
+#
+# This file is part of puppet_pure_postgres.
+#
+# puppet_pure_barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# puppet_pure_postgres is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with puppet_pure_postgres.  If not, see <http://www.gnu.org/licenses/>.
+
+# == Define: pure_postgres::sql::privileges
+#
+# Manage roles and privileges as one desired state, with one exec.
+# $roles is a hash of role name => attributes (login, superuser, replication, createdb, createrole and inherit as booleans,
+# password_hash, and member_of as a list of roles). Only the attributes that are set are managed.
+# $grants and $revokes are hashes of name => hash with role, privilege, object_type, object, db (default postgres)
+# and with_grant (grants only), like the parameters of pure_postgres::sql::grant:
+#   { 'app reads t' => { 'role' => 'app', 'privilege' => 'select', 'object_type' => 'table', 'object' => 't', 'db' => 'app' } }
+# pg_privileges.py reads the acls of all objects with one query per database, and runs only the grant, revoke,
+# create role and alter role statements that are needed to get from there to the desired state.
+# This is an opt-in replacement for pure_postgres::sql::grant, revoke and role (which still run an exec per statement):
+# don't manage the same roles or privileges with both.
+define pure_postgres::sql::privileges
+(
+  $roles        = {},
+  $grants       = {},
+  $revokes      = {},
+  $desired_file = "${pure_postgres::params::pg_etc_dir}/privileges_${title}.json",
+)
+{
+
+  if $title !~ /(?im-x:^[a-z_][a-z_0-9]*$)/ {
+    fail("Not a valid name for privileges: ${title}.")
+  }
+
+  $role_items = $roles.map |$role_name, $role| {
+    if $role_name !~ /(?im-x:^[a-z_][a-z_0-9$]*$)/ {
+      fail("Not a valid name for a postgres role: ${role_name}.")
+    }
+    $role_fields = $role.map |$key, $value| {
+      if $key in [ 'login', 'superuser', 'replication', 'createdb', 'createrole', 'inherit' ] {
+        $bool_value = $value ? {
+          true    => 'true',
+          default => 'false',
+        }
+        "\"${key}\": ${bool_value}"
+      }
+      elsif $key == 'password_hash' {
+        if $value !~ /^md5[0-9a-f]{32}$/ {
+          fail("You can only use a md5 hashed password for role ${role_name}.")
+        }
+        "\"${key}\": \"${value}\""
+      }
+      elsif $key == 'member_of' {
+        $groups = $value.map |$group| {
+          if $group !~ /(?im-x:^[a-z_][a-z_0-9$]*$)/ {
+            fail("Not a valid name for a postgres role: ${group}.")
+          }
+          "\"${group}\""
+        }
+        $groups_json = join($groups, ', ')
+        "\"${key}\": [ ${groups_json} ]"
+      }
+      else {
+        fail("Not a valid parameter ${key} for role ${role_name}.")
+      }
+    }
+    $role_json = join([ "\"name\": \"${role_name}\"" ] + $role_fields, ', ')
+    "    { ${role_json} }"
+  }
+
+  $grant_lists = [ [ 'grants', $grants ], [ 'revokes', $revokes ] ].map |$list| {
+    $list_items = $list[1].map |$item_name, $item| {
+      $item.each |$key, $value| {
+        if ! ($key in [ 'role', 'privilege', 'object_type', 'object', 'db', 'with_grant' ]) {
+          fail("Not a valid parameter ${key} for ${list[0]} ${item_name}.")
+        }
+      }
+      $db = $item['db'] ? {
+        undef   => 'postgres',
+        default => $item['db'],
+      }
+      $with_grant = $item['with_grant'] ? {
+        true    => 'true',
+        default => 'false',
+      }
+      if $item['role'] !~ /(?im-x:^[a-z_][a-z_0-9$]*$)/ {
+        fail("Not a valid name for a database role: ${item['role']} (${list[0]} ${item_name}).")
+      }
+      if $item['privilege'] !~ /(?im-x:^[a-z ,]+$)/ {
+        fail("Not a valid privilege ${item['privilege']} (${list[0]} ${item_name}).")
+      }
+      if $item['object_type'] !~ /(?im-x:^[a-z ]+$)/ {
+        fail("Not a valid object type ${item['object_type']} (${list[0]} ${item_name}).")
+      }
+      if $item['object'] !~ /(?im-x:^[a-z_0-9$ ().,]+$)/ {
+        fail("Not a valid name for a database object: ${item['object']} (${list[0]} ${item_name}).")
+      }
+      if $db !~ /(?im-x:^[a-z_][a-z_0-9$]*$)/ {
+        fail("Not a valid name for a database: ${db}.")
+      }
+      #The name is free text, so quotes and backslashes are escaped for json
+      $json_name = regsubst(regsubst("${item_name}", '\\\\', '\\\\\\\\', 'G'), '"', '\\\\"', 'G')
+      $item_json = join([ "\"name\": \"${json_name}\"", "\"role\": \"${item['role']}\"", "\"privilege\": \"${item['privilege']}\"",
+                          "\"object_type\": \"${item['object_type']}\"", "\"object\": \"${item['object']}\"",
+                          "\"db\": \"${db}\"", "\"with_grant\": ${with_grant}" ], ', ')
+      "    { ${item_json} }"
+    }
+    $list_json = join($list_items, ",\n")
+    "  \"${list[0]}\": [\n${list_json}\n  ]"
+  }
+
+  $roles_json = join($role_items, ",\n")
+  $grants_json = join($grant_lists, ",\n")
+
+  file { $desired_file:
+    ensure  => file,
+    owner   => $pure_postgres::params::postgres_user,
+    group   => $pure_postgres::params::postgres_group,
+    mode    => '0640',
+    content => "{\n  \"roles\": [\n${roles_json}\n  ],\n${grants_json}\n}\n",
+  }
+
+  $cmd = shellquote("${pure_postgres::params::pg_bin_dir}/pg_privileges.py", '--pid-file', $pure_postgres::params::pg_pid_file,
+                    '--desired', $desired_file)
+
+  exec { "exec ${cmd}":
+    user    => $pure_postgres::params::postgres_user,
+    command => "${cmd} --apply",
+    unless  => "${cmd} --check",
+    onlyif  => "/bin/test -f ${pure_postgres::params::pg_data_dir}/PG_VERSION",
+    cwd     => $pure_postgres::params::pg_bin_dir,
+    require => [ File["${pure_postgres::params::pg_bin_dir}/pg_privileges.py"], File[$desired_file] ],
+  }
+
+  Pure_postgres::Service::Started['postgres started'] -> Exec["exec ${cmd}"]
+
+}
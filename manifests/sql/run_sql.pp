@@ -16,6 +16,11 @@
 # along with puppet_pure_postgres.  If not, see <http://www.gnu.org/licenses/>.
 
 # == Deinition: pure_postgres::sql::run_sql
+#
+# Every run_sql (and so every grant, revoke, role, db and extension) is its own exec, which starts pg_sql_batch.py
+# twice (for unless and for the command) with a connection each. Many statements are cheaper as one
+# pure_postgres::sql::batch (or roles and privileges as one pure_postgres::sql::privileges), see
+# benchmarks/bench_sql_batch.py.
 define pure_postgres::sql::run_sql (
   $sql,
   $unless = undef,
@@ -30,20 +35,25 @@ define pure_postgres::sql::run_sql (
     fail("Not a valid name for a database: ${db}.")
   }
 
-  $run_cmd       = shellquote("${pure_postgres::params::pg_bin_dir}/psql", '-c', $sql, '-d', $db)
+  #Statement and guard run over one connection (pg_sql_batch.py), instead of psql for each and a pipe through wc.
+  #The statement is only run when the guard returns no rows, also when puppet runs the command.
+  $run_args = [ "${pure_postgres::params::pg_bin_dir}/pg_sql_batch.py", '--pid-file', $pure_postgres::params::pg_pid_file,
+                '--db', $db, '--sql', $sql ]
   if $unless {
-    $unless_test = shellquote("${pure_postgres::params::pg_bin_dir}/psql", '--quiet', '--tuples-only', '-d', $db, '-c', $unless)
-    $unless_cmd  = "/bin/test $(${unless_test} | wc -l) -gt 1"
+    $unless_args = [ '--unless', $unless ]
+    $unless_cmd  = shellquote($run_args, $unless_args, '--check')
   }  else {
+    $unless_args = []
     $unless_cmd  = undef
   }
 
   exec { "psql ${sql} in ${db}":
     user    => $pure_postgres::params::postgres_user,
-    command => $run_cmd,
+    command => shellquote($run_args, $unless_args),
     unless  => $unless_cmd,
     onlyif  => "/bin/test -f ${pure_postgres::params::pg_data_dir}/PG_VERSION",
     cwd     => $pure_postgres::params::pg_bin_dir,
+    require => File["${pure_postgres::params::pg_bin_dir}/pg_sql_batch.py"],
   }
 
   Pure_postgres::Service::Started['postgres started'] -> Exec["psql ${sql} in ${db}"]
@@ -0,0 +1,123 @@
+#!/usr/bin/python3
+
+'''
+# Copyright (C) 2017 Collaboration of KPN and Splendid Data
+#
+# This file is part of puppet_pure_postgres.
+#
+# puppet_pure_barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# puppet_pure_postgres is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with puppet_pure_postgres.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+'''
+Tests of pg_autotune.py against fixtures: folders in tests/fixtures/autotune with the files of /proc and /sys that
+pg_autotune.py reads (--root) for a machine:
+- small: one cpu and 2GB, on ssd
+- numa: 16 cpus and 64GB over two numa nodes (with zone reclaim), huge pages reserved, on a rotational disk
+- container: 8 cpus and 32GB, limited by cgroup v2 to 2 cpus and 4GB, on ssd (next to a rotational loop device)
+
+Example usage:
+  python3 -m unittest discover -s tests
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'files'))
+
+from pg_autotune import GB, PgAutotune, PgAutotuneError, PgHardware, main
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'autotune')
+
+class PgAutotuneTest(unittest.TestCase):
+    def hardware(self, name):
+        return PgHardware(os.path.join(FIXTURES_DIR, name))
+
+    def settings(self, name, profile='mixed', max_connections=100, pg_version='11'):
+        '''
+        This function returns the settings for a fixture as a dict of name => (value, explanation).
+        '''
+        tuner = PgAutotune(self.hardware(name), profile, max_connections, pg_version)
+        return dict( (setting, (value, ' '.join(explanation))) for setting, value, explanation in tuner.settings() )
+
+    def test_hardware(self):
+        small = self.hardware('small')
+        self.assertEqual((small.cpus, small.memory, small.numa_nodes, small.rotational), (1, 2 * GB, 1, False))
+        numa = self.hardware('numa')
+        self.assertEqual((numa.cpus, numa.memory, numa.numa_nodes, numa.zone_reclaim), (16, 64 * GB, 2, 1))
+        self.assertEqual((numa.huge_pages, numa.huge_page, numa.thp, numa.rotational), (8200, 2048, 'always', True))
+        #Limited by the cgroup, and the loop device isn't storage
+        container = self.hardware('container')
+        self.assertEqual((container.cpus, container.memory, container.rotational), (2, 4 * GB, False))
+
+    def test_memory(self):
+        settings = self.settings('numa')
+        self.assertEqual(settings['shared_buffers'][0], '16GB')
+        self.assertIn('zone_reclaim_mode', settings['shared_buffers'][1])
+        self.assertIn('enough for shared buffers', settings['huge_pages'][1])
+        self.assertIn('always on', settings['huge_pages'][1])
+        self.assertEqual(settings['effective_cache_size'][0], '48GB')
+        self.assertEqual(settings['maintenance_work_mem'][0], '2GB')
+        #(64GB - 16GB) / (100 connections * 3) / 4 workers / 2 for the mixed profile
+        self.assertEqual(settings['work_mem'][0], '20971kB')
+        self.assertEqual(self.settings('numa', 'oltp', 400)['work_mem'][0], '20971kB')
+        self.assertEqual(self.settings('container')['shared_buffers'][0], '1GB')
+
+    def test_parallelism(self):
+        settings = self.settings('small')
+        self.assertEqual(settings['max_parallel_workers_per_gather'][0], 0)
+        self.assertIn('one cpu', settings['max_parallel_workers_per_gather'][1])
+        self.assertEqual(settings['max_worker_processes'][0], 8)
+        self.assertEqual(self.settings('numa')['max_parallel_workers_per_gather'][0], 4)
+        self.assertEqual(self.settings('numa', 'olap')['max_parallel_workers_per_gather'][0], 8)
+        self.assertEqual(self.settings('container')['max_parallel_workers_per_gather'][0], 1)
+
+    def test_versions(self):
+        #Settings that the version of postgres doesn't have are left out
+        settings = self.settings('numa', pg_version='9.4')
+        self.assertNotIn('max_parallel_workers_per_gather', settings)
+        self.assertNotIn('max_wal_size', settings)
+        self.assertIn('checkpoint_segments', settings)
+        self.assertIn('max_parallel_workers', self.settings('numa', pg_version='10'))
+        self.assertRaises(PgAutotuneError, PgAutotune, self.hardware('small'), 'bogus')
+
+    def test_planner(self):
+        self.assertEqual(self.settings('numa')['random_page_cost'][0], 4.0)
+        self.assertEqual(self.settings('container')['random_page_cost'][0], 1.1)
+
+    def test_output(self):
+        folder = tempfile.mkdtemp(prefix='pure_postgres_test_')
+        try:
+            output = os.path.join(folder, 'autotune.conf')
+            args = [ '--root', os.path.join(FIXTURES_DIR, 'numa'), '--output', output ]
+            self.assertEqual(main(args + [ '--check' ]), 1)
+            self.assertEqual(main(args), 0)
+            self.assertEqual(main(args + [ '--check' ]), 0)
+            mtime = os.stat(output).st_mtime
+            main(args)
+            self.assertEqual(os.stat(output).st_mtime, mtime)
+            with open(output) as f:
+                contents = f.read()
+            self.assertIn('cpus: 16, memory: 64.0GB, numa nodes: 2', contents)
+            self.assertIn('\nshared_buffers = 16GB\n', contents)
+            self.assertIn("\nhuge_pages = 'try'\n", contents)
+            self.assertIn('\ncheckpoint_timeout = 15min\n', contents)
+            self.assertEqual(main(args + [ '--check', '--profile', 'olap' ]), 1)
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+
+'''
+# Copyright (C) 2017 Collaboration of KPN and Splendid Data
+#
+# This file is part of puppet_pure_postgres.
+#
+# puppet_pure_barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# puppet_pure_postgres is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with puppet_pure_postgres.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+'''
+Tests of pg_hba.py --cluster (run_clusters) against temporary cluster folders, each with a pg_hba.conf and a fake
+postmaster: a process that writes a line to a file for every SIGHUP it gets, with a postmaster.pid that points to it.
+One cluster keeps its postmaster.pid in a data directory that its postgresql.conf sets, the other in the folder itself.
+
+Example usage:
+  python3 -m unittest discover -s tests
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+FILES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'files')
+
+#The fake postmaster: it writes a line to the file in argv[1] for every SIGHUP, and says when its handler is set
+FAKE_POSTMASTER = '''
+import sys, time, signal
+def hup(signum, frame):
+    with open(sys.argv[1], 'a') as f:
+        f.write('hup\\n')
+signal.signal(signal.SIGHUP, hup)
+sys.stdout.write('ready\\n')
+sys.stdout.flush()
+while True:
+    time.sleep(1)
+'''
+
+RULES = [ { 'name': 'app', 'databases': 'app', 'users': 'app_user', 'source': '10.0.0.0/8' },
+          { 'name': 'backup', 'databases': 'replication', 'users': 'barman', 'source': '10.1.2.3/32' } ]
+
+class PgHbaClustersTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='pure_postgres_test_')
+        self.postmasters = []
+        #A cluster with its data directory below its config folder, and one with both in the same folder
+        self.clusters = [ os.path.join(self.folder, 'main'), os.path.join(self.folder, 'other') ]
+        self.add_cluster(self.clusters[0], 'data')
+        self.add_cluster(self.clusters[1], None)
+        self.batch_file = os.path.join(self.folder, 'rules.json')
+        with open(self.batch_file, 'w') as f:
+            json.dump(RULES, f)
+
+    def tearDown(self):
+        for postmaster in self.postmasters:
+            postmaster.kill()
+            postmaster.wait()
+            postmaster.stdout.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def add_cluster(self, folder, data_dir, pg_hba='local all all trust\n'):
+        '''
+        This procedure creates a cluster folder with a pg_hba.conf, and starts a fake postmaster for it.
+        '''
+        os.mkdir(folder)
+        with open(os.path.join(folder, 'pg_hba.conf'), 'w') as f:
+            f.write(pg_hba)
+        pid_folder = folder
+        if data_dir:
+            with open(os.path.join(folder, 'postgresql.conf'), 'w') as f:
+                f.write("port = 5432\ndata_directory = '{0}'\n".format(data_dir))
+            pid_folder = os.path.join(folder, data_dir)
+            os.mkdir(pid_folder)
+        postmaster = subprocess.Popen([ sys.executable, '-c', FAKE_POSTMASTER, os.path.join(folder, 'hups') ],
+                                      stdout=subprocess.PIPE)
+        postmaster.stdout.readline()
+        self.postmasters.append(postmaster)
+        with open(os.path.join(pid_folder, 'postmaster.pid'), 'w') as f:
+            f.write('{0}\n{1}\n1500000000\n5432\n{1}\n'.format(postmaster.pid, pid_folder))
+
+    def run_clusters(self, *args):
+        '''
+        This function runs pg_hba.py for all cluster folders, and returns the exit code and the report.
+        '''
+        proc = subprocess.Popen([ sys.executable, os.path.join(FILES_DIR, 'pg_hba.py'), '--cluster',
+                                  os.path.join(self.folder, '*'), '--batch', self.batch_file, '--jobs', '2' ] +
+                                list(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        self.assertEqual(err.decode('utf-8'), '')
+        return proc.returncode, json.loads(out.decode('utf-8'))
+
+    def hups(self, folder, expected, wait=2.0):
+        '''
+        This function returns the number of SIGHUPs the fake postmaster of a cluster handled, after waiting
+        (at most wait seconds) until it handled expected.
+        '''
+        deadline = time.time() + wait
+        while True:
+            try:
+                with open(os.path.join(folder, 'hups')) as f:
+                    count = len(f.readlines())
+            except IOError:
+                count = 0
+            if count >= expected or time.time() > deadline:
+                return count
+            time.sleep(0.01)
+
+    def rules(self, folder):
+        with open(os.path.join(folder, 'pg_hba.conf')) as f:
+            return sorted( line.split()[2] for line in f if line.startswith('host') )
+
+    def test_clusters(self):
+        rc, report = self.run_clusters('--reload', '--cache', 'pg_hba.conf.cache')
+        self.assertEqual(rc, 0)
+        self.assertTrue(report['changed'])
+        self.assertEqual(report['failed'], [])
+        self.assertEqual(report['jobs'], 2)
+        self.assertEqual(sorted(report['clusters']), self.clusters)
+        for folder in self.clusters:
+            result = report['clusters'][folder]
+            self.assertEqual(result['file'], os.path.join(folder, 'pg_hba.conf'))
+            self.assertEqual(result['exit'], 0)
+            self.assertTrue(result['changed'])
+            self.assertEqual(self.rules(folder), [ 'app_user', 'barman' ])
+            #Every cluster has its own cache, and is reloaded by the pid in its own data directory
+            self.assertTrue(os.path.exists(os.path.join(folder, 'pg_hba.conf.cache')))
+            self.assertEqual(self.hups(folder, 1), 1)
+        #Nothing changes the second time
+        rc, report = self.run_clusters('--check')
+        self.assertEqual(rc, 0)
+        self.assertFalse(report['changed'])
+
+    def test_failed_cluster(self):
+        #A cluster that fails is reported, and doesn't keep the others from being changed
+        broken = os.path.join(self.folder, 'broken')
+        self.add_cluster(broken, None, 'host all all 10.0.0.0/33 md5\n')
+        rc, report = self.run_clusters()
+        self.assertEqual(rc, 1)
+        self.assertEqual(report['failed'], [ broken ])
+        self.assertIn('10.0.0.0/33', '\n'.join(report['clusters'][broken]['errors']))
+        for folder in self.clusters:
+            self.assertEqual(self.rules(folder), [ 'app_user', 'barman' ])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+
+'''
+# Copyright (C) 2017 Collaboration of KPN and Splendid Data
+#
+# This file is part of puppet_pure_postgres.
+#
+# puppet_pure_barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# puppet_pure_postgres is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with puppet_pure_postgres.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+'''
+Tests of compaction of pg_hba files (PgHbaCompactor): generated files are written with and without compact, and
+for every generated connection, the rule that postgres would use (PgHbaMatcher) should have the same method and
+options in both files.
+
+Example usage:
+  python3 -m unittest discover -s tests
+'''
+
+import os
+import sys
+import random
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'files'))
+
+from pg_hba import PgHba, PgHbaSpecDefaults, PgHbaTypes, fields_to_rule, tokenize_hba
+
+#Sources are picked so that networks overlap, nest and are siblings (which compaction merges).
+#Databases and users are single items, like new_rules creates them: with compact, lists are expanded when a file is
+#read (see PgHba.expand_rule), which can sort them differently than the list did.
+SOURCES   = [ 'all', 'samenet', 'samehost', 'db.example.com', '10.0.0.0/8', '10.0.0.5/32', '10.0.0.4/32',
+              'fe80::/64', '10.0.0.0 255.255.255.0' ]
+DATABASES = [ 'all', 'a', 'b', 'c', 'replication', 'sameuser', 'samerole' ]
+USERS     = [ 'all', 'x', 'y', 'z', '+g' ]
+METHODS   = [ 'md5', 'md5', 'trust', 'reject' ]
+
+#Connections: every combination of these is matched
+CONNECT_DATABASES = [ 'a', 'b', 'c', 'x', 'replication', 'other' ]
+CONNECT_USERS     = [ 'x', 'y', 'z' ]
+CONNECT_ADDRESSES = [ '10.0.0.5', '10.0.0.4', '10.0.0.70', '10.0.0.200', '10.0.1.9', '10.0.3.130', '10.2.3.4',
+                      'fe80::1', '192.168.0.1' ]
+MEMBERS         = { 'g': [ 'x' ], 'a': [ 'y' ] }
+SERVER_NETWORKS = [ '10.0.0.5/16' ]
+
+TRIALS = 40
+
+'''
+This function returns a random line of a pg_hba file.
+'''
+def random_line(rnd):
+    contype = rnd.choice(PgHbaTypes + [ 'host', 'host' ])
+    fields  = [ contype, rnd.choice(DATABASES), rnd.choice(USERS) ]
+    if contype != 'local':
+        fields.append(rnd.choice(SOURCES +
+                                 [ '10.{0}.0.0/16'.format(rnd.randint(0, 3)),
+                                   '10.0.{0}.0/24'.format(rnd.randint(0, 3)),
+                                   '10.0.{0}.{1}/25'.format(rnd.randint(0, 3), rnd.choice([ 0, 128 ])),
+                                   '10.0.0.{0}/26'.format(rnd.choice([ 0, 64, 128, 192 ])) ]))
+    fields.append(rnd.choice(METHODS))
+    return '\t'.join(fields)
+
+class PgHbaCompactTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='pure_postgres_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def write(self, name, lines, compact):
+        '''
+        This function writes lines to a pg_hba file, applies one (new) rule with compact set or not, and returns the
+        rules of the file as it was written (in the order of the file, like postgres reads them).
+        '''
+        path = os.path.join(self.folder, name)
+        with open(path, 'w') as f:
+            f.write(''.join( line + '\n' for line in lines ))
+        pg_hba = PgHba(path, compact=compact)
+        spec = dict(PgHbaSpecDefaults, contype='local', method='peer')
+        pg_hba.apply_edit([ spec ])
+        pg_hba.write()
+        with open(path) as f:
+            return [ fields_to_rule(fields, path, lineno) for lineno, fields, comment in tokenize_hba(f, path) if fields ]
+
+    def verdicts(self, rules):
+        '''
+        This function returns the method and options of the matching rule (or None) for every connection.
+        '''
+        matcher = PgHba().matcher(MEMBERS, SERVER_NETWORKS, rules)
+        verdicts = {}
+        for contype in PgHbaTypes:
+            for database in CONNECT_DATABASES:
+                for user in CONNECT_USERS:
+                    for address in CONNECT_ADDRESSES:
+                        rule = matcher.match(contype, database, user, address)
+                        verdicts[(contype, database, user, address)] = rule and (rule.method, rule.options)
+        return verdicts
+
+    def test_same_verdicts(self):
+        rnd = random.Random(1)
+        removed = 0
+        for trial in range(TRIALS):
+            lines = [ random_line(rnd) for pos in range(rnd.randint(1, 60)) ]
+            rules     = self.write('pg_hba.conf', lines, False)
+            compacted = self.write('pg_hba.compact.conf', lines, True)
+            self.assertLessEqual(len(compacted), len(rules))
+            removed += len(rules) - len(compacted)
+            before, after = self.verdicts(rules), self.verdicts(compacted)
+            for connection in sorted(before):
+                self.assertEqual(before[connection], after[connection],
+                                 'trial {0}, connection {1}:\n{2}'.format(trial, connection, '\n'.join(lines)))
+        #Else the test proves nothing
+        self.assertGreater(removed, 0)
+
+if __name__ == "__main__":
+    unittest.main()
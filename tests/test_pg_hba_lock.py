@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+
+'''
+# Copyright (C) 2017 Collaboration of KPN and Splendid Data
+#
+# This file is part of puppet_pure_postgres.
+#
+# puppet_pure_barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# puppet_pure_postgres is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with puppet_pure_postgres.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+'''
+Tests of concurrent runs of pg_hba.py on one file (PgHbaLock, PgHbaSpool and apply_merged): the test holds the lock
+while the runs put their edits in the spool, so that the run that gets the lock next applies all of them.
+Reloads go to a fake postmaster: a process that writes a line to a file for every SIGHUP it gets.
+
+Example usage:
+  python3 -m unittest discover -s tests
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+FILES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'files')
+sys.path.insert(0, FILES_DIR)
+
+from pg_hba import PgHbaLock, PgHbaSpool, PgHbaSpecDefaults, cli_parser, pg_hba_settings
+
+#The fake postmaster: it writes a line to the file in argv[1] for every SIGHUP, and says when its handler is set
+FAKE_POSTMASTER = '''
+import sys, time, signal
+def hup(signum, frame):
+    with open(sys.argv[1], 'a') as f:
+        f.write('hup\\n')
+signal.signal(signal.SIGHUP, hup)
+sys.stdout.write('ready\\n')
+sys.stdout.flush()
+while True:
+    time.sleep(1)
+'''
+
+RUNS = 5
+
+class PgHbaLockTest(unittest.TestCase):
+    def setUp(self):
+        self.folder      = tempfile.mkdtemp(prefix='pure_postgres_test_')
+        self.pg_hba_file = os.path.join(self.folder, 'pg_hba.conf')
+        self.pid_file    = os.path.join(self.folder, 'postmaster.pid')
+        self.hups_file   = os.path.join(self.folder, 'hups')
+        with open(self.pg_hba_file, 'w') as f:
+            f.write('local all all trust\n')
+        self.postmaster = subprocess.Popen([ sys.executable, '-c', FAKE_POSTMASTER, self.hups_file ],
+                                           stdout=subprocess.PIPE)
+        self.postmaster.stdout.readline()
+        with open(self.pid_file, 'w') as f:
+            f.write('{0}\n{1}\n1500000000\n5432\n{1}\n'.format(self.postmaster.pid, self.folder))
+        self.spool = PgHbaSpool(self.pg_hba_file + '.spool')
+
+    def tearDown(self):
+        self.postmaster.kill()
+        self.postmaster.wait()
+        self.postmaster.stdout.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def args(self, pos):
+        '''
+        This function returns the arguments of a run that adds a rule for user{pos}.
+        '''
+        return [ '-f', self.pg_hba_file, '-t', 'host', '-d', 'all', '-u', 'user{0}'.format(pos),
+                 '-s', '10.0.0.{0}/32'.format(pos), '-m', 'md5', '--reload', '--pid-file', self.pid_file,
+                 '--reload-window', '0.2', '--stats' ]
+
+    def spooled(self):
+        return [ name for name in os.listdir(self.spool.folder) if name.endswith('.edit') ]
+
+    def run_locked(self, spooled=0):
+        '''
+        This function starts RUNS runs while the lock is held, waits until their edits are in the spool (next to
+        spooled edits of the test itself), releases the lock, and returns the stats of every run.
+        '''
+        lock = PgHbaLock(self.pg_hba_file + '.lock')
+        lock.acquire()
+        procs = []
+        try:
+            for pos in range(RUNS):
+                procs.append(subprocess.Popen([ sys.executable, os.path.join(FILES_DIR, 'pg_hba.py') ] +
+                                              self.args(pos), stdout=subprocess.PIPE, stderr=subprocess.PIPE))
+            deadline = time.time() + 10
+            while len(self.spooled()) < RUNS + spooled and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            lock.release()
+        stats = []
+        for proc in procs:
+            out, err = proc.communicate()
+            self.assertEqual(proc.returncode, 0, err)
+            stats.append(json.loads(err.decode('utf-8').strip().splitlines()[-1]))
+        return stats
+
+    def hups(self, expected, wait=2.0):
+        '''
+        This function returns the number of SIGHUPs the fake postmaster handled, after waiting (at most wait seconds)
+        until it handled expected.
+        '''
+        deadline = time.time() + wait
+        while True:
+            try:
+                with open(self.hups_file) as f:
+                    count = len(f.readlines())
+            except IOError:
+                count = 0
+            if count >= expected or time.time() > deadline:
+                return count
+            time.sleep(0.01)
+
+    def rules(self):
+        with open(self.pg_hba_file) as f:
+            return [ line.split()[2] for line in f if line.startswith('host') ]
+
+    def spec(self, **kwargs):
+        spec = dict(PgHbaSpecDefaults)
+        spec.update(kwargs)
+        return spec
+
+    def test_merged(self):
+        #No update is lost, and all of them are written and reloaded once
+        stats = self.run_locked()
+        self.assertEqual(sorted(self.rules()), [ 'user{0}'.format(pos) for pos in range(RUNS) ])
+        self.assertEqual([ stat['counters']['merged'] for stat in stats ], [ RUNS ] * RUNS)
+        self.assertEqual(sum( stat['counters'].get('written', 0) for stat in stats ), 1)
+        self.assertEqual(self.hups(1), 1)
+        self.assertEqual(self.hups(2, wait=0.5), 1)
+        self.assertEqual(os.listdir(self.spool.folder), [])
+
+    def test_failing_edit(self):
+        #An edit that fails (not validated, like from another version) gets an error, and doesn't hold up the others
+        settings = pg_hba_settings(cli_parser().parse_args(self.args(0)))
+        name = self.spool.submit([ self.spec(contype='host', users='bad', source='10.0.1.1/32', method='bogus') ],
+                                 settings, True)
+        self.run_locked(spooled=1)
+        self.assertEqual(sorted(self.rules()), [ 'user{0}'.format(pos) for pos in range(RUNS) ])
+        self.assertIn('bogus', self.spool.result(name)['error'])
+        self.assertEqual(self.hups(1), 1)
+        self.assertEqual(os.listdir(self.spool.folder), [])
+
+    def test_other_settings(self):
+        #An edit with other settings is left to its own process, and one of a process that is gone is dropped
+        settings = pg_hba_settings(cli_parser().parse_args(self.args(0) + [ '--compact' ]))
+        other = self.spool.submit([ self.spec(contype='host', users='other', source='10.0.1.1/32') ], settings, True)
+        proc = subprocess.Popen([ sys.executable, '-c', 'pass' ])
+        proc.wait()
+        gone = '{0:017.6f}.{1}.edit'.format(time.time(), proc.pid)
+        settings = pg_hba_settings(cli_parser().parse_args(self.args(0)))
+        self.spool.write_json(os.path.join(self.spool.folder, gone),
+                              { 'specs': [ self.spec(contype='host', users='gone', source='10.0.1.2/32') ],
+                                'settings': settings, 'reload': True })
+        self.run_locked(spooled=2)
+        self.assertEqual(sorted(self.rules()), [ 'user{0}'.format(pos) for pos in range(RUNS) ])
+        self.assertEqual(self.spooled(), [ other ])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,194 @@
+#!/usr/bin/python3
+
+'''
+# Copyright (C) 2017 Collaboration of KPN and Splendid Data
+#
+# This file is part of puppet_pure_postgres.
+#
+# puppet_pure_barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# puppet_pure_postgres is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with puppet_pure_postgres.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+'''
+Tests of the reload of postgres by pg_hba.py (PgHbaReloader) against a fake postmaster: a process that writes a line
+to a file for every SIGHUP it gets, with a postmaster.pid that points to it.
+
+Example usage:
+  python3 -m unittest discover -s tests
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import tempfile
+import unittest
+import threading
+import subprocess
+
+FILES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'files')
+sys.path.insert(0, FILES_DIR)
+
+from pg_hba import PgHbaReloader
+
+#The fake postmaster: it writes a line to the file in argv[1] for every SIGHUP, and says when its handler is set
+FAKE_POSTMASTER = '''
+import sys, time, signal
+def hup(signum, frame):
+    with open(sys.argv[1], 'a') as f:
+        f.write('hup\\n')
+signal.signal(signal.SIGHUP, hup)
+sys.stdout.write('ready\\n')
+sys.stdout.flush()
+while True:
+    time.sleep(1)
+'''
+
+#A fake postmaster that is stuck: it blocks SIGHUP, so that the signal stays pending
+STUCK_POSTMASTER = '''
+import sys, time, signal
+signal.pthread_sigmask(signal.SIG_BLOCK, [ signal.SIGHUP ])
+sys.stdout.write('ready\\n')
+sys.stdout.flush()
+while True:
+    time.sleep(1)
+'''
+
+class PgHbaReloadTest(unittest.TestCase):
+    def setUp(self):
+        self.folder    = tempfile.mkdtemp(prefix='pure_postgres_test_')
+        self.pid_file  = os.path.join(self.folder, 'postmaster.pid')
+        self.hups_file = os.path.join(self.folder, 'hups')
+        self.postmaster = subprocess.Popen([ sys.executable, '-c', FAKE_POSTMASTER, self.hups_file ],
+                                           stdout=subprocess.PIPE)
+        self.postmaster.stdout.readline()
+        with open(self.pid_file, 'w') as f:
+            f.write('{0}\n{1}\n1500000000\n5432\n{1}\n'.format(self.postmaster.pid, self.folder))
+
+    def tearDown(self):
+        self.postmaster.kill()
+        self.postmaster.wait()
+        self.postmaster.stdout.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def hups(self, expected, wait=2.0):
+        '''
+        This function returns the number of SIGHUPs the fake postmaster handled, after waiting (at most wait seconds)
+        until it handled expected.
+        '''
+        deadline = time.time() + wait
+        while True:
+            try:
+                with open(self.hups_file) as f:
+                    count = len(f.readlines())
+            except IOError:
+                count = 0
+            if count >= expected or time.time() > deadline:
+                return count
+            time.sleep(0.01)
+
+    def test_signal(self):
+        result = PgHbaReloader(self.pid_file).request()
+        self.assertTrue(result['reloaded'])
+        self.assertEqual(result['method'], 'signal')
+        self.assertEqual(result['pid'], self.postmaster.pid)
+        self.assertEqual(self.hups(1), 1)
+
+    def test_not_running(self):
+        os.remove(self.pid_file)
+        self.assertEqual(PgHbaReloader(self.pid_file).request()['reason'], 'not running')
+        #A stale pid file, of a process that has ended
+        proc = subprocess.Popen([ sys.executable, '-c', 'pass' ])
+        proc.wait()
+        with open(self.pid_file, 'w') as f:
+            f.write('{0}\n'.format(proc.pid))
+        result = PgHbaReloader(self.pid_file).request()
+        self.assertFalse(result['reloaded'])
+        self.assertEqual(result['reason'], 'not running')
+        self.assertEqual(self.hups(1, wait=0.2), 0)
+
+    @unittest.skipUnless(hasattr(signal, 'pthread_sigmask') and os.path.isdir('/proc'),
+                         'needs pthread_sigmask and /proc')
+    def test_timeout(self):
+        #A SIGHUP that is still pending when the timeout passes is not reported as a reload
+        stuck = subprocess.Popen([ sys.executable, '-c', STUCK_POSTMASTER ], stdout=subprocess.PIPE)
+        try:
+            stuck.stdout.readline()
+            with open(self.pid_file, 'w') as f:
+                f.write('{0}\n'.format(stuck.pid))
+            reloader = PgHbaReloader(self.pid_file)
+            reloader.timeout = 0.2
+            result = reloader.request()
+        finally:
+            stuck.kill()
+            stuck.wait()
+            stuck.stdout.close()
+        self.assertFalse(result['reloaded'])
+        self.assertEqual(result['reason'], 'timeout')
+        self.assertEqual(result['pid'], stuck.pid)
+        self.assertGreaterEqual(result['seconds'], 0.2)
+
+    def test_init_script(self):
+        #Without a pid file, the init script is used
+        reloader = PgHbaReloader()
+        reloader.init_cmd = [ sys.executable, '-c', 'pass' ]
+        self.assertEqual(reloader.request()['method'], 'init')
+        self.assertTrue(reloader.results[0]['reloaded'])
+        reloader.init_cmd = [ sys.executable, '-c', 'import sys; sys.exit(3)' ]
+        result = reloader.request()
+        self.assertFalse(result['reloaded'])
+        self.assertIn('returned 3', result['reason'])
+
+    def test_debounce(self):
+        #Requests within the window are grouped into one SIGHUP, sent by the last request
+        stamp_file = os.path.join(self.folder, 'pg_hba.conf.reload')
+        reloaders  = [ PgHbaReloader(self.pid_file, 0.5, stamp_file) for i in range(3) ]
+        threads    = []
+        for reloader in reloaders:
+            threads.append(threading.Thread(target=reloader.request))
+            threads[-1].start()
+            time.sleep(0.05)
+        for thread in threads:
+            thread.join()
+        results = [ reloader.results[0] for reloader in reloaders ]
+        self.assertEqual([ result['reloaded'] for result in results ], [ False, False, True ])
+        self.assertEqual([ result['reason'] for result in results[:2] ], [ 'debounced', 'debounced' ])
+        self.assertEqual(self.hups(1), 1)
+        self.assertEqual(self.hups(2, wait=0.2), 1)
+
+    def test_modify_pg_hba(self):
+        #Concurrent runs of modify_pg_hba.py reload once, and don't hold the lock during the reload window
+        pg_hba_file = os.path.join(self.folder, 'pg_hba.conf')
+        with open(pg_hba_file, 'w') as f:
+            f.write('local all all trust\n')
+        procs = []
+        for pos in range(3):
+            procs.append(subprocess.Popen([ sys.executable, os.path.join(FILES_DIR, 'modify_pg_hba.py'),
+                                            '-f', pg_hba_file, '-t', 'host', '-d', 'all', '-u', 'user{0}'.format(pos),
+                                            '-s', '10.0.0.{0}/32'.format(pos), '-m', 'md5', '--reload',
+                                            '--pid-file', self.pid_file, '--reload-window', '1', '--stats' ],
+                                          stdout=subprocess.PIPE, stderr=subprocess.PIPE))
+        for proc in procs:
+            out, err = proc.communicate()
+            self.assertEqual(proc.returncode, 0, err)
+            stats = json.loads(err.decode('utf-8'))
+            self.assertLess(stats['phases'].get('lock_hold', 0), 1)
+        with open(pg_hba_file) as f:
+            self.assertEqual(len([ line for line in f if line.startswith('host') ]), 3)
+        self.assertEqual(self.hups(1), 1)
+        self.assertEqual(self.hups(2, wait=0.2), 1)
+
+if __name__ == "__main__":
+    unittest.main()
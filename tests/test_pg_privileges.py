@@ -0,0 +1,162 @@
+#!/usr/bin/python3
+
+'''
+# Copyright (C) 2017 Collaboration of KPN and Splendid Data
+#
+# This file is part of puppet_pure_postgres.
+#
+# puppet_pure_barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# puppet_pure_postgres is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with puppet_pure_postgres.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+'''
+Tests of pg_privileges.py against a throwaway postgres: a cluster is created with initdb in a temporary folder,
+and started with only a unix socket in that folder. The binaries are taken from $PG_BIN (or from $PATH).
+The tests are skipped when there is no initdb, or when they run as root (initdb refuses to run as root).
+Every test reconciles a desired state, checks the statements that are needed, runs them, and checks that nothing
+is needed after that.
+
+Example usage:
+  PG_BIN=/usr/pgsql-9.6/bin python3 -m unittest discover -s tests
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'files'))
+
+from pg_protocol import PgConnection
+from pg_privileges import PgPrivilegeReconciler
+
+'''
+This function returns the folder with initdb, pg_ctl and postgres, or None when there is no initdb.
+'''
+def pg_bin():
+    folders = [ os.environ['PG_BIN'] ] if os.environ.get('PG_BIN') else os.environ.get('PATH', '').split(os.pathsep)
+    for folder in folders:
+        if os.access(os.path.join(folder, 'initdb'), os.X_OK):
+            return folder
+    return None
+
+class PgPrivilegesTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.bin_dir = pg_bin()
+        if cls.bin_dir is None:
+            raise unittest.SkipTest('initdb not found (set PG_BIN)')
+        if os.getuid() == 0:
+            raise unittest.SkipTest('initdb cannot run as root')
+        cls.folder   = tempfile.mkdtemp(prefix='pure_postgres_test_')
+        cls.data_dir = os.path.join(cls.folder, 'data')
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call([ os.path.join(cls.bin_dir, 'initdb'), '-D', cls.data_dir, '-U', 'postgres',
+                                    '-A', 'trust' ], stdout=devnull, stderr=devnull)
+            subprocess.check_call([ os.path.join(cls.bin_dir, 'pg_ctl'), '-D', cls.data_dir, '-w', '-l',
+                                    os.path.join(cls.folder, 'postgres.log'), '-o',
+                                    "-k {0} -c listen_addresses=''".format(cls.folder), 'start' ],
+                                  stdout=devnull, stderr=devnull)
+
+    @classmethod
+    def tearDownClass(cls):
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call([ os.path.join(cls.bin_dir, 'pg_ctl'), '-D', cls.data_dir, '-w', '-m', 'immediate',
+                              'stop' ], stdout=devnull, stderr=devnull)
+        shutil.rmtree(cls.folder, ignore_errors=True)
+
+    def connect(self, db):
+        return PgConnection.connect_pid_file(os.path.join(self.data_dir, 'postmaster.pid'), user='postgres',
+                                             database=db, timeout=10)
+
+    def query(self, sql, db='postgres'):
+        conn = self.connect(db)
+        try:
+            return conn.query(sql)
+        finally:
+            conn.close()
+
+    def reconcile(self, desired):
+        '''
+        This function returns the statements that are needed for desired (of all databases, in order), and checks
+        that there are no errors.
+        '''
+        reconciler = PgPrivilegeReconciler(desired)
+        statements = []
+        for db, conn, db_statements in reconciler.statements(self.connect):
+            conn.close()
+            statements += db_statements
+        self.assertEqual(reconciler.errors, [])
+        return statements
+
+    def converge(self, desired, expected):
+        '''
+        This procedure checks that the statements for desired are expected, runs them, and checks that nothing is
+        needed after that.
+        '''
+        statements = self.reconcile(desired)
+        self.assertEqual(statements, expected)
+        for sql in statements:
+            self.query(sql)
+        self.assertEqual(self.reconcile(desired), [])
+
+    def test_acldefault(self):
+        #Objects without an acl have the privileges of acldefault: for the owner, and execute of functions for PUBLIC
+        self.query('CREATE TABLE default_t (id int); CREATE FUNCTION default_f() RETURNS int AS $$ SELECT 1 $$ LANGUAGE sql')
+        self.assertEqual(self.query("SELECT relacl FROM pg_class WHERE relname = 'default_t'"), [ [ None ] ])
+        self.assertEqual(self.reconcile({ 'grants': [
+            { 'role': 'postgres', 'privilege': 'all', 'object_type': 'table', 'object': 'default_t' },
+            { 'role': 'public', 'privilege': 'execute', 'object_type': 'function', 'object': 'default_f()' } ] }), [])
+        self.converge({ 'revokes': [ { 'role': 'public', 'privilege': 'execute', 'object_type': 'function',
+                                       'object': 'default_f()' } ] },
+                      [ 'REVOKE EXECUTE ON FUNCTION "public"."default_f"() FROM PUBLIC;' ])
+
+    def test_all_in_schema(self):
+        self.query('CREATE SCHEMA collapse; CREATE TABLE collapse.a (id int); CREATE TABLE collapse.b (id int); '
+                   'CREATE ROLE collapse_reader')
+        desired = { 'grants': [ { 'role': 'collapse_reader', 'privilege': 'select',
+                                  'object_type': 'all tables in schema', 'object': 'collapse' } ] }
+        #None of the tables has the privilege: one statement for the schema
+        self.assertEqual(self.reconcile(desired),
+                         [ 'GRANT SELECT ON ALL TABLES IN SCHEMA "collapse" TO "collapse_reader";' ])
+        #One of them has it already: a statement for the other one only
+        self.query('GRANT SELECT ON collapse.a TO collapse_reader')
+        self.converge(desired, [ 'GRANT SELECT ON TABLE "collapse"."b" TO "collapse_reader";' ])
+
+    def test_revoke_public(self):
+        #PUBLIC can connect to a database and create temporary tables by default (acldefault)
+        self.query('CREATE DATABASE revoke_db')
+        self.query('CREATE ROLE revoke_user LOGIN')
+        #revoke_user only has temporary through PUBLIC, so there is nothing to revoke from it itself
+        self.assertEqual(self.reconcile({ 'revokes': [ { 'role': 'revoke_user', 'privilege': 'temp',
+                                                         'object_type': 'database', 'object': 'revoke_db' } ] }), [])
+        self.converge({ 'revokes': [ { 'role': 'PUBLIC', 'privilege': 'temporary', 'object_type': 'database',
+                                       'object': 'revoke_db' } ] },
+                      [ 'REVOKE TEMPORARY ON DATABASE "revoke_db" FROM PUBLIC;' ])
+        self.assertEqual(self.query("SELECT has_database_privilege('revoke_user', 'revoke_db', 'temporary')"),
+                         [ [ 'f' ] ])
+
+    def test_role_then_grant(self):
+        #The role is created before it is granted to, also when it doesn't exist when the snapshot is read
+        self.query('CREATE TABLE role_t (id int)')
+        self.converge({ 'roles':  [ { 'name': 'role_new', 'login': True } ],
+                        'grants': [ { 'role': 'role_new', 'privilege': 'select, insert', 'object_type': 'table',
+                                      'object': 'role_t', 'with_grant': True } ] },
+                      [ 'CREATE ROLE "role_new" LOGIN;',
+                        'GRANT INSERT, SELECT ON TABLE "public"."role_t" TO "role_new" WITH GRANT OPTION;' ])
+        self.assertEqual(self.query("SELECT rolcanlogin FROM pg_roles WHERE rolname = 'role_new'"), [ [ 't' ] ])
+
+if __name__ == "__main__":
+    unittest.main()
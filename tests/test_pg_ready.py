@@ -0,0 +1,191 @@
+#!/usr/bin/python3
+
+'''
+# Copyright (C) 2017 Collaboration of KPN and Splendid Data
+#
+# This file is part of puppet_pure_postgres.
+#
+# puppet_pure_barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# puppet_pure_postgres is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with puppet_pure_postgres.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+'''
+Tests of pg_ready.py against a fake postmaster: a thread that listens on a unix socket in a temporary folder, and
+answers every startup message like postgres would in a state (starting up, asking for a password, trust, or an error),
+with a postmaster.pid that points to the socket.
+
+Example usage:
+  python3 -m unittest discover -s tests
+'''
+
+import os
+import sys
+import time
+import shutil
+import socket
+import struct
+import tempfile
+import unittest
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'files'))
+
+from pg_ready import PgReadyWaiter, probe
+
+PORT = 6543
+
+'''
+This function returns an error message of the protocol of postgres, with a sqlstate.
+'''
+def error_message(code, message):
+    payload = b'SFATAL\0C' + code.encode('ascii') + b'\0M' + message.encode('ascii') + b'\0\0'
+    return b'E' + struct.pack('!i', len(payload) + 4) + payload
+
+#Answers of the fake postmaster to a startup message
+STARTING = error_message('57P03', 'the database system is starting up')
+NO_DB    = error_message('3D000', 'database "postgres" does not exist')
+MD5      = b'R' + struct.pack('!ii', 12, 5) + b'salt'
+TRUST    = b'R' + struct.pack('!ii', 8, 0) + b'Z' + struct.pack('!i', 5) + b'I'
+
+'''
+This class is a fake postmaster: it answers every connection on the unix socket with answer (one of the answers above).
+'''
+class FakePostmaster(threading.Thread):
+    def __init__(self, folder, answer):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.answer = answer
+        self.count  = 0
+        self.path   = os.path.join(folder, '.s.PGSQL.{0}'.format(PORT))
+        self.sock   = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(5)
+
+    def run(self):
+        while True:
+            try:
+                conn = self.sock.accept()[0]
+            except socket.error:
+                return
+            try:
+                conn.recv(1024)
+                conn.sendall(self.answer)
+                self.count += 1
+            finally:
+                conn.close()
+
+    def stop(self):
+        #shutdown wakes up accept, which close alone doesn't do
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        self.join()
+        os.remove(self.path)
+
+class PgReadyTest(unittest.TestCase):
+    def setUp(self):
+        self.folder   = tempfile.mkdtemp(prefix='pure_postgres_test_')
+        self.pid_file = os.path.join(self.folder, 'postmaster.pid')
+        self.server   = None
+
+    def tearDown(self):
+        if self.server:
+            self.server.stop()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def write_pid_file(self, pid=None, status=None):
+        '''
+        This procedure writes postmaster.pid like postgres does (the status line only for postgres 10 and newer).
+        '''
+        lines = [ str(pid or os.getpid()), self.folder, '1500000000', str(PORT), self.folder, '*', '0 0' ]
+        if status:
+            lines.append(status)
+        with open(self.pid_file, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def start(self, answer):
+        self.server = FakePostmaster(self.folder, answer)
+        self.server.start()
+
+    def test_no_pid_file(self):
+        self.assertEqual(probe(self.pid_file)[0], 'no pid file')
+
+    def test_not_running(self):
+        #The pid of a process that has ended
+        proc = subprocess.Popen([ sys.executable, '-c', 'pass' ])
+        proc.wait()
+        self.write_pid_file(pid=proc.pid, status='ready')
+        self.assertEqual(probe(self.pid_file)[0], 'not running')
+
+    def test_status_line(self):
+        #While the status line says starting, the socket isn't tried
+        self.start(TRUST)
+        self.write_pid_file(status='starting')
+        self.assertEqual(probe(self.pid_file)[0], 'starting')
+        self.assertEqual(self.server.count, 0)
+
+    def test_no_socket(self):
+        self.write_pid_file(status='ready')
+        self.assertEqual(probe(self.pid_file, timeout=1)[0], 'no socket')
+
+    def test_starting(self):
+        self.start(STARTING)
+        self.write_pid_file()
+        state, detail = probe(self.pid_file, timeout=1)
+        self.assertEqual(state, 'starting')
+        self.assertIn('starting up', detail)
+
+    def test_accepting(self):
+        for answer in [ MD5, TRUST, NO_DB ]:
+            self.start(answer)
+            self.write_pid_file()
+            self.assertEqual(probe(self.pid_file, timeout=1), ('ready', None))
+            self.server.stop()
+            self.server = None
+
+    def test_standby(self):
+        self.start(MD5)
+        self.write_pid_file(status='standby')
+        self.assertEqual(probe(self.pid_file, timeout=1)[0], 'standby')
+
+    def test_wait_until_ready(self):
+        self.start(STARTING)
+        self.write_pid_file()
+        timer = threading.Timer(0.5, lambda: setattr(self.server, 'answer', MD5))
+        timer.start()
+        try:
+            result = PgReadyWaiter(self.pid_file, timeout=10, min_sleep=0.01, max_sleep=0.1).wait()
+        finally:
+            timer.cancel()
+        self.assertTrue(result['ready'])
+        self.assertEqual(result['state'], 'ready')
+        self.assertEqual(sorted(result['states']), [ 'ready', 'starting' ])
+        self.assertGreater(result['probes'], 2)
+        self.assertGreaterEqual(result['seconds'], 0.4)
+        self.assertLess(result['seconds'], 5)
+
+    def test_wait_timeout(self):
+        self.start(STARTING)
+        self.write_pid_file()
+        start  = time.time()
+        result = PgReadyWaiter(self.pid_file, timeout=0.5, min_sleep=0.01, max_sleep=0.1).wait()
+        self.assertFalse(result['ready'])
+        self.assertEqual(result['state'], 'starting')
+        self.assertIn('starting up', result['detail'])
+        self.assertLess(time.time() - start, 3)
+
+if __name__ == "__main__":
+    unittest.main()
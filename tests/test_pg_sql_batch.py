@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+
+'''
+# Copyright (C) 2017 Collaboration of KPN and Splendid Data
+#
+# This file is part of puppet_pure_postgres.
+#
+# puppet_pure_barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# puppet_pure_postgres is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with puppet_pure_postgres.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+'''
+Tests of pg_sql_batch.py against a throwaway postgres: a cluster is created with initdb in a temporary folder,
+and started with only a unix socket in that folder. The binaries are taken from $PG_BIN (or from $PATH).
+The tests are skipped when there is no initdb, or when they run as root (initdb refuses to run as root).
+
+Example usage:
+  PG_BIN=/usr/pgsql-9.6/bin python3 -m unittest discover -s tests
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'files'))
+
+from pg_protocol import PgConnection
+from pg_sql_batch import PgSqlBatch
+
+'''
+This function returns the folder with initdb, pg_ctl and postgres, or None when there is no initdb.
+'''
+def pg_bin():
+    folders = [ os.environ['PG_BIN'] ] if os.environ.get('PG_BIN') else os.environ.get('PATH', '').split(os.pathsep)
+    for folder in folders:
+        if os.access(os.path.join(folder, 'initdb'), os.X_OK):
+            return folder
+    return None
+
+class PgSqlBatchTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.bin_dir = pg_bin()
+        if cls.bin_dir is None:
+            raise unittest.SkipTest('initdb not found (set PG_BIN)')
+        if os.getuid() == 0:
+            raise unittest.SkipTest('initdb cannot run as root')
+        cls.folder   = tempfile.mkdtemp(prefix='pure_postgres_test_')
+        cls.data_dir = os.path.join(cls.folder, 'data')
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call([ os.path.join(cls.bin_dir, 'initdb'), '-D', cls.data_dir, '-U', 'postgres',
+                                    '-A', 'trust' ], stdout=devnull, stderr=devnull)
+            subprocess.check_call([ os.path.join(cls.bin_dir, 'pg_ctl'), '-D', cls.data_dir, '-w', '-l',
+                                    os.path.join(cls.folder, 'postgres.log'), '-o',
+                                    "-k {0} -c listen_addresses=''".format(cls.folder), 'start' ],
+                                  stdout=devnull, stderr=devnull)
+
+    @classmethod
+    def tearDownClass(cls):
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call([ os.path.join(cls.bin_dir, 'pg_ctl'), '-D', cls.data_dir, '-w', '-m', 'immediate',
+                              'stop' ], stdout=devnull, stderr=devnull)
+        shutil.rmtree(cls.folder, ignore_errors=True)
+
+    def connect(self, db):
+        return PgConnection.connect_pid_file(os.path.join(self.data_dir, 'postmaster.pid'), user='postgres',
+                                             database=db, timeout=10)
+
+    def run_batch(self, items, check=False):
+        return dict( (item['name'], item) for item in PgSqlBatch(items, self.connect).run(check) )
+
+    def query(self, sql, db='postgres'):
+        conn = self.connect(db)
+        try:
+            return conn.query(sql)
+        finally:
+            conn.close()
+
+    def test_guards(self):
+        items = [ { 'name': 'role', 'sql': 'CREATE ROLE guarded',
+                    'unless': "SELECT * FROM pg_roles WHERE rolname = 'guarded';" } ]
+        self.assertEqual(self.run_batch(items, check=True)['role']['status'], 'needed')
+        self.assertEqual(self.run_batch(items)['role']['status'], 'applied')
+        self.assertEqual(self.run_batch(items)['role']['status'], 'unchanged')
+        self.assertEqual(self.run_batch(items, check=True)['role']['status'], 'unchanged')
+
+    def test_failed_item(self):
+        status = self.run_batch([ { 'name': 'before', 'sql': 'CREATE TABLE failed_before (id int)' },
+                                  { 'name': 'failed', 'sql': 'SELEC 1' },
+                                  { 'name': 'after',  'sql': 'CREATE TABLE failed_after (id int)' } ])
+        self.assertEqual(status['before']['status'], 'applied')
+        self.assertEqual(status['failed']['status'], 'failed')
+        self.assertIn('syntax error', status['failed']['error'])
+        self.assertEqual(status['after']['status'], 'applied')
+        self.assertEqual(self.query("SELECT count(*) FROM pg_class WHERE relname LIKE 'failed_%'"), [ [ '2' ] ])
+
+    def test_commit_failure(self):
+        self.run_batch([ { 'name': 'parent', 'sql': 'CREATE TABLE commit_parent (id int PRIMARY KEY)' },
+                         { 'name': 'child',  'sql': 'CREATE TABLE commit_child (parent int REFERENCES commit_parent '
+                                                    'DEFERRABLE INITIALLY DEFERRED)' } ])
+        #The deferred foreign key is only checked by COMMIT, which rolls back all items of the transaction
+        status = self.run_batch([ { 'name': 'parent', 'sql': 'INSERT INTO commit_parent VALUES (1)' },
+                                  { 'name': 'child',  'sql': 'INSERT INTO commit_child VALUES (2)' },
+                                  { 'name': 'vacuum', 'sql': 'VACUUM commit_parent' },
+                                  { 'name': 'after',  'sql': 'INSERT INTO commit_parent VALUES (3)' } ])
+        self.assertEqual(status['parent']['status'], 'failed')
+        self.assertEqual(status['child']['status'], 'failed')
+        self.assertIn('foreign key', status['child']['error'])
+        self.assertEqual(status['vacuum']['status'], 'applied')
+        self.assertEqual(status['after']['status'], 'applied')
+        self.assertEqual(self.query('SELECT id FROM commit_parent'), [ [ '3' ] ])
+
+    def test_no_transaction(self):
+        status = self.run_batch([ { 'name': 'db', 'sql': 'CREATE DATABASE batch_db',
+                                    'unless': "SELECT * FROM pg_database WHERE datname = 'batch_db'" },
+                                  { 'name': 'table', 'sql': 'CREATE TABLE batch_table (id int)', 'db': 'batch_db' } ])
+        self.assertEqual(status['db']['status'], 'applied')
+        self.assertEqual(status['table']['status'], 'applied')
+        self.assertEqual(self.query("SELECT count(*) FROM pg_class WHERE relname = 'batch_table'", 'batch_db'),
+                         [ [ '1' ] ])
+
+    def test_connect_failure(self):
+        status = self.run_batch([ { 'name': 'missing', 'sql': 'SELECT 1', 'db': 'batch_missing_db' },
+                                  { 'name': 'present', 'sql': 'SELECT 1' } ])
+        self.assertEqual(status['missing']['status'], 'failed')
+        self.assertEqual(status['present']['status'], 'applied')
+
+if __name__ == "__main__":
+    unittest.main()